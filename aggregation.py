@@ -0,0 +1,253 @@
+"""
+This module contains the aggregation engine, which totals the per sample uncertainties
+of a filling according to how each component is correlated in time. Adding uncertainties
+linearly, as calculate_total_combined_unc() does, treats them as fully correlated, while
+calculate_sum_variance() treats them as independent. Here each component is given its own
+correlation model, such as a fully correlated calibration deviation, an uncorrelated
+repeatability, and a first order autoregressive (AR(1)) field condition. Every model is
+computed from sums over the samples in O(n), without building an n x n covariance matrix.
+
+Classes:
+    FullyCorrelated
+    Uncorrelated
+    AutoRegressive
+    UncertaintyAggregator
+"""
+import math
+import numpy as np
+from fill_state import FillState
+from uncertainty_tools import UncertaintyTools
+
+
+class FullyCorrelated:
+    """Correlation model for systematic components, fully correlated in time."""
+
+    def combine(self, contributions, timestamps=None):
+        """
+        Totals the contributions of the samples.
+
+        Parameters:
+            - Contributions: Array of absolute standard uncertainties per sample [kg]
+            - Timestamps: Not used.
+
+        Returns:
+            - Standard uncertainty of the total [kg]
+        """
+        return abs(float(np.sum(contributions)))
+
+
+class Uncorrelated:
+    """Correlation model for random components, independent between samples."""
+
+    def combine(self, contributions, timestamps=None):
+        """
+        Totals the contributions of the samples.
+
+        Parameters:
+            - Contributions: Array of absolute standard uncertainties per sample [kg]
+            - Timestamps: Not used.
+
+        Returns:
+            - Standard uncertainty of the total [kg]
+        """
+        return math.sqrt(float(np.dot(contributions, contributions)))
+
+
+class AutoRegressive:
+    """
+    Correlation model for components which are correlated between nearby samples, with a
+    correlation decreasing exponentially with the time between them. The correlation
+    between subsequent samples is either given directly, or as a time constant.
+    """
+
+    def __init__(self, correlation=None, time_constant=None):
+        """
+        Parameters:
+            - correlation: Correlation between subsequent samples, between 0 and 1.
+            - time_constant: Time for the correlation to decrease to 1/e [s]. Used
+              together with the timestamps of the samples.
+        """
+        if (correlation is None) == (time_constant is None):
+            raise ValueError("Set either the correlation or the time constant.")
+        if correlation is not None and not 0 <= correlation <= 1:
+            raise ValueError("The correlation must be between 0 and 1.")
+        self.correlation = correlation
+        self.time_constant = time_constant
+
+    def get_log_decays(self, sample_count, timestamps):
+        """
+        Returns the logarithm of the correlation between each sample and the previous.
+
+        Parameters:
+            - Sample count: Number of samples.
+            - Timestamps: Array of sample times [s], required with a time constant.
+
+        Returns:
+            - Array of log correlations, where the first element is zero.
+        """
+        log_decays = np.zeros(sample_count)
+        if self.time_constant is not None:
+            if timestamps is None:
+                raise ValueError("Timestamps are required with a time constant.")
+            durations = np.diff(np.asarray(timestamps, dtype=float))
+            log_decays[1:] = -durations / self.time_constant
+        else:
+            log_decays[1:] = math.log(self.correlation)
+        return log_decays
+
+    def combine(self, contributions, timestamps=None):
+        """
+        Totals the contributions of the samples. The variance is the sum of squares plus
+        twice the sum of a_j * g_j, where g_j = sum(a_i * rho_ij) over the previous samples
+        follows the recursion g_j = d_j * (g_j-1 + a_j-1). The recursion is evaluated in
+        blocks, where the scaling by the decays within a block cannot overflow.
+
+        Parameters:
+            - Contributions: Array of absolute standard uncertainties per sample [kg]
+            - Timestamps: Array of sample times [s]
+
+        Returns:
+            - Standard uncertainty of the total [kg]
+        """
+        contributions = np.asarray(contributions, dtype=float)
+        sample_count = len(contributions)
+        if sample_count == 0:
+            return 0.0
+        if self.correlation == 0:
+            return Uncorrelated().combine(contributions)
+        levels = -np.cumsum(self.get_log_decays(sample_count, timestamps))
+
+        cross_sum = 0.0
+        carry = 0.0
+        start = 0
+        while start < sample_count:
+            end = int(np.searchsorted(levels, levels[start] + 700, side="right"))
+            end = max(end, start + 1)
+            block = contributions[start:end]
+            scaled = block * np.exp(levels[start:end] - levels[start])
+            # Sum of the scaled contributions of the previous samples in the block.
+            previous = np.concatenate(([0.0], np.cumsum(scaled[:-1])))
+            history = np.exp(levels[start] - levels[start:end]) * (carry + previous)
+            cross_sum += float(np.dot(block, history))
+            if end < sample_count:
+                decay = math.exp(levels[start] - levels[end])
+                carry = decay * (carry + float(np.sum(scaled)))
+            start = end
+
+        variance = float(np.dot(contributions, contributions)) + 2 * cross_sum
+        return math.sqrt(max(variance, 0.0))
+
+
+class UncertaintyAggregator:
+    """
+    This class totals the per sample components of UncertaintyTools over a filling,
+    using a correlation model per component. The components are assumed independent of
+    each other, and are added in quadrature after being totaled.
+    """
+
+    def __init__(self, uncertainty_tools: UncertaintyTools, correlation_models=None):
+        """
+        Parameters:
+            - uncertainty_tools: UncertaintyTools giving the per sample components.
+            - correlation_models: Optional dictionary of component name: model, replacing
+              the default models of those components.
+        """
+        self.uncertainty_tools = uncertainty_tools
+        self.correlation_models = {
+            "calibration_deviation": FullyCorrelated(),
+            "calibration_reference": FullyCorrelated(),
+            "calibration_repeatability": Uncorrelated(),
+            "field_repeatability": Uncorrelated(),
+            "field_condition": AutoRegressive(correlation=0.9),
+            "temperature": FullyCorrelated(),
+            "pressure": FullyCorrelated(),
+            "annual": FullyCorrelated(),
+        }
+        if correlation_models is not None:
+            self.correlation_models.update(correlation_models)
+
+    def get_sample_weights(self, sample_count, formatting=1 / 60, timestamps=None):
+        """
+        Returns the duration each sample is counted for, matching the rectangular sum of
+        calculate_total_combined_unc(), or the trapezoidal rule for timestamped samples.
+
+        Parameters:
+            - Sample count: Number of samples.
+            - Formatting: Duration of each sample [min]
+            - Timestamps: Optional array of sample times [s]
+
+        Returns:
+            - Array of durations [min]
+        """
+        if timestamps is None:
+            return np.full(sample_count, formatting)
+        durations = np.diff(np.asarray(timestamps, dtype=float)) / 60
+        weights = np.zeros(sample_count)
+        weights[:-1] += durations / 2
+        weights[1:] += durations / 2
+        return weights
+
+    def aggregate_components(
+        self,
+        flowrates,
+        temperatures,
+        pressures,
+        fill_state: FillState,
+        formatting=1 / 60,
+        timestamps=None,
+    ):
+        """
+        Totals each uncertainty component over the filling with its correlation model.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - Fill state: State of the filling, containing the previous temperature.
+            - Formatting: Duration of each sample [min]
+            - Timestamps: Optional array of sample times [s]
+
+        Returns:
+            - Dictionary of component name: standard uncertainty of the total [kg]
+        """
+        flowrates = np.asarray(flowrates, dtype=float)
+        components = self.uncertainty_tools.calculate_component_arrays(
+            flowrates, temperatures, pressures, fill_state
+        )
+        weights = self.get_sample_weights(len(flowrates), formatting, timestamps)
+        # Samples without flow do not contribute, as in calculate_total_abs_unc_std().
+        weights = np.where(flowrates != 0, weights, 0.0)
+        return {
+            name: self.correlation_models[name].combine(values * weights, timestamps)
+            for name, values in components.items()
+        }
+
+    def calculate_total_system_rel_unc_k(
+        self, mass_delivered, component_totals, fill_state: FillState, k
+    ):
+        """
+        Calculates the relative expanded uncertainty of the filling, as
+        UncertaintyTools.calculate_total_system_rel_unc_k(), with the CFM uncertainty
+        given by the correlated component totals.
+
+        Parameters:
+            - Mass delivered: Calculated corrected mass delivered [kg]
+            - Component totals: Dictionary returned by aggregate_components() [kg]
+            - Fill state: State of the filling, containing the pre- and post-fill
+              pressures [Pa] and temperatures [K]
+            - k: Coverage factor
+
+        Returns:
+            - Relative expanded uncertainty of the filling.
+        """
+        cfm_uncertainty = self.uncertainty_tools.calculate_sum_variance(
+            *component_totals.values()
+        )
+        correction_uncertainty = self.uncertainty_tools.calculate_correction_uncertainty(
+            fill_state
+        )
+        rel_unc = self.uncertainty_tools.calculate_sum_variance(
+            cfm_uncertainty / mass_delivered,
+            correction_uncertainty / mass_delivered,
+        )
+        return self.uncertainty_tools.convert_std_to_confidence(rel_unc, k)
@@ -0,0 +1,409 @@
+"""
+This module runs batch audits of fillings as map-reduce jobs. The fillings are
+partitioned by station and day, each partition is evaluated by a map task running the
+UncertaintyTools and Correction pipeline of its station, and the fill summaries of each
+partition are reduced into a FillSummaryStore and a FillDistribution as they complete.
+Only the summaries are returned by the tasks, never the per sample arrays.
+
+The tasks run on a pluggable backend:
+    - InProcessBackend: In the calling process, for debugging.
+    - ProcessPoolBackend: A multiprocessing pool on the local host.
+    - LocalClusterBackend: A process pool of spawned workers, which share nothing with the
+      parent, as the nodes of a cluster. Used to test jobs before running them on a
+      cluster.
+    - DaskBackend: A Dask cluster, or a local Dask cluster. Requires dask.distributed.
+    - RayBackend: A Ray cluster, or a local Ray instance. Requires ray.
+Every backend keeps a bounded number of tasks in flight, so the partitions may be
+generated lazily, and each partition may load its own fillings on the worker.
+
+Classes:
+    AuditTask
+    PartitionResult
+    InProcessBackend
+    ProcessPoolBackend
+    LocalClusterBackend
+    DaskBackend
+    RayBackend
+    BatchAudit
+Functions:
+    partition_fills: Groups fillings into partitions by station and day.
+    get_worker_configuration: Returns the configuration of a task, cached per worker.
+    audit_partition: Evaluates the fillings of a partition, run by the workers.
+"""
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from batch_evaluator import BatchEvaluator
+from sketches import FillDistribution
+from station_registry import load_configuration
+from instrumentation import timed
+
+try:
+    from dask import distributed
+except ImportError:
+    distributed = None
+
+try:
+    import ray
+except ImportError:
+    ray = None
+
+DASK_AVAILABLE = distributed is not None
+RAY_AVAILABLE = ray is not None
+
+
+class AuditTask:
+    """
+    This class describes the map task of one partition: the fillings of a station on
+    one day, and the configuration to evaluate them with.
+    """
+
+    def __init__(self, station_id, day, configuration, fills, k, names, sketch_size):
+        """
+        Parameters:
+            - station_id: Identifier of the station.
+            - day: Day of the fillings, as YYYY-MM-DD.
+            - configuration: The HRS configuration of the station, or the path to its
+              workbook, read on the worker.
+            - fills: List of (fill id, fill time, flowrates [kg/min], temperatures [C],
+              pressures [bar]), optionally followed by the timestamps [s]. May instead be
+              a picklable callable returning the list, called on the worker.
+            - k: Coverage factor
+            - names: Keys of the fill summaries summarized by the FillDistribution.
+            - sketch_size: Accuracy parameter of the sketches.
+        """
+        self.station_id = station_id
+        self.day = day
+        self.configuration = configuration
+        self.fills = fills
+        self.k = k
+        self.names = names
+        self.sketch_size = sketch_size
+
+
+class PartitionResult:
+    """
+    This class holds the result of the map task of one partition.
+    """
+
+    def __init__(self, station_id, day, rows, distribution, worker):
+        """
+        Parameters:
+            - station_id: Identifier of the station.
+            - day: Day of the fillings.
+            - rows: List of (fill id, fill time, summary), as taken by
+              FillSummaryStore.add_fills().
+            - distribution: The FillDistribution of the fillings.
+            - worker: Process ID of the worker which ran the task.
+        """
+        self.station_id = station_id
+        self.day = day
+        self.rows = rows
+        self.distribution = distribution
+        self.worker = worker
+
+
+def partition_fills(fills):
+    """
+    Groups fillings into partitions by station and day.
+
+    Parameters:
+        - fills: Iterable of (station id, fill id, fill time, flowrates, temperatures,
+          pressures), optionally followed by the timestamps.
+
+    Returns:
+        - Dictionary of (station id, day): list of the fillings, without the station id.
+    """
+    partitions = {}
+    for fill in fills:
+        station_id, fill_time = fill[0], fill[2]
+        key = (station_id, fill_time.date().isoformat())
+        partitions.setdefault(key, []).append(tuple(fill[1:]))
+    return partitions
+
+
+# Configurations read by this worker, by workbook path and modification time.
+worker_configurations = {}
+
+
+def get_worker_configuration(configuration):
+    """
+    Returns the HRS configuration of a task. A workbook path is read once per worker,
+    and again only after the workbook has been modified.
+    """
+    if not isinstance(configuration, (str, os.PathLike)):
+        return configuration
+    key = (os.fspath(configuration), os.stat(configuration).st_mtime_ns)
+    hrs_config = worker_configurations.get(key)
+    if hrs_config is None:
+        hrs_config = load_configuration(configuration)
+        worker_configurations[key] = hrs_config
+    return hrs_config
+
+
+def audit_partition(task: AuditTask):
+    """
+    Evaluates every filling of a partition. Defined at module level, so it can be run by
+    every backend.
+
+    Parameters:
+        - task: The AuditTask of the partition.
+
+    Returns:
+        - The PartitionResult.
+    """
+    evaluator = BatchEvaluator(get_worker_configuration(task.configuration), max_workers=1)
+    fills = task.fills() if callable(task.fills) else task.fills
+    rows = []
+    for fill in fills:
+        fill_id, fill_time, flowrates, temperatures, pressures = fill[:5]
+        timestamps = fill[5] if len(fill) > 5 else None
+        _, summary = evaluator.evaluate_fill(
+            flowrates, temperatures, pressures, task.k, timestamps=timestamps
+        )
+        summary["k"] = task.k
+        rows.append((fill_id, fill_time, summary))
+    distribution = FillDistribution(task.names, task.sketch_size)
+    distribution.add_summaries([summary for _, _, summary in rows])
+    return PartitionResult(task.station_id, task.day, rows, distribution, os.getpid())
+
+
+class InProcessBackend:
+    """Runs the tasks one by one in the calling process."""
+
+    def map_unordered(self, function, tasks):
+        """Yields the result of each task."""
+        for task in tasks:
+            yield function(task)
+
+    def close(self):
+        """Nothing to release."""
+
+
+class ProcessPoolBackend:
+    """Runs the tasks on a pool of processes on the local host."""
+
+    def __init__(self, max_workers=None, max_pending=None, mp_context=None):
+        """
+        Parameters:
+            - max_workers: Number of processes, defaults to the number of CPUs.
+            - max_pending: Largest number of tasks in flight, defaults to twice the
+              number of processes.
+            - mp_context: Optional multiprocessing context.
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.max_workers
+        self.executor = ProcessPoolExecutor(self.max_workers, mp_context=mp_context)
+
+    def map_unordered(self, function, tasks):
+        """Yields the result of each task as it completes."""
+        tasks = iter(tasks)
+        pending = set()
+        while True:
+            for task in tasks:
+                pending.add(self.executor.submit(function, task))
+                if len(pending) >= self.max_pending:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    def close(self):
+        """Shuts down the processes."""
+        self.executor.shutdown()
+
+
+class LocalClusterBackend(ProcessPoolBackend):
+    """
+    Runs the tasks on spawned processes, which start from a fresh interpreter and
+    receive everything by pickling, as the workers of a cluster. A job which runs here
+    has no hidden dependency on the state of the parent process.
+    """
+
+    def __init__(self, workers=2, max_pending=None):
+        """
+        Parameters:
+            - workers: Number of worker processes.
+            - max_pending: Largest number of tasks in flight.
+        """
+        super().__init__(workers, max_pending, multiprocessing.get_context("spawn"))
+
+
+class DaskBackend:
+    """Runs the tasks on a Dask cluster. The optional dask.distributed package is required."""
+
+    def __init__(self, address=None, workers=2, max_pending=None):
+        """
+        Parameters:
+            - address: Address of the scheduler. Without an address, a local cluster of
+              processes is started and closed with the backend.
+            - workers: Number of workers of the local cluster.
+            - max_pending: Largest number of tasks in flight, defaults to twice the
+              number of workers.
+        """
+        if not DASK_AVAILABLE:
+            raise ImportError("The dask.distributed package is required for the Dask backend.")
+        self.cluster = None
+        if address is None:
+            self.cluster = distributed.LocalCluster(n_workers=workers, threads_per_worker=1)
+            address = self.cluster
+        self.client = distributed.Client(address)
+        worker_count = len(self.client.scheduler_info()["workers"]) or workers
+        self.max_pending = max_pending or 2 * worker_count
+
+    def map_unordered(self, function, tasks):
+        """Yields the result of each task as it completes."""
+        tasks = iter(tasks)
+        completed = distributed.as_completed()
+        pending = 0
+        for task in tasks:
+            completed.add(self.client.submit(function, task, pure=False))
+            pending += 1
+            if pending >= self.max_pending:
+                break
+        for future in completed:
+            yield future.result()
+            future.release()
+            for task in tasks:
+                completed.add(self.client.submit(function, task, pure=False))
+                break
+
+    def close(self):
+        """Closes the client, and the local cluster."""
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+class RayBackend:
+    """Runs the tasks on a Ray cluster. The optional ray package is required."""
+
+    def __init__(self, address=None, workers=2, max_pending=None):
+        """
+        Parameters:
+            - address: Address of the cluster. Without an address, a local instance with
+              the given number of CPUs is started.
+            - workers: Number of CPUs of the local instance.
+            - max_pending: Largest number of tasks in flight.
+        """
+        if not RAY_AVAILABLE:
+            raise ImportError("The ray package is required for the Ray backend.")
+        if address is None:
+            ray.init(num_cpus=workers, ignore_reinit_error=True)
+        else:
+            ray.init(address=address, ignore_reinit_error=True)
+        self.max_pending = max_pending or 2 * int(ray.cluster_resources().get("CPU", workers))
+
+    def map_unordered(self, function, tasks):
+        """Yields the result of each task as it completes."""
+        remote = ray.remote(function)
+        tasks = iter(tasks)
+        pending = []
+        while True:
+            for task in tasks:
+                pending.append(remote.remote(task))
+                if len(pending) >= self.max_pending:
+                    break
+            if not pending:
+                return
+            done, pending = ray.wait(pending, num_returns=1)
+            yield ray.get(done[0])
+
+    def close(self):
+        """Shuts down the local instance."""
+        ray.shutdown()
+
+
+class BatchAudit:
+    """
+    This class runs a batch audit: it creates the map task of every partition, runs them
+    on a backend, and reduces their results into a FillSummaryStore and a
+    FillDistribution.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        k=2,
+        store=None,
+        names=("total_relative_fill_unc_k", "mass_corrected"),
+        sketch_size=200,
+    ):
+        """
+        Parameters:
+            - backend: The backend running the tasks, defaults to InProcessBackend.
+            - k: Coverage factor
+            - store: Optional FillSummaryStore receiving the summaries of every filling.
+            - names: Keys of the fill summaries summarized by the FillDistribution.
+            - sketch_size: Accuracy parameter of the sketches.
+        """
+        self.backend = backend or InProcessBackend()
+        self.k = k
+        self.store = store
+        self.names = names
+        self.sketch_size = sketch_size
+
+    def create_tasks(self, configurations, partitions):
+        """
+        Creates the map task of each partition.
+
+        Parameters:
+            - configurations: Dictionary of station id: HRS configuration or workbook path.
+            - partitions: Iterable of (station id, day, fills), or a dictionary returned
+              by partition_fills().
+
+        Yields:
+            - AuditTask
+        """
+        if isinstance(partitions, dict):
+            partitions = ((station, day, fills) for (station, day), fills in partitions.items())
+        for station_id, day, fills in partitions:
+            yield AuditTask(
+                station_id,
+                day,
+                configurations[station_id],
+                fills,
+                self.k,
+                self.names,
+                self.sketch_size,
+            )
+
+    @timed("batch_audit.run")
+    def run(self, configurations, partitions):
+        """
+        Runs the audit of every partition.
+
+        Parameters:
+            - configurations: Dictionary of station id: HRS configuration or workbook path.
+            - partitions: Iterable of (station id, day, fills), or a dictionary returned
+              by partition_fills(). See AuditTask for the fills.
+
+        Returns:
+            - Dictionary with:
+                - "partitions": Number of partitions evaluated.
+                - "fills": Number of fillings evaluated.
+                - "distribution": The FillDistribution of every filling.
+                - "workers": Number of fillings evaluated per worker process ID.
+        """
+        distribution = FillDistribution(self.names, self.sketch_size)
+        partition_count = 0
+        fill_count = 0
+        workers = {}
+        for result in self.backend.map_unordered(
+            audit_partition, self.create_tasks(configurations, partitions)
+        ):
+            if self.store is not None:
+                self.store.add_fills(result.station_id, result.rows)
+            distribution.merge(result.distribution)
+            partition_count += 1
+            fill_count += len(result.rows)
+            workers[result.worker] = workers.get(result.worker, 0) + len(result.rows)
+        return {
+            "partitions": partition_count,
+            "fills": fill_count,
+            "distribution": distribution,
+            "workers": workers,
+        }
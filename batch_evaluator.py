@@ -0,0 +1,355 @@
+"""
+This module contains the BatchEvaluator class, which evaluates the uncertainty of long
+filling logs, or of many fillings, on a pool of threads sharing one HRS configuration.
+The work is done by the array methods of UncertaintyTools, where NumPy releases the GIL
+while processing each chunk, so the threads run in parallel without the cost of
+spawning processes and pickling data.
+
+Classes:
+    BatchEvaluator
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from hrs_config import HRSConfiguration
+from correction import Correction
+from fill_state import FillState
+from uncertainty_tools import UncertaintyTools
+from time_integration import SampleIntegrator
+from instrumentation import timed
+
+# Sample series integrated over the timestamps, in the order of FillState.add_totals().
+INTEGRATED_SERIES = ("abs_cfm", "abs_total", "abs_temp", "abs_pres", "abs_ltd")
+
+
+class BatchEvaluator:
+    """
+    This class splits filling logs into chunks, and evaluates the chunks on a thread pool.
+    The HRS configuration, UncertaintyTools and Correction objects are only read, and
+    are shared between all threads.
+    """
+
+    def __init__(
+        self,
+        hrs_config: HRSConfiguration,
+        max_workers=None,
+        chunk_size=65536,
+        correlated_corrections=False,
+    ):
+        """
+        Parameters:
+            - hrs_config: The HRS configuration shared by all fillings.
+            - max_workers: Number of threads, defaults to the number of CPUs.
+            - chunk_size: Number of samples evaluated per task.
+            - correlated_corrections: Whether the uncertainty of the vent and dead volume
+              corrections is propagated with their correlation, as described by
+              UncertaintyTools.calculate_correction_uncertainty().
+        """
+        self.hrs_config = hrs_config
+        self.correction = Correction(hrs_config)
+        self.uncertainty_tools = UncertaintyTools(
+            hrs_config, self.correction, correlated_corrections
+        )
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def evaluate_chunk(self, flowrates, temperatures, pressures, k, previous_temperature):
+        """
+        Evaluates one chunk of samples.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - k: Coverage factor
+            - Previous temperature: Temperature of the sample before the chunk [C]
+
+        Returns:
+            - Sample arrays: Dictionary returned by calculate_sample_arrays()
+            - Chunk state: FillState containing the totals of the chunk.
+        """
+        chunk_state = FillState()
+        chunk_state.previous_temperature = previous_temperature
+        sample_arrays = self.uncertainty_tools.calculate_sample_arrays(
+            flowrates, temperatures, pressures, k, chunk_state
+        )
+        chunk_state.record_samples(flowrates, temperatures, sample_arrays)
+        return sample_arrays, chunk_state
+
+    @timed("batch_evaluator.evaluate_samples")
+    def evaluate_samples(
+        self,
+        flowrates,
+        temperatures,
+        pressures,
+        k,
+        fill_state=None,
+        timestamps=None,
+        decimation_tolerance=None,
+    ):
+        """
+        Evaluates every sample of a filling log, split into chunks over the thread pool.
+        The first sample of each chunk is compared to the last sample of the preceding
+        chunk, giving the same result as evaluating the log in one piece. Timestamped
+        samples are integrated over the whole log after the chunks are joined, so the
+        intervals between chunks are included.
+
+        Timestamped samples can be decimated after they are evaluated, keeping only the
+        samples needed to follow the flowrate and the integrated uncertainties within a
+        tolerance. Every integrated total then deviates at most tolerance * duration from
+        the total of every sample, see SampleIntegrator.decimate(). The decimation only
+        reduces the size of the returned arrays, for storing or plotting: every sample
+        is still evaluated, since the uncertainties are not linear in the flowrate, and
+        the search costs more than the evaluation it could save.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - k: Coverage factor
+            - Fill state: State of the filling, which the totals are added to.
+            - Timestamps: Optional array of sample times [s]
+            - Decimation tolerance: Optional largest deviation of the flowrate and the
+              integrated uncertainties of the removed samples [kg/min], for timestamped
+              samples.
+
+        Returns:
+            - Sample arrays: Dictionary of arrays, as returned by calculate_sample_arrays()
+              When decimated, the arrays hold the kept samples, and "sample_index" holds
+              their indices in the log.
+            - Fill state: The updated fill state.
+        """
+        flowrates = np.asarray(flowrates, dtype=float)
+        temperatures = np.asarray(temperatures, dtype=float)
+        pressures = np.asarray(pressures, dtype=float)
+        if fill_state is None:
+            fill_state = FillState()
+
+        starts = range(0, len(flowrates), self.chunk_size)
+        previous_temperatures = [fill_state.previous_temperature] + [
+            temperatures[start - 1] for start in starts[1:]
+        ]
+
+        def evaluate(start, previous):
+            end = start + self.chunk_size
+            return self.evaluate_chunk(
+                flowrates[start:end],
+                temperatures[start:end],
+                pressures[start:end],
+                k,
+                previous,
+            )
+
+        if len(starts) <= 1 or self.max_workers == 1:
+            results = list(map(evaluate, starts, previous_temperatures))
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(evaluate, starts, previous_temperatures))
+
+        if len(results) == 1:
+            sample_arrays = results[0][0]
+        else:
+            sample_arrays = {
+                name: np.concatenate([arrays[name] for arrays, _ in results])
+                for name in results[0][0]
+            }
+        if timestamps is None:
+            for _, chunk_state in results:
+                fill_state.merge(chunk_state)
+        else:
+            if decimation_tolerance is not None:
+                kept, _ = SampleIntegrator().decimate(
+                    timestamps,
+                    [flowrates] + [sample_arrays[name] for name in INTEGRATED_SERIES],
+                    [decimation_tolerance] * (len(INTEGRATED_SERIES) + 1),
+                )
+                sample_arrays = {
+                    name: values[kept] for name, values in sample_arrays.items()
+                }
+                sample_arrays["sample_index"] = kept
+                flowrates = flowrates[kept]
+                temperatures = temperatures[kept]
+                timestamps = np.asarray(timestamps, dtype=float)[kept]
+            fill_state.record_samples(
+                flowrates, temperatures, sample_arrays, timestamps=timestamps
+            )
+        return sample_arrays, fill_state
+
+    def evaluate_fill(
+        self,
+        flowrates,
+        temperatures,
+        pressures,
+        k,
+        fill_state=None,
+        timestamps=None,
+        decimation_tolerance=None,
+    ):
+        """
+        Evaluates a complete filling, following PresentData.run_simulation() without the
+        presentation. The last sample gives the post-fill conditions used for the
+        dead volume and vent corrections.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - k: Coverage factor
+            - Fill state: State of the filling, holding the pre-fill conditions.
+            - Timestamps: Optional array of sample times [s]
+            - Decimation tolerance: Optional tolerance of the decimation of timestamped
+              samples [kg/min], see evaluate_samples().
+
+        Returns:
+            - Sample arrays: Dictionary of arrays, as returned by evaluate_samples()
+            - Summary: Dictionary containing the masses, corrections and totaled
+              uncertainties of the filling. When decimated, "decimation_error_bound" is
+              the largest deviation of each integrated total [kg].
+        """
+        sample_arrays, fill_state = self.evaluate_samples(
+            flowrates,
+            temperatures,
+            pressures,
+            k,
+            fill_state,
+            timestamps,
+            decimation_tolerance,
+        )
+        summary = self.summarize_fill(pressures, temperatures, k, fill_state)
+        if timestamps is not None and decimation_tolerance is not None:
+            duration = float(timestamps[-1]) - float(timestamps[0])
+            summary["decimation_error_bound"] = decimation_tolerance * duration / 60
+        return sample_arrays, summary
+
+    @timed("batch_evaluator.evaluate_compressed_fill")
+    def evaluate_compressed_fill(self, compressed_fill, k, fill_state=None):
+        """
+        Evaluates a complete filling from its runs, giving the summary of
+        evaluate_fill() without decoding the samples. See
+        UncertaintyTools.calculate_run_totals().
+
+        Parameters:
+            - Compressed fill: CompressedFill of the samples, at one minute per 60
+              samples as in evaluate_fill() without timestamps.
+            - k: Coverage factor
+            - Fill state: State of the filling, holding the pre-fill conditions.
+
+        Returns:
+            - Summary: Dictionary describing the filling, as returned by evaluate_fill().
+        """
+        if fill_state is None:
+            fill_state = FillState()
+        fill_state.add_totals(
+            self.uncertainty_tools.calculate_run_totals(compressed_fill, fill_state)
+        )
+        _, temperature, pressure = compressed_fill.get_last_values()[:, -1]
+        fill_state.previous_temperature = temperature
+        return self.summarize_fill([pressure], [temperature], k, fill_state)
+
+    @timed("batch_evaluator.summarize_fill")
+    def summarize_fill(self, pressures, temperatures, k, fill_state: FillState):
+        """
+        Calculates the corrections and the totaled uncertainties of a filling, after
+        every sample has been recorded in the fill state.
+
+        Parameters:
+            - Pressures: Array of pressures [bar]
+            - Temperatures: Array of temperatures [C]
+            - k: Coverage factor
+            - Fill state: State of the filling, containing the running totals.
+
+        Returns:
+            - Summary: Dictionary describing the filling.
+        """
+        fill_state.set_post_fill_conditions(
+            float(pressures[-1]) * 100000, float(temperatures[-1]) + 273.15
+        )
+        total_error, vented_error, dead_volume_error = (
+            self.correction.calculate_total_correction_error(
+                fill_state.pre_fill_pressure,
+                fill_state.pre_fill_temp,
+                fill_state.post_fill_pressure,
+                fill_state.post_fill_temp,
+            )
+        )
+        mass_corrected = fill_state.mass_uncorrected - total_error
+        vent_abs_unc, dv_abs_unc = self.uncertainty_tools.return_abs_error_data(
+            fill_state
+        )
+        (
+            tot_rel_temp,
+            tot_rel_pres,
+            tot_rel_ltd,
+            tot_rel_vent,
+            tot_rel_dv,
+            tot_rel_cfm,
+            tot_abs_cfm,
+            tot_abs_temp,
+            tot_abs_press,
+            tot_abs_ltd,
+        ) = self.uncertainty_tools.return_total_system_uncs(
+            mass_corrected, fill_state, dv_abs_unc, vent_abs_unc
+        )
+        total_relative_fill_unc_k = (
+            self.uncertainty_tools.calculate_total_system_rel_unc_k(
+                mass_corrected, fill_state, k
+            )
+        )
+        return {
+            "mass_uncorrected": fill_state.mass_uncorrected,
+            "mass_corrected": mass_corrected,
+            "total_error": total_error,
+            "vented_error": vented_error,
+            "dead_volume_error": dead_volume_error,
+            "vent_abs_unc": vent_abs_unc,
+            "dv_abs_unc": dv_abs_unc,
+            "total_relative_fill_unc_k": total_relative_fill_unc_k,
+            "tot_rel_temp": tot_rel_temp,
+            "tot_rel_pres": tot_rel_pres,
+            "tot_rel_ltd": tot_rel_ltd,
+            "tot_rel_vent": tot_rel_vent,
+            "tot_rel_dv": tot_rel_dv,
+            "tot_rel_cfm": tot_rel_cfm,
+            "tot_abs_cfm": tot_abs_cfm,
+            "tot_abs_temp": tot_abs_temp,
+            "tot_abs_press": tot_abs_press,
+            "tot_abs_ltd": tot_abs_ltd,
+        }
+
+    def evaluate_fills(self, fills, k, decimation_tolerance=None):
+        """
+        Evaluates many fillings in parallel, one filling per task.
+
+        Parameters:
+            - Fills: Iterable of (flowrates, temperatures, pressures) tuples, optionally
+              followed by the fill state and the timestamps [s] of the filling.
+            - k: Coverage factor
+            - Decimation tolerance: Optional tolerance of the decimation of timestamped
+              fillings [kg/min], see evaluate_samples().
+
+        Returns:
+            - List of (sample arrays, summary) tuples, in the order of the fillings.
+        """
+        evaluator = BatchEvaluator(
+            self.hrs_config,
+            max_workers=1,
+            chunk_size=self.chunk_size,
+            correlated_corrections=self.uncertainty_tools.correlated_corrections,
+        )
+
+        def evaluate(fill):
+            flowrates, temperatures, pressures = fill[:3]
+            fill_state = fill[3] if len(fill) > 3 else None
+            timestamps = fill[4] if len(fill) > 4 else None
+            return evaluator.evaluate_fill(
+                flowrates,
+                temperatures,
+                pressures,
+                k,
+                fill_state,
+                timestamps,
+                decimation_tolerance,
+            )
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(evaluate, fills))
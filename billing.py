@@ -0,0 +1,164 @@
+"""
+This module contains the BillingCalculator class, which converts the mass delivered by
+fillings into the units used for invoicing: the volume at standard conditions [Nm3] and
+the energy by the superior calorific value [kWh], each with its expanded uncertainty.
+
+The standard volume is Qv0 = Z0 * R * T0 / (M * p0) * qm, with the relative uncertainty
+sqrt((u(qm) / qm)^2 + (u(Z0/M) / (Z0/M))^2), as in
+UncertaintyTools.calculate_std_vol_flowrate_unc(). The uncertainty of the superior
+calorific value is negligible, so the energy has the relative uncertainty of the mass.
+The series of every filling are calculated for all samples at once, and totaled per
+filling by NumPy.
+
+Classes:
+    BillingCalculator
+"""
+import numpy as np
+
+from uncertainty_tools import UncertaintyTools
+
+
+class BillingCalculator:
+    """
+    This class calculates the standard volume and energy series of fillings, and their
+    totals per filling, from the sample arrays and summaries of the uncertainty pipeline.
+    """
+
+    def __init__(self, uncertainty_tools: UncertaintyTools):
+        """
+        Parameters:
+            - uncertainty_tools: The UncertaintyTools of the station, giving the flow
+              properties and the standard uncertainty of Z0/M.
+        """
+        self.flow_properties = uncertainty_tools.flow_properties
+        # Standard volume per mass [m3/kg]
+        self.std_volume_factor = self.flow_properties.calculate_std_vol_flowrate(1.0)
+        # The factor is taken as the standard uncertainty of Z0/M [mol/kg]
+        z0_m = self.flow_properties.gas_compressibility_z0 / self.flow_properties.molar_mass_m
+        self.rel_z0_m_unc = uncertainty_tools.std_uncertainty_zo_m_factor / z0_m
+
+    def calculate_sample_arrays(self, flowrates, abs_total):
+        """
+        Converts the mass flowrates of the samples to standard volume and energy
+        flowrates, with their standard uncertainties. Samples without flow are given zero
+        uncertainty.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - abs_total: Array of the absolute standard uncertainty of the flowrates,
+              as returned by calculate_sample_arrays() [kg/min]
+
+        Returns:
+            - Dictionary of arrays: std_volume_flowrate, abs_std_volume [Nm3/min],
+              energy_flowrate and abs_energy [kWh/min].
+        """
+        flowrates = np.asarray(flowrates, dtype=float)
+        abs_total = np.asarray(abs_total, dtype=float)
+        std_volume_flowrates = self.flow_properties.calculate_std_vol_flowrate(flowrates)
+        # sqrt((u(qm) / qm)^2 + (u(z) / z)^2) * Qv0, without dividing by the flowrate.
+        abs_std_volume = np.sqrt(
+            np.square(self.std_volume_factor * abs_total)
+            + np.square(std_volume_flowrates * self.rel_z0_m_unc)
+        )
+        abs_energy = self.flow_properties.calculate_energy_flowrate(abs_total)
+        return {
+            "std_volume_flowrate": std_volume_flowrates,
+            "abs_std_volume": np.where(flowrates != 0, abs_std_volume, 0.0),
+            "energy_flowrate": self.flow_properties.calculate_energy_flowrate(flowrates),
+            "abs_energy": np.where(flowrates != 0, abs_energy, 0.0),
+        }
+
+    def calculate_fill_totals(
+        self, flowrates, abs_total, fill_starts, summaries, k, durations=None
+    ):
+        """
+        Totals the billing quantities of many fillings in one pass. The measured series
+        are totaled as the mass and tot_abs_total of the fill state, and the billed
+        quantities are converted from the corrected mass, whose standard uncertainty
+        combines the totaled meter uncertainty with the vent and dead volume
+        uncertainties, as in calculate_total_system_rel_unc_k().
+
+        Parameters:
+            - Flowrates: Array of the flowrates of every filling, one after another [kg/min]
+            - abs_total: Array of the absolute standard uncertainty of the flowrates [kg/min]
+            - Fill starts: Index of the first sample of each filling, in increasing
+              order. A filling without samples starts at the start of the next one.
+            - Summaries: List of the summary of each filling, as returned by
+              BatchEvaluator.evaluate_fill()
+            - k: Coverage factor
+            - Durations: Optional array of the duration each sample is counted for [min].
+              Defaults to one second per sample.
+
+        Returns:
+            - Dictionary of arrays, one value per filling:
+                - "measured_std_volume", "measured_energy": Totals of the measured series
+                  [Nm3, kWh]
+                - "mass_corrected", "mass_unc_k": Billed mass and its expanded
+                  uncertainty [kg]
+                - "std_volume", "std_volume_unc_k": Billed standard volume [Nm3]
+                - "energy", "energy_unc_k": Billed energy [kWh]
+        """
+        flowrates = np.asarray(flowrates, dtype=float)
+        if durations is None:
+            durations = np.full(flowrates.shape, 1 / 60)
+        durations = np.where(flowrates != 0, durations, 0.0)
+        fill_starts = np.asarray(fill_starts, dtype=np.intp)
+        fill_lengths = np.diff(np.append(fill_starts, len(flowrates)))
+        sample_arrays = self.calculate_sample_arrays(flowrates, abs_total)
+        weighted = np.vstack(
+            (
+                sample_arrays["std_volume_flowrate"],
+                sample_arrays["energy_flowrate"],
+                abs_total,
+            )
+        ) * durations
+        # reduceat() returns the sample at the start of a filling without samples, and
+        # cannot start at the end of the array, so a zero column is appended and the
+        # empty fillings are set to zero.
+        weighted = np.hstack((weighted, np.zeros((len(weighted), 1))))
+        totals = np.where(
+            fill_lengths == 0, 0.0, np.add.reduceat(weighted, fill_starts, axis=1)
+        )
+
+        mass_corrected = np.array([summary["mass_corrected"] for summary in summaries])
+        correction_variance = np.array(
+            [summary["vent_abs_unc"] ** 2 + summary["dv_abs_unc"] ** 2 for summary in summaries]
+        )
+        mass_unc = np.sqrt(np.square(totals[2]) + correction_variance)
+        std_volume = self.flow_properties.calculate_std_vol_flowrate(mass_corrected)
+        std_volume_unc = np.sqrt(
+            np.square(self.std_volume_factor * mass_unc)
+            + np.square(std_volume * self.rel_z0_m_unc)
+        )
+        return {
+            "measured_std_volume": totals[0],
+            "measured_energy": totals[1],
+            "mass_corrected": mass_corrected,
+            "mass_unc_k": k * mass_unc,
+            "std_volume": std_volume,
+            "std_volume_unc_k": k * std_volume_unc,
+            "energy": self.flow_properties.calculate_energy_flowrate(mass_corrected),
+            "energy_unc_k": k * self.flow_properties.calculate_energy_flowrate(mass_unc),
+        }
+
+    def bill_fills(self, flowrates, results, k):
+        """
+        Totals the billing quantities of fillings evaluated by
+        BatchEvaluator.evaluate_fills(). See calculate_fill_totals().
+
+        Parameters:
+            - Flowrates: List of the flowrate arrays of the fillings [kg/min]
+            - Results: List of (sample arrays, summary), in the order of the fillings.
+            - k: Coverage factor
+
+        Returns:
+            - Dictionary of arrays, one value per filling.
+        """
+        lengths = [len(fill_flowrates) for fill_flowrates in flowrates]
+        return self.calculate_fill_totals(
+            np.concatenate(flowrates),
+            np.concatenate([sample_arrays["abs_total"] for sample_arrays, _ in results]),
+            np.cumsum([0] + lengths[:-1]),
+            [summary for _, summary in results],
+            k,
+        )
@@ -6,6 +6,7 @@ tables containing different types of data.
 import os
 import pandas as pd
 from hrs_config import HRSConfiguration
+from instrumentation import timed
 
 
 class CollectData:
@@ -14,7 +15,7 @@ class CollectData:
     the program and the user. It directly stores data into objects created outside this module.
     """
 
-    def __init__(self, hrs_configs: HRSConfiguration):
+    def __init__(self, hrs_configs: HRSConfiguration, file_path=None):
         # pylint: disable = W1401
         """
         Creating an instance of the CollectData class requires the hrs_configuration
@@ -23,7 +24,8 @@ class CollectData:
 
         Parameters:
             - hrs_config: An instance of the HRS configuration class
-            - filepath: The path to the Excel template.
+            - file_path: The path to the Excel template. Defaults to the template in the
+              excel_template folder.
 
         Tips:
             To easily find the correct filepath, find the template in its folder,
@@ -32,7 +34,7 @@ class CollectData:
             "C:/Path/To/Your/Master_project_sheet.xlsx"
         """
         self.hrs_config = hrs_configs
-        self.file_path = self.get_filepath()
+        self.file_path = file_path if file_path is not None else self.get_filepath()
 
         self.config_sheet = "HRS_config"
         self.calibration_sheet = "Calibration_uncertainty"
@@ -54,12 +56,13 @@ class CollectData:
 
     def get_filepath(self):
         """
-        Returns the 
+        Returns the path to the Excel template in the excel_template folder.
         """
         program_dir = os.path.dirname(os.path.abspath(__file__))
-        dynamic_filepath = os.path.join(program_dir, "excel_template", "configurationtemplate.xlsx")
+        dynamic_filepath = os.path.join(program_dir, "excel_template", "ConfigurationTemplate.xlsx")
         return dynamic_filepath
 
+    @timed("collect_data.read_file")
     def read_file(self):
         """
         Reads an excel file, through the path given defined in __init__.
@@ -275,6 +278,7 @@ class CollectData:
         else:
             self.hrs_config.temperature_contribution = 0
 
-hrs_config = HRSConfiguration()
-data_reader = CollectData(hrs_config)
-#print(vars(hrs_config))
+if __name__ == "__main__":
+    hrs_config = HRSConfiguration()
+    data_reader = CollectData(hrs_config)
+    #print(vars(hrs_config))
@@ -0,0 +1,268 @@
+"""
+This module contains the ColumnarExporter class, which writes the per sample breakdown
+and the summary of evaluated fillings to Parquet or Arrow IPC files, for analysis by
+other tools. The tables are built directly on the NumPy result arrays, which Arrow
+references without copying.
+
+The files are organized as datasets partitioned by station and date, in folders named
+station=<station id>/date=<YYYY-MM-DD>, which Arrow, pandas, DuckDB and Spark read as
+partition columns. Every write adds a new file to its partitions, so fillings can be
+appended to the datasets while they are being read. The optional pyarrow package is
+required.
+
+Classes:
+    ColumnarExporter
+"""
+import os
+import tempfile
+import uuid
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+PYARROW_AVAILABLE = pa is not None
+
+# Input series stored along the sample arrays, with their units.
+INPUT_SERIES = ("flowrate", "temperature", "pressure")
+
+
+class ColumnarExporter:
+    """
+    This class appends evaluated fillings to two datasets below a root directory: the
+    samples dataset, with one row per sample, and the fills dataset, with one row per
+    filling.
+    """
+
+    formats = {"parquet": ".parquet", "arrow": ".arrow"}
+
+    def __init__(self, directory, file_format="parquet"):
+        """
+        Parameters:
+            - directory: Root directory of the datasets, created if missing.
+            - file_format: "parquet", or "arrow" for Arrow IPC files.
+        """
+        if not PYARROW_AVAILABLE:
+            raise ImportError("The pyarrow package is required for the columnar export.")
+        if file_format not in self.formats:
+            raise ValueError(f"Unknown file format: {file_format}")
+        self.directory = directory
+        self.file_format = file_format
+        os.makedirs(directory, exist_ok=True)
+
+    def get_partition_path(self, dataset, station_id, fill_time):
+        """
+        Returns the directory of the partition of a station and date.
+
+        Parameters:
+            - dataset: "samples" or "fills".
+            - station_id: Identifier of the station.
+            - fill_time: Start time of the filling, as a datetime.
+        """
+        return os.path.join(
+            self.directory,
+            dataset,
+            f"station={station_id}",
+            f"date={fill_time.date().isoformat()}",
+        )
+
+    def make_sample_table(self, fill_id, inputs, sample_arrays, timestamps=None):
+        """
+        Creates the table of the samples of a filling. The numeric columns reference the
+        NumPy arrays without copying them, when they are contiguous float64 arrays.
+
+        Parameters:
+            - fill_id: Identifier of the filling.
+            - inputs: Dictionary with the flowrate [kg/min], temperature [C] and pressure
+              [bar] arrays of the samples.
+            - sample_arrays: Dictionary of arrays, as returned by calculate_sample_arrays()
+            - timestamps: Optional array of sample times [s]
+
+        Returns:
+            - Arrow table.
+        """
+        sample_count = len(inputs["flowrate"])
+        columns = {
+            "fill_id": pa.DictionaryArray.from_arrays(
+                np.zeros(sample_count, dtype=np.int32), [str(fill_id)]
+            ),
+            "sample": pa.array(np.arange(sample_count, dtype=np.int64)),
+        }
+        if timestamps is not None:
+            columns["time_s"] = pa.array(np.ascontiguousarray(timestamps, dtype=float))
+        for name in INPUT_SERIES:
+            columns[name] = pa.array(np.ascontiguousarray(inputs[name], dtype=float))
+        for name, values in sample_arrays.items():
+            columns[name] = pa.array(np.ascontiguousarray(values, dtype=float))
+        return pa.table(columns)
+
+    def make_fill_table(self, fill_records):
+        """
+        Creates the table of the summaries of fillings, with one row per filling.
+
+        Parameters:
+            - fill_records: List of (fill id, fill time, summary dictionary)
+
+        Returns:
+            - Arrow table.
+        """
+        names = []
+        for _, _, summary in fill_records:
+            names.extend(name for name in summary if name not in names)
+        columns = {
+            "fill_id": pa.array([str(fill_id) for fill_id, _, _ in fill_records]),
+            "fill_time": pa.array(
+                [fill_time for _, fill_time, _ in fill_records], type=pa.timestamp("us")
+            ),
+        }
+        for name in names:
+            columns[name] = pa.array(
+                [summary.get(name) for _, _, summary in fill_records], type=pa.float64()
+            )
+        return pa.table(columns)
+
+    def write_table(self, table, directory):
+        """
+        Writes a table as a new file of a partition. The file is written to a temporary
+        name and moved into place, so readers never see a partially written file.
+
+        Parameters:
+            - table: Arrow table.
+            - directory: Directory of the partition.
+
+        Returns:
+            - Path of the file.
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, f"part-{uuid.uuid4().hex}{self.formats[self.file_format]}"
+        )
+        # Files starting with a dot are skipped by the dataset readers.
+        handle, temporary_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        os.close(handle)
+        try:
+            if self.file_format == "parquet":
+                pq.write_table(table, temporary_path)
+            else:
+                with pa.OSFile(temporary_path, "wb") as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        return path
+
+    def write_fills(self, station_id, fills):
+        """
+        Appends fillings of a station to the datasets, writing one samples file and one
+        fills file per date.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - fills: List of (fill id, fill time, inputs, sample arrays, summary,
+              timestamps), where inputs is the dictionary of make_sample_table(), and
+              sample arrays and summary are returned by BatchEvaluator.evaluate_fill().
+              The timestamps may be None.
+
+        Returns:
+            - List of the paths written.
+        """
+        by_date = {}
+        for fill in fills:
+            by_date.setdefault(fill[1].date(), []).append(fill)
+        paths = []
+        for date_fills in by_date.values():
+            fill_time = date_fills[0][1]
+            samples = pa.concat_tables(
+                [
+                    self.make_sample_table(fill_id, inputs, sample_arrays, timestamps)
+                    for fill_id, _, inputs, sample_arrays, _, timestamps in date_fills
+                ],
+                promote_options="default",
+            ).unify_dictionaries()
+            summaries = self.make_fill_table(
+                [(fill_id, time, summary) for fill_id, time, _, _, summary, _ in date_fills]
+            )
+            paths.append(
+                self.write_table(
+                    samples, self.get_partition_path("samples", station_id, fill_time)
+                )
+            )
+            paths.append(
+                self.write_table(
+                    summaries, self.get_partition_path("fills", station_id, fill_time)
+                )
+            )
+        return paths
+
+    def write_fill(
+        self, station_id, fill_id, fill_time, inputs, sample_arrays, summary, timestamps=None
+    ):
+        """
+        Appends a single filling to the datasets. See write_fills().
+
+        Returns:
+            - List of the paths written.
+        """
+        return self.write_fills(
+            station_id, [(fill_id, fill_time, inputs, sample_arrays, summary, timestamps)]
+        )
+
+    def open_dataset(self, dataset):
+        """
+        Opens a dataset for querying, with the station and date as partition columns.
+        The schema is unified over every file, so columns written only by some
+        appends, such as time_s of timestamped fillings or a new summary value, are
+        read as nulls from the other files instead of being dropped.
+
+        Parameters:
+            - dataset: "samples" or "fills".
+
+        Returns:
+            - pyarrow.dataset.Dataset
+        """
+        partitioning = ds.partitioning(
+            pa.schema([("station", pa.string()), ("date", pa.string())]), flavor="hive"
+        )
+        files = ds.dataset(
+            os.path.join(self.directory, dataset),
+            format="parquet" if self.file_format == "parquet" else "ipc",
+            partitioning=partitioning,
+        )
+        schema = pa.unify_schemas(
+            [files.schema]
+            + [fragment.physical_schema for fragment in files.get_fragments()],
+            promote_options="permissive",
+        )
+        return files.replace_schema(schema)
+
+    def read_fills(self, dataset="fills", station_id=None, start_date=None, end_date=None):
+        """
+        Reads the rows of a dataset, reading only the partitions of the given station and
+        dates.
+
+        Parameters:
+            - dataset: "samples" or "fills".
+            - station_id: Optional identifier of the station.
+            - start_date, end_date: Optional first and last date, as datetime.date.
+
+        Returns:
+            - Arrow table.
+        """
+        conditions = []
+        if station_id is not None:
+            conditions.append(ds.field("station") == str(station_id))
+        if start_date is not None:
+            conditions.append(ds.field("date") >= start_date.isoformat())
+        if end_date is not None:
+            conditions.append(ds.field("date") <= end_date.isoformat())
+        condition = None
+        for expression in conditions:
+            condition = expression if condition is None else condition & expression
+        return self.open_dataset(dataset).to_table(filter=condition)
@@ -0,0 +1,339 @@
+"""
+This module reloads the configuration workbook of a long running process, such as a
+service evaluating the fillings of a station, without restarting it. A background thread
+polls the modification time and size of the workbook, and when the workbook has been
+saved and left unchanged for one poll, reads it into a new HRS configuration, validates
+it, and freezes it. The new version then replaces the current version by a single
+assignment, so the samples are processed without pause while the workbook is read.
+
+A filling keeps the version it started with, by taking the version once through
+get_version() and evaluating every sample with its evaluator, so fillings in progress
+finish on the old configuration. A workbook which cannot be read, or fails validation,
+is reported and the current version is kept.
+
+Objects derived from the configuration, such as the tables of MeterCurves, are
+registered as caches with the values they depend on. A new version rebuilds only the
+caches whose values changed, and shares the others with the previous version.
+
+Classes:
+    ConfigurationVersion
+    ConfigurationWatcher
+Functions:
+    validate_configuration: Returns the problems of an HRS configuration.
+"""
+import math
+import numbers
+import os
+import threading
+
+from hrs_config import HRSConfiguration
+from batch_evaluator import BatchEvaluator
+from station_registry import load_configuration
+
+# Values of the configuration used by MeterCurves.
+METER_CURVE_VALUES = (
+    "flowrates_kg_min",
+    "multiple_calibration_repeatability_bool",
+    "calibration_repeatability_std",
+    "multiple_field_repeatability_bool",
+    "field_repeatability_std",
+)
+
+
+def is_number(value, minimum=-math.inf):
+    """Returns whether a value is a finite number, and not below the minimum."""
+    return (
+        isinstance(value, numbers.Real)
+        and not isinstance(value, bool)
+        and math.isfinite(value)
+        and value >= minimum
+    )
+
+
+def validate_configuration(hrs_config: HRSConfiguration):
+    """
+    Checks that a configuration can be evaluated: the calibration flowrates are
+    increasing, every curve has a value per flowrate, and the uncertainties, volumes and
+    contributions are finite numbers.
+
+    Parameters:
+        - hrs_config: The HRS configuration.
+
+    Returns:
+        - List of the problems found, empty for a valid configuration.
+    """
+    problems = []
+    flowrates = hrs_config.flowrates_kg_min
+    if not flowrates or not all(is_number(flowrate, 0) for flowrate in flowrates):
+        problems.append("The calibration flowrates must be positive numbers.")
+        flowrates = None
+    elif any(low >= high for low, high in zip(flowrates, flowrates[1:])):
+        problems.append("The calibration flowrates must be increasing.")
+
+    for name, multiple_bool, uncertainty in (
+        (
+            "calibration_deviation_std",
+            hrs_config.multiple_calibration_deviation_bool,
+            hrs_config.get_calibration_deviation(),
+        ),
+        (
+            "calibraiton_reference_std",
+            hrs_config.multiple_calibration_reference_bool,
+            hrs_config.get_calibration_reference(),
+        ),
+        (
+            "calibration_repeatability_std",
+            hrs_config.multiple_calibration_repeatability_bool,
+            hrs_config.get_calibration_repeatability(),
+        ),
+        (
+            "field_repeatability_std",
+            hrs_config.multiple_field_repeatability_bool,
+            hrs_config.get_field_repeatability(),
+        ),
+        (
+            "field_condition_std",
+            hrs_config.multiple_field_condition_bool,
+            hrs_config.get_field_condition(),
+        ),
+    ):
+        if not multiple_bool:
+            if not is_number(uncertainty, 0):
+                problems.append(f"{name} must be a number, not below zero.")
+        elif not all(is_number(value, 0) for value in uncertainty):
+            problems.append(f"Every value of {name} must be a number, not below zero.")
+        elif flowrates is not None and len(uncertainty) != len(flowrates):
+            problems.append(f"{name} must have a value per calibration flowrate.")
+
+    for name, minimum in (
+        ("dead_volume", 0),
+        ("depressurization_vent_volume", 0),
+        ("dead_volume_uncertainty", 0),
+        ("depressurization_vent_volume_uncertainty", 0),
+        ("pressure_sensor_uncertainty", 0),
+        ("pressure_contribution", -math.inf),
+        ("temperature_contribution", 0),
+        ("annual_deviation", 0),
+        ("years_since_calibration", 0),
+    ):
+        if not is_number(getattr(hrs_config, name), minimum):
+            problems.append(f"{name} must be a number, not below {minimum}.")
+    return problems
+
+
+class ConfigurationVersion:
+    """
+    This class holds one version of the configuration: the frozen HRS configuration,
+    the evaluator built on it, and the registered caches.
+    """
+
+    def __init__(self, number, hrs_config: HRSConfiguration, signature, changes):
+        """
+        Parameters:
+            - number: Number of the version, starting from 1.
+            - hrs_config: The frozen HRS configuration.
+            - signature: Modification time [ns] and size of the workbook when read.
+            - changes: Names of the values changed from the previous version.
+        """
+        self.number = number
+        self.hrs_config = hrs_config
+        self.signature = signature
+        self.changes = changes
+        self.evaluator = BatchEvaluator(hrs_config, max_workers=1)
+        self.caches = {}
+
+    def get_cache(self, name):
+        """Returns a registered cache, built for this version or shared with earlier ones."""
+        return self.caches[name]
+
+
+class ConfigurationWatcher:
+    """
+    This class serves the current version of the configuration of a workbook, and
+    reloads it in a background thread when the workbook changes. Every method may be
+    called from multiple threads.
+    """
+
+    def __init__(self, file_path=None, interval=1.0, on_reload=None, on_error=None):
+        """
+        The workbook is read when the watcher is created, raising a ValueError when the
+        configuration is not valid. The polling is started by start().
+
+        Parameters:
+            - file_path: The path to the Excel workbook. Defaults to the template in the
+              excel_template folder.
+            - interval: Time between the polls of the workbook [s]
+            - on_reload: Optional function called with each new ConfigurationVersion.
+            - on_error: Optional function called with the exception raised by a
+              workbook which could not be loaded.
+        """
+        if file_path is None:
+            file_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "excel_template",
+                "ConfigurationTemplate.xlsx",
+            )
+        self.file_path = file_path
+        self.interval = interval
+        self.on_reload = on_reload
+        self.on_error = on_error
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        # Name: (function building the cache from an evaluator, names of the values)
+        self.cache_factories = {}
+        self.pending_signature = None
+        self.failed_signature = None
+        self.last_error = None
+        self.version = None
+        self.reload()
+
+    def get_signature(self):
+        """Returns the modification time [ns] and the size of the workbook."""
+        status = os.stat(self.file_path)
+        return status.st_mtime_ns, status.st_size
+
+    def get_version(self):
+        """
+        Returns the current ConfigurationVersion. A filling should take the version once,
+        and use it for all of its samples.
+        """
+        return self.version
+
+    def get_evaluator(self):
+        """Returns the BatchEvaluator of the current version."""
+        return self.version.evaluator
+
+    def register_cache(self, name, factory, dependencies=None):
+        """
+        Registers an object derived from the configuration, built for the current
+        version and rebuilt by new versions where any value it depends on changed.
+
+        Parameters:
+            - name: Name of the cache, given to ConfigurationVersion.get_cache().
+            - factory: Function building the cache from the BatchEvaluator of a version,
+              such as lambda evaluator: MeterCurves(evaluator.uncertainty_tools).
+            - dependencies: Names of the values of HRSConfiguration used by the cache,
+              such as METER_CURVE_VALUES. Defaults to every value.
+        """
+        with self.lock:
+            if dependencies is not None:
+                dependencies = frozenset(dependencies)
+            self.cache_factories[name] = (factory, dependencies)
+            self.version.caches[name] = factory(self.version.evaluator)
+
+    def load(self, signature, previous=None):
+        """
+        Reads, validates and freezes the configuration of the workbook, and builds the
+        caches which depend on values changed from the previous version.
+
+        Parameters:
+            - signature: Signature of the workbook, taken before it was read.
+            - previous: The previous ConfigurationVersion, or None.
+
+        Returns:
+            - The new ConfigurationVersion.
+        """
+        hrs_config = load_configuration(self.file_path)
+        problems = validate_configuration(hrs_config)
+        if problems:
+            raise ValueError(
+                f"Invalid configuration in {self.file_path}: " + " ".join(problems)
+            )
+        hrs_config.freeze()
+        if previous is None:
+            changes = frozenset(hrs_config.get_values())
+            number = 1
+        else:
+            changes = hrs_config.get_changes(previous.hrs_config)
+            number = previous.number + 1
+        version = ConfigurationVersion(number, hrs_config, signature, changes)
+        for name, (factory, dependencies) in self.cache_factories.items():
+            if previous is not None and dependencies is not None and not (
+                dependencies & changes
+            ):
+                version.caches[name] = previous.caches[name]
+            else:
+                version.caches[name] = factory(version.evaluator)
+        return version
+
+    def reload(self):
+        """
+        Reads the workbook and replaces the current version, raising the error of a
+        workbook which cannot be loaded. The current version is kept when the values of
+        the workbook are unchanged.
+
+        Returns:
+            - The current ConfigurationVersion.
+        """
+        with self.lock:
+            signature = self.get_signature()
+            previous = self.version
+            version = self.load(signature, previous)
+            if previous is not None and not version.changes:
+                previous.signature = signature
+                return previous
+            self.version = version
+        if self.on_reload is not None:
+            self.on_reload(version)
+        return version
+
+    def check(self):
+        """
+        Polls the workbook once, reloading it when it has changed and has been left
+        unchanged since the previous poll, so a workbook being written is not read. A
+        workbook which fails to load is reported, and tried again when it changes.
+
+        Returns:
+            - Whether a new version was loaded.
+        """
+        signature = self.get_signature()
+        pending = self.pending_signature
+        self.pending_signature = signature
+        if (
+            signature == self.version.signature
+            or signature == self.failed_signature
+            or signature != pending
+        ):
+            return False
+        previous = self.version
+        try:
+            version = self.reload()
+        except Exception as error:  # pylint: disable = W0718
+            self.failed_signature = signature
+            self.last_error = error
+            if self.on_error is not None:
+                self.on_error(error)
+            return False
+        self.last_error = None
+        return version is not previous
+
+    def run(self):
+        """Polls the workbook until stop() is called. Run by the background thread."""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.check()
+            except OSError as error:
+                # The workbook may be missing while it is replaced.
+                self.last_error = error
+
+    def start(self):
+        """Starts polling the workbook in a background thread."""
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops polling, and waits for the background thread to finish."""
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -10,6 +10,7 @@ Classes:
 
 from hrs_config import HRSConfiguration
 from flow_calculations import FlowProperties
+from instrumentation import timed
 
 
 class Correction:
@@ -21,12 +22,6 @@ class Correction:
         self.hrs_config = hrs_config
         self.flow_properties = FlowProperties()
 
-        # Pipe variables
-        self.pre_fill_pressure = 35000000  #Pa TODO: pascal
-        self.pre_fill_temp = 233.15  # Kelvin
-        self.post_fill_pressure = None
-        self.post_fill_temp = None
-
     def calculate_vented_mass_error(self, volume_vent, density):
         """
         Calculates the mass of hydrogen lost due to depressurization of the dispenser hose.
@@ -54,6 +49,7 @@ class Correction:
         dead_volume_mass =  volume * (current_density - previous_density)
         return dead_volume_mass
 
+    @timed("correction.total_correction_error")
     def calculate_total_correction_error(self, pre_press,pre_temp, post_press, post_temp,):
         """
         Calculates the total correction error from dead volume and depressurized vent.
@@ -0,0 +1,253 @@
+"""
+This module contains the PlotDownsampler class, which reduces long sample series to a
+few thousand points before they are plotted. A screen cannot show more points than it
+has pixels, so plotting every sample of a multi-hour filling logged at 10 Hz only makes
+the rendering slow and the saved figures large. The methods keep the peaks of the
+series, so the reduced plots look the same as the full ones.
+
+Classes:
+    PlotDownsampler
+    IncrementalLTTB
+Functions:
+    select_largest_triangle: Returns the sample of a bucket kept by LTTB.
+"""
+import numpy as np
+
+
+def select_largest_triangle(x_values, y_values, start, end, previous, next_x, next_y):
+    """
+    Returns the sample of a bucket forming the largest triangle with the previously kept
+    sample and the average of the next bucket.
+
+    Parameters:
+        - X values, Y values: Arrays of the samples.
+        - Start, end: The samples of the bucket, as a slice.
+        - Previous: Index of the previously kept sample.
+        - Next x, next y: Average of the next bucket.
+
+    Returns:
+        - Index of the kept sample.
+    """
+    x_window = x_values[start:end]
+    y_window = y_values[start:end]
+    # Twice the area of the triangles, the constant factor does not matter.
+    areas = np.abs(
+        (x_values[previous] - next_x) * (y_window - y_values[previous])
+        - (x_values[previous] - x_window) * (next_y - y_values[previous])
+    )
+    return start + int(np.argmax(areas))
+
+
+class PlotDownsampler:
+    """
+    This class selects the samples to plot, either by Largest-Triangle-Three-Buckets
+    (LTTB) for series plotted in sample order, or by the minimum and maximum per bucket
+    of the x-axis for series plotted against another variable.
+    """
+
+    def __init__(self, max_points=2000):
+        """
+        Parameters:
+            - max_points: The largest number of points plotted per series.
+        """
+        if max_points < 3:
+            raise ValueError("At least 3 points are required.")
+        self.max_points = max_points
+
+    def lttb(self, x_values, y_values, max_points=None):
+        """
+        Selects the samples to plot by Largest-Triangle-Three-Buckets. The first and last
+        samples are kept, and the remaining samples are split into buckets in sample
+        order. From each bucket, the sample forming the largest triangle with the
+        previously kept sample and the average of the next bucket is kept, which keeps
+        the peaks of the series.
+
+        Parameters:
+            - X values: Array of x-values, such as the time [s]
+            - Y values: Array of y-values.
+            - Max points: Number of points kept, defaulting to max_points.
+
+        Returns:
+            - Array of the indices of the kept samples, in increasing order.
+        """
+        if max_points is None:
+            max_points = self.max_points
+        x_values = np.asarray(x_values, dtype=float)
+        y_values = np.asarray(y_values, dtype=float)
+        sample_count = len(y_values)
+        if sample_count <= max_points:
+            return np.arange(sample_count)
+
+        edges = np.linspace(1, sample_count - 1, max_points - 1).astype(int)
+        starts = edges[:-1]
+        ends = edges[1:]
+        # Average of each bucket, and of the last sample as the bucket after the last.
+        counts = ends - starts
+        x_sums = np.add.reduceat(x_values[: sample_count - 1], starts)
+        y_sums = np.add.reduceat(y_values[: sample_count - 1], starts)
+        x_averages = np.append(x_sums / counts, x_values[-1])
+        y_averages = np.append(y_sums / counts, y_values[-1])
+
+        indices = np.empty(max_points, dtype=int)
+        indices[0] = 0
+        indices[-1] = sample_count - 1
+        previous = 0
+        for bucket, (start, end) in enumerate(zip(starts, ends)):
+            previous = select_largest_triangle(
+                x_values,
+                y_values,
+                start,
+                end,
+                previous,
+                x_averages[bucket + 1],
+                y_averages[bucket + 1],
+            )
+            indices[bucket + 1] = previous
+        return indices
+
+    def min_max(self, x_values, y_values, max_points=None):
+        """
+        Selects the samples to plot against an x-axis which is not in sample order, such
+        as the flowrate. The x-axis is split into max_points / 2 buckets of equal width,
+        and the samples with the smallest and largest y-value of each bucket are kept.
+        The kept samples are returned in order of their buckets, so they can be drawn as
+        a line without sorting every sample.
+
+        Parameters:
+            - X values: Array of x-values, such as the flowrate [kg/min]
+            - Y values: Array of y-values.
+            - Max points: Number of points kept, defaulting to max_points.
+
+        Returns:
+            - Array of the indices of the kept samples, ordered by x-value.
+        """
+        if max_points is None:
+            max_points = self.max_points
+        x_values = np.asarray(x_values, dtype=float)
+        y_values = np.asarray(y_values, dtype=float)
+        sample_count = len(y_values)
+        if sample_count == 0:
+            return np.arange(0)
+        bucket_count = max(max_points // 2, 1)
+        x_min = np.min(x_values)
+        width = (np.max(x_values) - x_min) / bucket_count
+        if width == 0:
+            buckets = np.zeros(sample_count, dtype=int)
+        else:
+            buckets = np.minimum(
+                ((x_values - x_min) / width).astype(int), bucket_count - 1
+            )
+
+        y_min = np.full(bucket_count, np.inf)
+        y_max = np.full(bucket_count, -np.inf)
+        np.minimum.at(y_min, buckets, y_values)
+        np.maximum.at(y_max, buckets, y_values)
+        # The first sample reaching the smallest and largest y-value of each bucket.
+        samples = np.arange(sample_count)
+        min_index = np.full(bucket_count, sample_count)
+        max_index = np.full(bucket_count, sample_count)
+        is_min = y_values == y_min[buckets]
+        is_max = y_values == y_max[buckets]
+        np.minimum.at(min_index, buckets[is_min], samples[is_min])
+        np.minimum.at(max_index, buckets[is_max], samples[is_max])
+
+        used = min_index < sample_count
+        pairs = np.stack((min_index[used], max_index[used]), axis=-1)
+        # Order each pair by x-value, so the line moves forward within the bucket.
+        swap = x_values[pairs[:, 0]] > x_values[pairs[:, 1]]
+        pairs[swap] = pairs[swap][:, ::-1]
+        indices = pairs.ravel()
+        # Buckets where the same sample holds both extremes keep it once.
+        keep = np.ones(len(indices), dtype=bool)
+        keep[1::2] = pairs[:, 0] != pairs[:, 1]
+        return indices[keep]
+
+
+class IncrementalLTTB:
+    """
+    This class selects the samples to plot by Largest-Triangle-Three-Buckets for a series
+    which grows while it is plotted, such as a live filling. The buckets hold a fixed
+    number of samples, and a bucket is kept once the bucket after it is complete, since
+    its selection then no longer changes. Only the last buckets are selected again for
+    each frame, so the cost of a frame does not grow with the length of the series.
+
+    When the series outgrows max_points, the number of samples per bucket is doubled,
+    and the kept buckets are selected again once. The total cost is therefore linear in
+    the number of samples.
+    """
+
+    def __init__(self, max_points=2000):
+        """
+        Parameters:
+            - max_points: The largest number of points plotted per series.
+        """
+        if max_points < 3:
+            raise ValueError("At least 3 points are required.")
+        self.max_points = max_points
+        self.bucket_size = 1
+        self.kept = []
+
+    def get_bucket_average(self, x_values, y_values, start, end):
+        """Returns the average of the samples of a bucket, given as a slice."""
+        return np.mean(x_values[start:end]), np.mean(y_values[start:end])
+
+    def update(self, x_values, y_values):
+        """
+        Selects the samples to plot, after samples are appended to the series. The
+        arrays must hold every sample of the series so far, in the same order as for
+        the previous call.
+
+        Parameters:
+            - X values: Array of x-values, such as the time [s]
+            - Y values: Array of y-values.
+
+        Returns:
+            - Array of the indices of the kept samples, in increasing order.
+        """
+        sample_count = len(y_values)
+        if sample_count <= self.max_points:
+            return np.arange(sample_count)
+
+        # The first and last samples are kept, and the samples between them are split
+        # into buckets of bucket_size samples.
+        inner_count = sample_count - 2
+        bucket_limit = self.max_points - 2
+        if -(-inner_count // self.bucket_size) > bucket_limit:
+            while -(-inner_count // self.bucket_size) > bucket_limit:
+                self.bucket_size *= 2
+            self.kept = []
+        size = self.bucket_size
+        previous = self.kept[-1] if self.kept else 0
+
+        # A bucket is kept once the bucket after it is complete.
+        complete_count = inner_count // size
+        while len(self.kept) < complete_count - 1:
+            start = 1 + len(self.kept) * size
+            next_x, next_y = self.get_bucket_average(
+                x_values, y_values, start + size, start + 2 * size
+            )
+            previous = select_largest_triangle(
+                x_values, y_values, start, start + size, previous, next_x, next_y
+            )
+            self.kept.append(previous)
+
+        # The remaining buckets are selected again for each frame, the last one against
+        # the last sample.
+        indices = [0] + self.kept
+        last = sample_count - 1
+        start = 1 + len(self.kept) * size
+        while start < last:
+            end = min(start + size, last)
+            if end < last:
+                next_x, next_y = self.get_bucket_average(
+                    x_values, y_values, end, min(end + size, last)
+                )
+            else:
+                next_x, next_y = x_values[last], y_values[last]
+            previous = select_largest_triangle(
+                x_values, y_values, start, end, previous, next_x, next_y
+            )
+            indices.append(previous)
+            start = end
+        indices.append(last)
+        return np.array(indices)
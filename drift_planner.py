@@ -0,0 +1,259 @@
+"""
+This module contains the RecalibrationPlanner class, which projects the expanded
+uncertainty of fillings forward in time as the meters drift away from their calibration,
+and reports the date each meter exceeds a target uncertainty.
+
+The long term drift is the only contribution which changes with time, growing with
+annual_deviation * years since calibration. The remaining contributions of every sample
+of a representative mix of fillings are therefore calculated once per meter, and the
+projection is evaluated for every meter, time step and filling at once as NumPy arrays.
+
+Classes:
+    RecalibrationPlanner
+"""
+import datetime
+import numpy as np
+
+from hrs_config import HRSConfiguration
+from fill_state import FillState
+from correction import Correction
+from uncertainty_tools import UncertaintyTools
+from simulate_hrs import GenerateFlowData
+from instrumentation import timed
+
+DAYS_PER_YEAR = 365.25
+
+
+class RecalibrationPlanner:
+    """
+    This class projects the total expanded uncertainty of a mix of fillings for a number
+    of meters, each given by the HRS configuration of its station and the date it was
+    last calibrated.
+    """
+
+    def __init__(
+        self, k, target, criterion="max", max_elements=2**22, correlated_corrections=False
+    ):
+        """
+        Parameters:
+            - k: Coverage factor.
+            - target: Largest allowed relative expanded uncertainty, in the unit of
+              total_relative_fill_unc_k.
+            - criterion: "max" to compare the worst filling of the mix to the target, or
+              "mean" to compare the weighted mean of the mix.
+            - max_elements: Largest number of array elements evaluated at once, bounding
+              the memory used.
+            - correlated_corrections: Whether the uncertainty of the vent and dead volume
+              corrections is propagated with their correlation, as described by
+              UncertaintyTools.calculate_correction_uncertainty().
+        """
+        if criterion not in ("max", "mean"):
+            raise ValueError(f"Unknown criterion: {criterion}")
+        self.k = k
+        self.target = target
+        self.criterion = criterion
+        self.max_elements = max_elements
+        self.correlated_corrections = correlated_corrections
+        self.fills = []
+        self.fill_weights = []
+
+    def add_fill(self, flowrates, temperatures, pressures, weight=1.0, timestamps=None):
+        """
+        Adds a filling to the representative mix.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - Weight: Relative frequency of the filling in the mix.
+            - Timestamps: Optional array of sample times [s]. Without timestamps, each
+              sample lasts one second.
+        """
+        self.fills.append(
+            (
+                np.asarray(flowrates, dtype=float),
+                np.asarray(temperatures, dtype=float),
+                np.asarray(pressures, dtype=float),
+                None if timestamps is None else np.asarray(timestamps, dtype=float),
+            )
+        )
+        self.fill_weights.append(weight)
+
+    def add_simulated_fills(self, tank_sizes_kg, weights=None):
+        """
+        Adds simulated fillings of the given tank sizes to the representative mix.
+
+        Parameters:
+            - Tank sizes kg: List of the masses delivered [kg]
+            - Weights: Optional list of the relative frequency of each size.
+        """
+        simulator = GenerateFlowData()
+        if weights is None:
+            weights = [1.0] * len(tank_sizes_kg)
+        for tank_size, weight in zip(tank_sizes_kg, weights):
+            flowrates, pressures, temperatures = (
+                simulator.generate_filling_protocol_kg_sec(tank_size)
+            )
+            self.add_fill(np.asarray(flowrates) * 60, temperatures, pressures, weight)
+
+    def prepare_meter(self, hrs_config: HRSConfiguration, sample_weights):
+        """
+        Calculates the parts of the projection which do not change with time, for one
+        meter and every filling of the mix.
+
+        Parameters:
+            - hrs_config: The HRS configuration of the meter.
+            - sample_weights: List of the arrays returned by get_sample_weights().
+
+        Returns:
+            - Base variance: Array of the variance of each sample, without the long
+              term drift [kg2/min2]
+            - Masses: Array of the corrected mass of each filling [kg]
+            - Correction variances: Array of the squared uncertainty of the vent and
+              dead volume corrections of each filling [kg2]
+        """
+        correction = Correction(hrs_config)
+        uncertainty_tools = UncertaintyTools(
+            hrs_config, correction, self.correlated_corrections
+        )
+        base_variances = []
+        masses = []
+        correction_variances = []
+        for (flowrates, temperatures, pressures, _), weights in zip(
+            self.fills, sample_weights
+        ):
+            fill_state = FillState()
+            components = uncertainty_tools.calculate_component_arrays(
+                flowrates, temperatures, pressures, fill_state
+            )
+            variance = np.zeros(flowrates.shape)
+            for name, values in components.items():
+                if name != "annual":
+                    variance += np.square(values)
+            base_variances.append(variance)
+
+            fill_state.set_post_fill_conditions(
+                float(pressures[-1]) * 100000, float(temperatures[-1]) + 273.15
+            )
+            total_error, _, _ = correction.calculate_total_correction_error(
+                fill_state.pre_fill_pressure,
+                fill_state.pre_fill_temp,
+                fill_state.post_fill_pressure,
+                fill_state.post_fill_temp,
+            )
+            masses.append(float(np.dot(flowrates, weights)) - total_error)
+            correction_variances.append(
+                uncertainty_tools.calculate_correction_uncertainty(fill_state) ** 2
+            )
+        return (
+            np.concatenate(base_variances),
+            np.array(masses),
+            np.array(correction_variances),
+        )
+
+    def get_sample_weights(self):
+        """
+        Returns the duration each sample of each filling is counted for [min], with zero
+        for samples without flow, as in calculate_total_abs_unc_std().
+        """
+        weights = []
+        for flowrates, _, _, timestamps in self.fills:
+            if timestamps is None:
+                sample_weights = np.full(len(flowrates), 1 / 60)
+            else:
+                # Trapezoidal rule, each interval split between its two samples.
+                durations = np.diff(timestamps) / 60
+                sample_weights = np.zeros(len(flowrates))
+                sample_weights[:-1] += durations / 2
+                sample_weights[1:] += durations / 2
+            weights.append(np.where(flowrates != 0, sample_weights, 0.0))
+        return weights
+
+    @timed("drift_planner.project")
+    def project(self, meters, start_date, end_date, step_days=30):
+        """
+        Projects the relative expanded uncertainty of every filling of the mix, for
+        every meter and time step.
+
+        Parameters:
+            - meters: List of (meter id, HRS configuration, calibration date). The drift
+              rate of each meter is the annual_deviation of its configuration [%/year]
+            - start_date, end_date: First and last date of the projection.
+            - step_days: Days between the time steps.
+
+        Returns:
+            - Dictionary with:
+                - "meter_ids": List of the meter ids.
+                - "dates": List of the dates of the time steps.
+                - "uncertainty": Array of relative expanded uncertainties, with the
+                  shape (meters, time steps, fillings)
+                - "worst": Array of the largest uncertainty of the mix (meters, time steps)
+                - "mean": Array of the weighted mean uncertainty of the mix.
+                - "exceedance_dates": Dictionary of meter id: first date where the
+                  criterion exceeds the target, or None within the projection.
+        """
+        if not self.fills:
+            raise ValueError("Add fillings to the representative mix first.")
+        dates = [
+            start_date + datetime.timedelta(days=days)
+            for days in range(0, (end_date - start_date).days + 1, step_days)
+        ]
+        sample_weights = self.get_sample_weights()
+        weights = np.concatenate(sample_weights)
+        squared_flowrates = np.square(np.concatenate([fill[0] for fill in self.fills]))
+        fill_starts = np.cumsum([0] + [len(fill[0]) for fill in self.fills[:-1]])
+
+        prepared = [
+            self.prepare_meter(hrs_config, sample_weights) for _, hrs_config, _ in meters
+        ]
+        base_variances = np.stack([values[0] for values in prepared])
+        masses = np.stack([values[1] for values in prepared])
+        correction_variances = np.stack([values[2] for values in prepared])
+
+        # Relative long term drift of each meter at each time step [%]
+        day_numbers = np.array([date.toordinal() for date in dates], dtype=float)
+        calibration_days = np.array(
+            [calibration_date.toordinal() for _, _, calibration_date in meters], dtype=float
+        )
+        years = (
+            np.maximum(day_numbers[None, :] - calibration_days[:, None], 0) / DAYS_PER_YEAR
+        )
+        drift_rates = np.array(
+            [hrs_config.annual_deviation or 0.0 for _, hrs_config, _ in meters], dtype=float
+        )
+        squared_drift = np.square(drift_rates[:, None] * years / 100)
+
+        # Totaled absolute uncertainty of each filling, evaluated in blocks of meters.
+        meter_count, step_count = squared_drift.shape
+        totals = np.empty((meter_count, step_count, len(self.fills)))
+        block = max(1, self.max_elements // (step_count * len(weights)))
+        for start in range(0, meter_count, block):
+            end = min(start + block, meter_count)
+            sample_totals = np.sqrt(
+                base_variances[start:end, None, :]
+                + squared_flowrates * squared_drift[start:end, :, None]
+            )
+            sample_totals *= weights
+            totals[start:end] = np.add.reduceat(sample_totals, fill_starts, axis=-1)
+
+        uncertainty = self.k * np.sqrt(
+            (np.square(totals) + correction_variances[:, None, :])
+            / np.square(masses[:, None, :])
+        )
+        fill_weights = np.asarray(self.fill_weights, dtype=float)
+        worst = np.max(uncertainty, axis=-1)
+        mean = uncertainty @ (fill_weights / np.sum(fill_weights))
+
+        exceeded = (worst if self.criterion == "max" else mean) > self.target
+        exceedance_dates = {}
+        for (meter_id, _, _), meter_exceeded in zip(meters, exceeded):
+            step = int(np.argmax(meter_exceeded))
+            exceedance_dates[meter_id] = dates[step] if meter_exceeded[step] else None
+        return {
+            "meter_ids": [meter_id for meter_id, _, _ in meters],
+            "dates": dates,
+            "uncertainty": uncertainty,
+            "worst": worst,
+            "mean": mean,
+            "exceedance_dates": exceedance_dates,
+        }
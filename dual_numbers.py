@@ -0,0 +1,222 @@
+"""
+This module contains a small forward mode automatic differentiation layer, based on dual
+numbers holding NumPy arrays. Running the density and correction formulas of
+FlowProperties and Correction on dual numbers gives their partial derivatives, so the
+sensitivity coefficients do not have to be derived by hand when the models change.
+
+Classes:
+    Dual
+    CorrectionSensitivity
+"""
+import numpy as np
+from hrs_config import HRSConfiguration
+from correction import Correction
+
+
+class Dual:
+    """
+    A dual number, holding a value and its gradient with respect to a number of inputs.
+    The value has the shape of the batch, and the gradient has an additional last axis
+    with one element per input.
+    """
+
+    __array_priority__ = 100
+
+    def __init__(self, value, gradient):
+        """
+        Parameters:
+            - value: Array of values.
+            - gradient: Array of partial derivatives, with the inputs along the last axis.
+        """
+        self.value = np.asarray(value, dtype=float)
+        self.gradient = np.asarray(gradient, dtype=float)
+
+    @staticmethod
+    def variables(*values):
+        """
+        Creates a dual number per input, seeded with a unit gradient for that input.
+
+        Parameters:
+            - *values: Arrays or floats of the inputs, broadcast to a common shape.
+
+        Returns:
+            - List of Dual numbers.
+        """
+        arrays = np.broadcast_arrays(*[np.asarray(value, dtype=float) for value in values])
+        count = len(arrays)
+        variables = []
+        for index, array in enumerate(arrays):
+            gradient = np.zeros(array.shape + (count,))
+            gradient[..., index] = 1
+            variables.append(Dual(array, gradient))
+        return variables
+
+    def split(self, other):
+        """Returns the value and gradient of other, as a dual number or a constant."""
+        if isinstance(other, Dual):
+            return other.value, other.gradient
+        return np.asarray(other, dtype=float), 0.0
+
+    def __add__(self, other):
+        value, gradient = self.split(other)
+        return Dual(self.value + value, self.gradient + gradient)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        value, gradient = self.split(other)
+        return Dual(self.value - value, self.gradient - gradient)
+
+    def __rsub__(self, other):
+        value, gradient = self.split(other)
+        return Dual(value - self.value, gradient - self.gradient)
+
+    def __neg__(self):
+        return Dual(-self.value, -self.gradient)
+
+    def __mul__(self, other):
+        value, gradient = self.split(other)
+        return Dual(
+            self.value * value,
+            self.gradient * value[..., None] + self.value[..., None] * gradient,
+        )
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        value, gradient = self.split(other)
+        quotient = self.value / value
+        return Dual(
+            quotient,
+            (self.gradient - quotient[..., None] * gradient) / value[..., None],
+        )
+
+    def __rtruediv__(self, other):
+        value, gradient = self.split(other)
+        quotient = value / self.value
+        return Dual(
+            quotient,
+            (gradient - quotient[..., None] * self.gradient) / self.value[..., None],
+        )
+
+    def __pow__(self, exponent):
+        if isinstance(exponent, Dual):
+            raise TypeError("Only constant exponents are supported.")
+        return Dual(
+            self.value**exponent,
+            exponent * self.value[..., None] ** (exponent - 1) * self.gradient,
+        )
+
+
+class CorrectionSensitivity:
+    """
+    This class calculates the corrected mass of fillings, and its Jacobian with respect
+    to the inputs of the dead volume and vent corrections, by running Correction on
+    dual numbers. The inputs are, in order: pre-fill pressure p1, pre-fill temperature T1,
+    post-fill pressure p2, post-fill temperature T2, dead volume V_dv and vent volume V_vv.
+    """
+
+    inputs = ("p1", "T1", "p2", "T2", "V_dv", "V_vv")
+
+    def __init__(self, hrs_config: HRSConfiguration, correction: Correction):
+        self.hrs_config = hrs_config
+        self.correction = correction
+
+    def calculate_corrected_mass(
+        self,
+        measured_mass,
+        pre_press,
+        pre_temp,
+        post_press,
+        post_temp,
+        volume_dv=None,
+        volume_vv=None,
+    ):
+        """
+        Calculates the corrected mass and its Jacobian for a batch of fillings.
+
+        Parameters:
+            - Measured mass: Mass measured by the CFM [kg]
+            - Pre-fill-pressure, post-fill-pressure: Pressures [Pa]
+            - Pre-fill-temperature, post-fill-temperature: Temperatures [K]
+            - Volume dv, volume vv: Dead volume and vent volume [m3], defaulting to the
+              volumes of the HRS configuration.
+
+        Returns:
+            - Corrected mass [kg]
+            - Jacobian: Array with the derivatives with respect to each input along the
+              last axis [kg/Pa, kg/K, kg/Pa, kg/K, kg/m3, kg/m3]
+        """
+        if volume_dv is None:
+            volume_dv = self.hrs_config.get_dead_volume()
+        if volume_vv is None:
+            volume_vv = self.hrs_config.get_depressurization_vent_volume()
+        p_1, t_1, p_2, t_2, v_dv, v_vv = Dual.variables(
+            pre_press, pre_temp, post_press, post_temp, volume_dv, volume_vv
+        )
+        density = self.correction.flow_properties.calculate_hydrogen_density
+        prev_density = density(p_1, t_1)
+        curr_density = density(p_2, t_2)
+        dv_mass_error = self.correction.calculate_dead_volume_mass_error(
+            prev_density, curr_density, v_dv
+        )
+        vented_mass = self.correction.calculate_vented_mass_error(v_vv, curr_density)
+        corrected = (dv_mass_error + vented_mass) * -1 + measured_mass
+        return corrected.value, corrected.gradient
+
+    def get_input_uncertainties(self, pre_press, pre_temp, post_press, post_temp):
+        """
+        Returns the standard uncertainty of each input, from the sensor and volume
+        uncertainties of the HRS configuration.
+
+        Returns:
+            - Array with the uncertainties along the last axis [Pa, K, Pa, K, m3, m3]
+        """
+        config = self.hrs_config
+        dead_volume_unc = (
+            config.get_dead_volume_uncertainty() if config.correct_for_dead_volume_bool else 0
+        )
+        vent_volume_unc = (
+            config.get_depressurization_vent_volume_unc()
+            if config.correct_for_depress_bool
+            else 0
+        )
+        arrays = np.broadcast_arrays(
+            config.get_pressure_uncertainty(np.asarray(pre_press, dtype=float)),
+            config.get_temperature_uncertainty(np.asarray(pre_temp, dtype=float)),
+            config.get_pressure_uncertainty(np.asarray(post_press, dtype=float)),
+            config.get_temperature_uncertainty(np.asarray(post_temp, dtype=float)),
+            np.asarray(dead_volume_unc, dtype=float),
+            np.asarray(vent_volume_unc, dtype=float),
+        )
+        return np.stack(arrays, axis=-1)
+
+    def calculate_correction_abs_unc(
+        self,
+        measured_mass,
+        pre_press,
+        pre_temp,
+        post_press,
+        post_temp,
+        volume_dv=None,
+        volume_vv=None,
+    ):
+        """
+        Calculates the uncertainty of the corrected mass due to the corrections, by
+        propagating the input uncertainties through the Jacobian. Since the dead volume
+        and the vent share the post-fill conditions, their contributions are combined
+        before squaring, instead of being added in quadrature.
+
+        Returns:
+            - Corrected mass [kg]
+            - Absolute standard uncertainty of the corrections [kg]
+            - Contributions: Sensitivity times uncertainty for each input [kg]
+        """
+        corrected, jacobian = self.calculate_corrected_mass(
+            measured_mass, pre_press, pre_temp, post_press, post_temp, volume_dv, volume_vv
+        )
+        contributions = jacobian * self.get_input_uncertainties(
+            pre_press, pre_temp, post_press, post_temp
+        )
+        uncertainty = np.sqrt(np.sum(np.square(contributions), axis=-1))
+        return corrected, uncertainty, contributions
@@ -0,0 +1,278 @@
+"""
+This module contains the ExcelResultWriter class, which writes the results of evaluated
+fillings to an Excel workbook for the operators. The workbook mirrors
+ConfigurationTemplate.xlsx: it starts with copies of the sheets of the template the
+results were calculated with, followed by a sheet of fill summaries and optionally sheets
+of the per sample breakdown, laid out as the tables of the template.
+
+The workbook is written by the write-only mode of openpyxl, which streams every row to
+disk as it is appended, so a month of fillings is written in constant memory. A sheet
+holds at most 1048576 rows, so the samples continue on Samples_2, Samples_3 and so on,
+and the summaries on Fill_summaries_2 and so on.
+
+Classes:
+    ExcelResultWriter
+"""
+import math
+import os
+import numpy as np
+from openpyxl import Workbook, load_workbook
+
+from sample_archive import SAMPLE_SERIES
+
+MAX_ROWS = 1048576
+
+# Keys of the fill summaries, and their column headers.
+SUMMARY_COLUMNS = (
+    ("k", "Coverage factor k"),
+    ("mass_uncorrected", "Mass uncorrected [kg]"),
+    ("mass_corrected", "Mass corrected [kg]"),
+    ("total_error", "Total correction [kg]"),
+    ("vented_error", "Vented mass [kg]"),
+    ("dead_volume_error", "Dead volume mass [kg]"),
+    ("total_relative_fill_unc_k", "Expanded relative uncertainty (k) [-]"),
+    ("tot_abs_cfm", "CFM uncertainty [kg]"),
+    ("tot_abs_temp", "Temperature uncertainty [kg]"),
+    ("tot_abs_press", "Pressure uncertainty [kg]"),
+    ("tot_abs_ltd", "Long term drift uncertainty [kg]"),
+    ("vent_abs_unc", "Vent uncertainty [kg]"),
+    ("dv_abs_unc", "Dead volume uncertainty [kg]"),
+    ("tot_rel_cfm", "CFM share [%]"),
+    ("tot_rel_temp", "Temperature share [%]"),
+    ("tot_rel_pres", "Pressure share [%]"),
+    ("tot_rel_ltd", "Long term drift share [%]"),
+    ("tot_rel_vent", "Vent share [%]"),
+    ("tot_rel_dv", "Dead volume share [%]"),
+)
+
+# Inputs and series of the samples, and their column headers.
+SAMPLE_COLUMNS = (
+    ("flowrate", "Flowrate [kg/min]"),
+    ("temperature", "Temperature [C]"),
+    ("pressure", "Pressure [bar]"),
+) + tuple(
+    (name, f"{name} [{'%' if name.startswith(('rel', 'comb')) else 'kg/min'}]")
+    for name in SAMPLE_SERIES
+)
+
+
+def get_cell_value(value):
+    """Returns a value Excel can store, with NaN and infinity as empty cells."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+class ExcelResultWriter:
+    """
+    This class appends fill summaries, and optionally their samples, to a new workbook.
+    The workbook is saved by close(), or at the end of a with block.
+    """
+
+    def __init__(self, path, template_path=None, include_samples=False, k=None):
+        """
+        Parameters:
+            - path: Path of the workbook written.
+            - template_path: The configuration workbook copied to the first sheets.
+              Defaults to the template in the excel_template folder.
+            - include_samples: Whether to write the per sample sheets.
+            - k: Coverage factor of the fillings, for summaries which do not hold their
+              own, such as those returned by BatchEvaluator.evaluate_fill().
+        """
+        self.path = path
+        self.include_samples = include_samples
+        self.k = k
+        self.workbook = Workbook(write_only=True)
+        if template_path is None:
+            template_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "excel_template",
+                "ConfigurationTemplate.xlsx",
+            )
+        self.copy_template(template_path)
+
+        self.summary_sheet = None
+        self.summary_sheet_count = 0
+        self.summary_rows = 0
+        self.get_summary_sheet()
+        self.sample_sheet = None
+        self.sample_sheet_count = 0
+        self.sample_rows = 0
+
+    def copy_template(self, template_path):
+        """
+        Copies the values of every sheet of the configuration workbook, row by row, so the
+        workbook is read by CollectData as the configuration it was calculated with.
+        """
+        template = load_workbook(template_path, read_only=True, data_only=True)
+        try:
+            for source in template.worksheets:
+                sheet = self.workbook.create_sheet(source.title)
+                for row in source.iter_rows(values_only=True):
+                    sheet.append(row)
+        finally:
+            template.close()
+
+    def create_table(self, title, note, headers, coverage="k=1"):
+        """
+        Creates a sheet laid out as the tables of the template, with the coverage factor
+        and a note in the first row, and the headers in the second row starting from
+        column B.
+
+        Returns:
+            - The write-only sheet.
+        """
+        sheet = self.workbook.create_sheet(title)
+        sheet.column_dimensions["B"].width = 20
+        sheet.append([coverage, note])
+        sheet.append([None] + list(headers))
+        return sheet
+
+    def get_summary_sheet(self):
+        """
+        Returns the summary sheet with room for a row, starting a new sheet when the
+        current sheet is full.
+        """
+        if self.summary_sheet is None or self.summary_rows + 1 > MAX_ROWS:
+            self.summary_sheet_count += 1
+            title = "Fill_summaries"
+            if self.summary_sheet_count > 1:
+                title = f"Fill_summaries_{self.summary_sheet_count}"
+            self.summary_sheet = self.create_table(
+                title,
+                "# One row per filling, uncertainties in kg given as standard"
+                " uncertainties, the relative uncertainty expanded by the coverage factor"
+                " k of the row",
+                ["Station", "Fill ID", "Fill time"]
+                + [header for _, header in SUMMARY_COLUMNS],
+                coverage=None,
+            )
+            self.summary_rows = 2
+        return self.summary_sheet
+
+    def get_sample_sheet(self, row_count):
+        """
+        Returns the sample sheet with room for the given number of rows, starting a new
+        sheet when the current sheet is full. The comb_rel_k and rel_cfm_k columns are
+        expanded by the coverage factor of the writer, or of the summary of each filling
+        when the writer has none.
+        """
+        if self.sample_sheet is None or self.sample_rows + row_count > MAX_ROWS:
+            self.sample_sheet_count += 1
+            title = "Samples"
+            if self.sample_sheet_count > 1:
+                title = f"Samples_{self.sample_sheet_count}"
+            if self.k is None:
+                coverage = None
+                expansion = "the coverage factor k of the filling on Fill_summaries"
+            else:
+                coverage = f"k={self.k:g}"
+                expansion = f"k={self.k:g}"
+            self.sample_sheet = self.create_table(
+                title,
+                "# One row per sample, uncertainties in kg/min given as standard"
+                f" uncertainties, comb_rel_k and rel_cfm_k expanded by {expansion}",
+                ["Station", "Fill ID", "Sample", "Time [s]"]
+                + [header for _, header in SAMPLE_COLUMNS],
+                coverage=coverage,
+            )
+            self.sample_rows = 2
+        return self.sample_sheet
+
+    def write_summary(self, station_id, fill_id, fill_time, summary):
+        """
+        Appends the summary of a filling.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - fill_id: Identifier of the filling.
+            - fill_time: Start time of the filling, as a datetime.
+            - summary: Dictionary returned by BatchEvaluator.evaluate_fill(). The
+              coverage factor is taken from the key "k", or else from the writer.
+        """
+        if summary.get("k") is None:
+            if self.k is None:
+                raise ValueError(
+                    f"The coverage factor of filling {fill_id} is not given: pass k to "
+                    "the ExcelResultWriter, or store it in the summary."
+                )
+            summary = dict(summary, k=self.k)
+        self.get_summary_sheet().append(
+            [None, str(station_id), str(fill_id), fill_time]
+            + [get_cell_value(summary.get(key)) for key, _ in SUMMARY_COLUMNS]
+        )
+        self.summary_rows += 1
+
+    def write_samples(self, station_id, fill_id, inputs, sample_arrays, timestamps=None):
+        """
+        Appends the samples of a filling, one row per sample.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - fill_id: Identifier of the filling.
+            - inputs: Dictionary with the flowrate [kg/min], temperature [C] and pressure
+              [bar] arrays of the samples.
+            - sample_arrays: Dictionary of arrays, as returned by calculate_sample_arrays()
+            - timestamps: Optional array of sample times [s]
+        """
+        series = [
+            np.asarray(
+                inputs[name] if name in inputs else sample_arrays[name], dtype=float
+            ).tolist()
+            for name, _ in SAMPLE_COLUMNS
+        ]
+        sample_count = len(series[0])
+        times = (
+            [None] * sample_count
+            if timestamps is None
+            else np.asarray(timestamps, dtype=float).tolist()
+        )
+        station_id = str(station_id)
+        fill_id = str(fill_id)
+        start = 0
+        while start < sample_count:
+            sheet = self.get_sample_sheet(1)
+            end = min(sample_count, start + MAX_ROWS - self.sample_rows)
+            for index in range(start, end):
+                sheet.append(
+                    [None, station_id, fill_id, index, get_cell_value(times[index])]
+                    + [get_cell_value(values[index]) for values in series]
+                )
+            self.sample_rows += end - start
+            start = end
+
+    def write_fills(self, station_id, fills):
+        """
+        Appends fillings of a station.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - fills: List of (fill id, fill time, inputs, sample arrays, summary,
+              timestamps), as taken by ColumnarExporter.write_fills(). The inputs,
+              sample arrays and timestamps may be None when the samples are not written.
+        """
+        for fill_id, fill_time, inputs, sample_arrays, summary, timestamps in fills:
+            self.write_summary(station_id, fill_id, fill_time, summary)
+            if self.include_samples and sample_arrays is not None:
+                self.write_samples(station_id, fill_id, inputs, sample_arrays, timestamps)
+
+    def write_fill(
+        self, station_id, fill_id, fill_time, inputs, sample_arrays, summary, timestamps=None
+    ):
+        """Appends a single filling. See write_fills()."""
+        self.write_fills(
+            station_id, [(fill_id, fill_time, inputs, sample_arrays, summary, timestamps)]
+        )
+
+    def close(self):
+        """Saves the workbook, written to a temporary file and moved into place."""
+        temporary_path = f"{self.path}.tmp"
+        self.workbook.save(temporary_path)
+        os.replace(temporary_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
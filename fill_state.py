@@ -0,0 +1,204 @@
+"""
+This module contains the FillState class, which stores the mutable state belonging to a
+single refueling. The HRS configuration is shared between fillings, while the fill state
+is created per filling, allowing multiple fillings to be evaluated against the same
+configuration.
+
+Classes:
+    FillState
+"""
+import numpy as np
+from time_integration import SampleIntegrator
+
+
+class FillState:
+    """
+    This class stores the state of one filling: the temperature of the previous sample,
+    the running totals of the uncertainties, and the pre- and post-fill conditions of
+    the dispenser.
+    """
+
+    __slots__ = (
+        "previous_temperature",
+        "mass_uncorrected",
+        "tot_abs_cfm",
+        "tot_abs_total",
+        "tot_abs_temp",
+        "tot_abs_press",
+        "tot_abs_ltd",
+        "pre_fill_pressure",
+        "pre_fill_temp",
+        "post_fill_pressure",
+        "post_fill_temp",
+        "previous_time",
+        "previous_rates",
+    )
+
+    def __init__(self, pre_fill_pressure=35000000, pre_fill_temp=233.15):
+        """
+        Creates an empty fill state.
+
+        Parameters:
+            - Pre-fill-pressure: Pressure in the dispenser from the previous filling [Pa]
+            - Pre-fill-temperature: Temperature in the dispenser from the previous filling [K]
+        """
+        # Calculation check
+        self.previous_temperature = None
+
+        # Running totals
+        self.mass_uncorrected = 0
+        self.tot_abs_cfm = 0
+        self.tot_abs_total = 0
+        self.tot_abs_temp = 0
+        self.tot_abs_press = 0
+        self.tot_abs_ltd = 0
+
+        # Dispenser conditions
+        self.pre_fill_pressure = pre_fill_pressure
+        self.pre_fill_temp = pre_fill_temp
+        self.post_fill_pressure = None
+        self.post_fill_temp = None
+
+        # Previous sample, for trapezoidal integration of timestamped samples
+        self.previous_time = None
+        self.previous_rates = None
+
+    def record_sample(
+        self,
+        flowrate,
+        temperature,
+        abs_cfm,
+        abs_total,
+        abs_temp,
+        abs_press,
+        abs_ltd,
+        formatting=1 / 60,
+        timestamp=None,
+    ):
+        """
+        Adds one sample to the running totals, and stores its temperature for the
+        temperature change check of the next sample. Without a timestamp, the sample is
+        counted for the given duration. With a timestamp, the interval since the previous
+        sample is integrated by the trapezoidal rule.
+
+        Parameters:
+            - Flowrate: Measured flowrate [kg/min]
+            - Temperature: Measured temperature [C]
+            - abs_cfm: Absolute CFM standard uncertainty [kg/min]
+            - abs_total: Absolute CFM + temp + press + annual standard uncertainty [kg/min]
+            - abs_temp: Absolute uncertainty from temperature effect [kg/min]
+            - abs_press: Absolute uncertainty from pressure effect [kg/min]
+            - abs_ltd: Absolute uncertainty from long term drift [kg/min]
+            - Formatting: Duration of the sample [min]
+            - Timestamp: Time of the sample [s]
+        """
+        if timestamp is not None:
+            rates = (flowrate, abs_cfm, abs_total, abs_temp, abs_press, abs_ltd)
+            if self.previous_time is not None:
+                duration = (timestamp - self.previous_time) / 60
+                self.add_totals(
+                    [
+                        (previous + current) / 2 * duration
+                        for previous, current in zip(self.previous_rates, rates)
+                    ]
+                )
+            self.previous_time = timestamp
+            self.previous_rates = rates
+            self.previous_temperature = temperature
+            return
+        self.mass_uncorrected += flowrate * formatting
+        self.tot_abs_cfm += abs_cfm * formatting
+        self.tot_abs_total += abs_total * formatting
+        self.tot_abs_temp += abs_temp * formatting
+        self.tot_abs_press += abs_press * formatting
+        self.tot_abs_ltd += abs_ltd * formatting
+        self.previous_temperature = temperature
+
+    def set_post_fill_conditions(self, pressure, temperature):
+        """
+        Stores the conditions at the end of the filling.
+
+        Parameters:
+            - Pressure: Pressure at the end of the filling [Pa]
+            - Temperature: Temperature at the end of the filling [K]
+        """
+        self.post_fill_pressure = pressure
+        self.post_fill_temp = temperature
+
+    def record_samples(
+        self, flowrates, temperatures, sample_arrays, formatting=1 / 60, timestamps=None
+    ):
+        """
+        Adds an array of samples to the running totals. The array version of
+        record_sample(), used with UncertaintyTools.calculate_sample_arrays().
+
+        Parameters:
+            - Flowrates: Array of measured flowrates [kg/min]
+            - Temperatures: Array of measured temperatures [C]
+            - Sample arrays: Dictionary returned by calculate_sample_arrays()
+            - Formatting: Duration of each sample [min]
+            - Timestamps: Array of sample times [s], integrated by the trapezoidal rule.
+        """
+        if len(flowrates) == 0:
+            return
+        if timestamps is not None:
+            rates = np.vstack(
+                (
+                    flowrates,
+                    sample_arrays["abs_cfm"],
+                    sample_arrays["abs_total"],
+                    sample_arrays["abs_temp"],
+                    sample_arrays["abs_pres"],
+                    sample_arrays["abs_ltd"],
+                )
+            )
+            timestamps = np.asarray(timestamps, dtype=float)
+            if self.previous_time is not None:
+                rates = np.hstack((np.reshape(self.previous_rates, (6, 1)), rates))
+                timestamps = np.concatenate(([self.previous_time], timestamps))
+            self.add_totals(SampleIntegrator().integrate_trapezoidal(rates, timestamps))
+            self.previous_time = float(timestamps[-1])
+            self.previous_rates = tuple(rates[:, -1])
+            self.previous_temperature = temperatures[-1]
+            return
+        self.mass_uncorrected += float(np.sum(flowrates)) * formatting
+        self.tot_abs_cfm += float(np.sum(sample_arrays["abs_cfm"])) * formatting
+        self.tot_abs_total += float(np.sum(sample_arrays["abs_total"])) * formatting
+        self.tot_abs_temp += float(np.sum(sample_arrays["abs_temp"])) * formatting
+        self.tot_abs_press += float(np.sum(sample_arrays["abs_pres"])) * formatting
+        self.tot_abs_ltd += float(np.sum(sample_arrays["abs_ltd"])) * formatting
+        self.previous_temperature = temperatures[-1]
+
+    def add_totals(self, totals):
+        """
+        Adds integrated values to the running totals.
+
+        Parameters:
+            - Totals: Mass, cfm, total, temperature, pressure and drift uncertainty [kg]
+        """
+        self.mass_uncorrected += float(totals[0])
+        self.tot_abs_cfm += float(totals[1])
+        self.tot_abs_total += float(totals[2])
+        self.tot_abs_temp += float(totals[3])
+        self.tot_abs_press += float(totals[4])
+        self.tot_abs_ltd += float(totals[5])
+
+    def merge(self, other):
+        """
+        Adds the running totals of a fill state describing the subsequent samples of
+        the same filling, such as a chunk evaluated in a separate thread.
+
+        Parameters:
+            - Other: The fill state of the subsequent samples.
+        """
+        self.mass_uncorrected += other.mass_uncorrected
+        self.tot_abs_cfm += other.tot_abs_cfm
+        self.tot_abs_total += other.tot_abs_total
+        self.tot_abs_temp += other.tot_abs_temp
+        self.tot_abs_press += other.tot_abs_press
+        self.tot_abs_ltd += other.tot_abs_ltd
+        if other.previous_temperature is not None:
+            self.previous_temperature = other.previous_temperature
+        if other.previous_time is not None:
+            self.previous_time = other.previous_time
+            self.previous_rates = other.previous_rates
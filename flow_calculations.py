@@ -28,8 +28,8 @@ class FlowProperties:
         self.molar_mass_m = 2.01568*(10**-3)  # (g/mol)*10^-3   ->   2.016×10−3 kg/mol.
         self.gas_compressibility_z0 = 1
         self.abs_std_temperature_t0 = 288.15  # K, = 15°C
-        self.abs_std_pressure_p0 = 1  # atm, = 101325Pa
-        self.superior_calorific_value = None
+        self.abs_std_pressure_p0 = 101325  # Pa, = 1 atm
+        self.superior_calorific_value = 39.41  # kWh/kg, = 141.8 MJ/kg
 
     def calculate_std_vol_flowrate(self, flowrate):
         """
@@ -64,7 +64,7 @@ class FlowProperties:
             self - h_sm: superior burn value 
             self - q_m: Flow rate
         Returns:
-            Calculated energy flowrate value []
+            Calculated energy flowrate value [kWh/min, for a flowrate in kg/min]
         """
         return self.superior_calorific_value * flowrate
 
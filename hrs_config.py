@@ -3,6 +3,7 @@ This module will create a configuration for the Hydrogen refueling station, allo
 versatile use of the program. The class hrs_config will take in decision by the operator
 through the Excel sheet.
 """
+import hashlib
 
 
 class HRSConfiguration:
@@ -11,6 +12,9 @@ class HRSConfiguration:
     addition to multiple "get" functions to allow for data retrieval.
     """
 
+    # Set by freeze(), after which the configuration cannot be changed.
+    frozen = False
+
     def __init__(self):
         """
         The class will store variables from the Excel sheet. The initial
@@ -51,9 +55,6 @@ class HRSConfiguration:
         self.pressure_sensor_uncertainty = None
         self.temperature_sensor_uncertainty = None
 
-        #Caclculation check
-        self.previous_temperature = None
-
     def convert_relative_to_absolute(self, uncertainty, reference):
         """
         Converts relative uncertainty to absolte uncertainty.
@@ -131,3 +132,63 @@ class HRSConfiguration:
         return self.convert_relative_to_absolute(
             self.pressure_sensor_uncertainty, temperature
         )
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError(
+                f"The configuration is frozen, and {name} cannot be changed."
+            )
+        super().__setattr__(name, value)
+
+    def __copy__(self):
+        """Returns an editable copy, also of a frozen configuration."""
+        duplicate = HRSConfiguration.__new__(HRSConfiguration)
+        duplicate.__dict__.update(self.get_values())
+        return duplicate
+
+    def freeze(self):
+        """
+        Makes the configuration immutable, so it can be shared by every thread of a
+        long running process while a new configuration is loaded. The curves are stored
+        as tuples, and setting any value raises an AttributeError.
+
+        Returns:
+            - The configuration.
+        """
+        for name, value in vars(self).items():
+            if isinstance(value, list):
+                super().__setattr__(name, tuple(value))
+        super().__setattr__("frozen", True)
+        return self
+
+    def get_values(self):
+        """
+        Returns a dictionary of every value in the configuration, with the curves as
+        lists, equal for a configuration and its frozen version.
+        """
+        return {
+            name: list(value) if isinstance(value, tuple) else value
+            for name, value in vars(self).items()
+            if name != "frozen"
+        }
+
+    def get_changes(self, other):
+        """
+        Returns the names of the values which differ from another configuration, such as
+        the curves changed by a new version of the workbook.
+        """
+        values = self.get_values()
+        other_values = other.get_values()
+        return frozenset(
+            name
+            for name in values.keys() | other_values.keys()
+            if repr(values.get(name)) != repr(other_values.get(name))
+        )
+
+    def fingerprint(self):
+        """
+        Returns a hash of every value in the configuration, which changes whenever the
+        configuration changes. Used as part of the key of cached results.
+        """
+        values = repr(sorted(self.get_values().items())).encode("utf-8")
+        return hashlib.sha256(values).hexdigest()
@@ -0,0 +1,202 @@
+"""
+This module records the wall time and number of calls of each stage of the program, such
+as reading the Excel file, generating the profile, evaluating the samples, correcting and
+plotting. The recording is turned off by default, and is turned on either by setting the
+environment variable HRS_PROFILE=1, or by the profiling() context manager. When turned
+off, a timed stage only costs a single check of a boolean.
+
+The results can be exported to JSON, or to a Chrome trace file which can be opened in
+chrome://tracing or https://ui.perfetto.dev. When HRS_PROFILE is set, the paths given by
+HRS_PROFILE_JSON and HRS_PROFILE_TRACE are written as the program exits.
+
+Classes:
+    Profiler
+Functions:
+    timed: Decorator recording each call of a function as a stage.
+    stage: Context manager recording a block of code as a stage.
+    profiling: Context manager turning the profiler on for a block of code.
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    This class stores the total wall time and number of calls per stage, in addition to
+    the individual calls as trace events.
+    """
+
+    def __init__(self, max_events=100000):
+        """
+        Parameters:
+            - max_events: The maximum number of trace events stored. The totals per
+              stage are recorded for every call, also after the limit is reached.
+        """
+        self.enabled = False
+        self.max_events = max_events
+        self.stages = {}
+        self.events = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, name, start, end):
+        """
+        Records a single call of a stage.
+
+        Parameters:
+            - name: Name of the stage.
+            - start: Start time, given by time.perf_counter() [s]
+            - end: End time, given by time.perf_counter() [s]
+        """
+        duration = end - start
+        with self.lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + duration)
+            if len(self.events) < self.max_events:
+                self.events.append(
+                    (name, start - self.origin, duration, threading.get_ident())
+                )
+
+    def reset(self):
+        """Removes every recorded stage and event."""
+        with self.lock:
+            self.stages = {}
+            self.events = []
+            self.origin = time.perf_counter()
+
+    def summary(self):
+        """
+        Returns the recorded stages, sorted with the most time consuming stage first.
+
+        Returns:
+            - Dictionary of stage name: calls, total and mean wall time [s].
+        """
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        return {
+            name: {"calls": calls, "total_s": total, "mean_s": total / calls}
+            for name, (calls, total) in stages
+        }
+
+    def export_json(self, path):
+        """
+        Writes the summary of the recorded stages to a JSON file.
+
+        Parameters:
+            - path: The path of the file.
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def export_chrome_trace(self, path):
+        """
+        Writes the recorded calls to a file in the Chrome trace event format.
+
+        Parameters:
+            - path: The path of the file.
+        """
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace_events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "pid": pid,
+                "tid": tid,
+            }
+            for name, start, duration, tid in events
+        ]
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+
+
+PROFILER = Profiler()
+PROFILER.enabled = os.environ.get("HRS_PROFILE", "0") not in ("", "0")
+
+
+def timed(name):
+    """
+    Decorator recording each call of the decorated function as the given stage.
+
+    Parameters:
+        - name: Name of the stage.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PROFILER.record(name, start, time.perf_counter())
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager recording the enclosed block of code as the given stage.
+
+    Parameters:
+        - name: Name of the stage.
+    """
+    if not PROFILER.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.record(name, start, time.perf_counter())
+
+
+@contextmanager
+def profiling(json_path=None, trace_path=None):
+    """
+    Context manager turning the profiler on for the enclosed block of code. The
+    previously recorded stages are removed when entering the block.
+
+    Parameters:
+        - json_path: Optional path of a JSON summary written when leaving the block.
+        - trace_path: Optional path of a Chrome trace written when leaving the block.
+
+    Returns:
+        - The profiler.
+    """
+    was_enabled = PROFILER.enabled
+    PROFILER.reset()
+    PROFILER.enabled = True
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.enabled = was_enabled
+        if json_path is not None:
+            PROFILER.export_json(json_path)
+        if trace_path is not None:
+            PROFILER.export_chrome_trace(trace_path)
+
+
+def export_at_exit():
+    """Writes the files given by HRS_PROFILE_JSON and HRS_PROFILE_TRACE."""
+    if os.environ.get("HRS_PROFILE_JSON"):
+        PROFILER.export_json(os.environ["HRS_PROFILE_JSON"])
+    if os.environ.get("HRS_PROFILE_TRACE"):
+        PROFILER.export_chrome_trace(os.environ["HRS_PROFILE_TRACE"])
+
+
+if PROFILER.enabled:
+    atexit.register(export_at_exit)
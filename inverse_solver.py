@@ -0,0 +1,350 @@
+"""
+This module contains the InverseSolver class, which answers the inverse questions of the
+program, such as the smallest filling meeting a target uncertainty, or the largest dead
+volume or vent volume allowed before the corrections dominate the uncertainty. Each
+question is solved by bisection, for a whole grid of the other parameters at once.
+
+The simulated fillings of GenerateFlowData are prefixes of each other, apart from the
+pressure ramp which is stretched to the length of the filling. The meter uncertainty of
+every sample is therefore calculated once, on a master filling of the largest size, and
+the corrections are calculated once per sample as coefficients per unit of volume, since
+the corrections and their uncertainties are proportional to the volumes.
+
+Classes:
+    InverseSolver
+"""
+import copy
+import numpy as np
+
+from hrs_config import HRSConfiguration
+from fill_state import FillState
+from correction import Correction
+from uncertainty_tools import UncertaintyTools
+from simulate_hrs import GenerateFlowData
+from instrumentation import timed
+
+
+class InverseSolver:
+    """
+    This class evaluates the relative expanded uncertainty of simulated fillings as an
+    array function of the number of samples, the volumes, the years since calibration and
+    the coverage factor, and inverts it by bisection.
+    """
+
+    def __init__(self, hrs_config: HRSConfiguration, max_fill_kg=20, max_elements=2**22):
+        """
+        Parameters:
+            - hrs_config: The HRS configuration.
+            - max_fill_kg: The size of the master filling, the largest fill solved for [kg]
+            - max_elements: Largest number of array elements evaluated at once, bounding
+              the memory used.
+        """
+        self.hrs_config = hrs_config
+        self.max_elements = max_elements
+        self.formatting = 1 / 60
+        self.final_pressure = 700
+        flowrates, _, temperatures = GenerateFlowData().generate_filling_protocol_kg_sec(
+            max_fill_kg
+        )
+        self.flowrates_kg_sec = np.asarray(flowrates, dtype=float)
+        self.flowrates = self.flowrates_kg_sec * 60
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.mass_delivered = np.cumsum(self.flowrates * self.formatting)
+        self.prepare_meter_curves()
+        self.prepare_correction_coefficients()
+
+    def prepare_meter_curves(self):
+        """
+        Calculates the variance of each sample of the master filling which does not
+        depend on the length of the filling: the meter components and the temperature
+        effect [kg2/min2]. The pressure effect and the long term drift are added when
+        evaluating, as they depend on the pressure ramp and on the years since calibration.
+        """
+        uncertainty_tools = UncertaintyTools(self.hrs_config, Correction(self.hrs_config))
+        components = uncertainty_tools.calculate_component_arrays(
+            self.flowrates, self.temperatures, np.zeros_like(self.flowrates), FillState()
+        )
+        self.base_variances = np.zeros_like(self.flowrates)
+        for name, values in components.items():
+            if name not in ("pressure", "annual"):
+                self.base_variances += np.square(values)
+
+    def prepare_correction_coefficients(self):
+        """
+        Calculates, for a filling ending at each sample of the master filling, the dead
+        volume and vent corrections and their uncertainties per unit of volume [kg/m3].
+        """
+        unit_config = copy.copy(self.hrs_config)
+        unit_config.dead_volume = 1
+        unit_config.depressurization_vent_volume = 1
+        correction = Correction(unit_config)
+        uncertainty_tools = UncertaintyTools(unit_config, correction)
+        fill_state = FillState()
+        sample_count = len(self.flowrates)
+        self.dead_volume_errors = np.zeros(sample_count)
+        self.vent_errors = np.zeros(sample_count)
+        self.dead_volume_uncs = np.zeros(sample_count)
+        self.vent_uncs = np.zeros(sample_count)
+        for index, temperature in enumerate(self.temperatures):
+            fill_state.set_post_fill_conditions(
+                self.final_pressure * 100000, float(temperature) + 273.15
+            )
+            _, self.vent_errors[index], self.dead_volume_errors[index] = (
+                correction.calculate_total_correction_error(
+                    fill_state.pre_fill_pressure,
+                    fill_state.pre_fill_temp,
+                    fill_state.post_fill_pressure,
+                    fill_state.post_fill_temp,
+                )
+            )
+            self.vent_uncs[index], self.dead_volume_uncs[index] = (
+                uncertainty_tools.return_abs_error_data(fill_state)
+            )
+
+    def get_sample_count(self, fill_kg):
+        """
+        Returns the number of samples of the simulated filling of a given size, as
+        generated by generate_filling_protocol_kg_sec().
+
+        Parameters:
+            - Fill kg: Array of the sizes of the fillings [kg]
+        """
+        cumulative = np.cumsum(self.flowrates_kg_sec)
+        counts = np.searchsorted(cumulative, np.asarray(fill_kg, dtype=float)) + 1
+        if np.any(counts > len(cumulative)):
+            raise ValueError("A filling is larger than the master filling.")
+        return counts
+
+    def calculate_meter_uncertainty(self, sample_counts, years):
+        """
+        Calculates the totaled absolute standard uncertainty of the meter, for fillings
+        of the given number of samples.
+
+        Parameters:
+            - Sample counts: Array of the number of samples of each filling, at least 2.
+            - Years: Array of the years since calibration.
+
+        Returns:
+            - Array of absolute standard uncertainties [kg]
+        """
+        sample_counts, years = np.broadcast_arrays(sample_counts, years)
+        shape = sample_counts.shape
+        sample_counts = sample_counts.ravel()
+        years = years.ravel().astype(float)
+        totals = np.empty(len(sample_counts))
+        length = int(np.max(sample_counts))
+        indices = np.arange(length)
+        flowrates = self.flowrates[:length]
+        base_variances = self.base_variances[:length]
+        config = self.hrs_config
+        block = max(1, self.max_elements // length)
+        for start in range(0, len(sample_counts), block):
+            counts = sample_counts[start : start + block, None]
+            # Pressure ramp of np.linspace(0, 700, count)
+            pressures = indices * (self.final_pressure / (counts - 1))
+            pressure_effect = config.pressure_contribution * pressures * flowrates / 100
+            drift = config.annual_deviation * years[start : start + block, None]
+            drift = drift * flowrates / 100
+            variances = base_variances + np.square(pressure_effect) + np.square(drift)
+            sample_totals = np.where(indices < counts, np.sqrt(variances), 0.0)
+            totals[start : start + block] = np.sum(sample_totals, axis=-1) * self.formatting
+        return totals.reshape(shape)
+
+    def get_parameters(self, dead_volume=None, vent_volume=None, years=None):
+        """
+        Returns the volumes and the years since calibration, replacing missing values
+        by those of the configuration.
+        """
+        config = self.hrs_config
+        if dead_volume is None:
+            dead_volume = config.get_dead_volume()
+        if vent_volume is None:
+            vent_volume = config.get_depressurization_vent_volume()
+        if years is None:
+            years = config.years_since_calibration
+        return dead_volume, vent_volume, years
+
+    def calculate_uncertainty(
+        self, sample_counts, dead_volume=None, vent_volume=None, years=None, k=2
+    ):
+        """
+        Calculates the relative expanded uncertainty of simulated fillings, as
+        calculate_total_system_rel_unc_k(). Every parameter may be an array, and the
+        arrays are broadcast together.
+
+        Parameters:
+            - Sample counts: Number of samples of the fillings, at least 2.
+            - Dead volume, vent volume: Volumes [m3], defaulting to the configuration.
+            - Years: Years since calibration, defaulting to the configuration.
+            - k: Coverage factor.
+
+        Returns:
+            - Relative expanded uncertainty, infinite where the corrections exceed the
+              mass delivered.
+            - Corrected mass delivered [kg]
+        """
+        sample_counts, dead_volume, vent_volume, years, k = np.broadcast_arrays(
+            sample_counts, *self.get_parameters(dead_volume, vent_volume, years), k
+        )
+        last = sample_counts - 1
+        meter_uncertainty = self.calculate_meter_uncertainty(sample_counts, years)
+        mass_corrected = (
+            self.mass_delivered[last]
+            - dead_volume * self.dead_volume_errors[last]
+            - vent_volume * self.vent_errors[last]
+        )
+        uncertainty = k * np.sqrt(
+            np.square(meter_uncertainty)
+            + np.square(vent_volume * self.vent_uncs[last])
+            + np.square(dead_volume * self.dead_volume_uncs[last])
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative = np.where(mass_corrected > 0, uncertainty / mass_corrected, np.inf)
+        return relative, mass_corrected
+
+    @timed("inverse_solver.min_fill")
+    def solve_min_fill(self, target, dead_volume=None, vent_volume=None, years=None, k=2):
+        """
+        Finds the smallest simulated filling meeting the target uncertainty, for every
+        combination of the parameters. The uncertainty is assumed to decrease as the
+        filling grows. Every parameter may be an array, and the arrays are broadcast
+        together, such as a grid created by np.meshgrid().
+
+        Parameters:
+            - Target: Largest allowed relative expanded uncertainty.
+            - Dead volume, vent volume, years, k: As for calculate_uncertainty()
+
+        Returns:
+            - Dictionary of arrays with the shape of the broadcast parameters:
+                - "sample_count": Number of samples of the smallest filling, or -1 where
+                  no filling up to the master filling meets the target.
+                - "fill_kg": Mass delivered by the filling [kg], NaN where not met.
+                - "mass_corrected": Corrected mass of the filling [kg]
+                - "uncertainty": Relative expanded uncertainty of the filling.
+        """
+        parameters = np.broadcast_arrays(
+            target, *self.get_parameters(dead_volume, vent_volume, years), k
+        )
+        shape = parameters[0].shape
+        target, dead_volume, vent_volume, years, k = [
+            np.ravel(value).astype(float) for value in parameters
+        ]
+
+        def meets_target(counts, select):
+            uncertainty, _ = self.calculate_uncertainty(
+                counts, dead_volume[select], vent_volume[select], years[select], k[select]
+            )
+            return uncertainty <= target[select]
+
+        everything = np.arange(target.size)
+        low = np.full(target.size, 2)
+        high = np.full(target.size, len(self.flowrates))
+        feasible = meets_target(high, everything)
+        met_at_low = meets_target(low, everything)
+        high[met_at_low] = 2
+        # Invariant: the filling at high meets the target, and the one at low does not.
+        active = np.flatnonzero(feasible & ~met_at_low)
+        while active.size:
+            middle = (low[active] + high[active]) // 2
+            meets = meets_target(middle, active)
+            high[active] = np.where(meets, middle, high[active])
+            low[active] = np.where(meets, low[active], middle)
+            active = active[high[active] - low[active] > 1]
+
+        uncertainty, mass_corrected = self.calculate_uncertainty(
+            high, dead_volume, vent_volume, years, k
+        )
+        return {
+            "sample_count": np.where(feasible, high, -1).reshape(shape),
+            "fill_kg": np.where(feasible, self.mass_delivered[high - 1], np.nan).reshape(
+                shape
+            ),
+            "mass_corrected": np.where(feasible, mass_corrected, np.nan).reshape(shape),
+            "uncertainty": np.where(feasible, uncertainty, np.nan).reshape(shape),
+        }
+
+    @timed("inverse_solver.max_volume")
+    def solve_max_volume(
+        self,
+        target,
+        fill_kg,
+        volume="dead_volume",
+        dead_volume=None,
+        vent_volume=None,
+        years=None,
+        k=2,
+        iterations=60,
+    ):
+        """
+        Finds the largest dead volume or vent volume where the simulated filling still
+        meets the target uncertainty, for every combination of the parameters. The
+        uncertainty grows with the volume, as both the correction uncertainty grows and
+        the corrected mass shrinks. Every parameter may be an array, and the arrays are
+        broadcast together.
+
+        Parameters:
+            - Target: Largest allowed relative expanded uncertainty.
+            - Fill kg: Size of the simulated filling [kg]
+            - Volume: The volume solved for, "dead_volume" or "vent_volume".
+            - Dead volume, vent volume: The other volume [m3], defaulting to the
+              configuration. The value of the volume solved for is ignored.
+            - Years, k: As for calculate_uncertainty()
+            - Iterations: Number of bisection steps, each halving the interval.
+
+        Returns:
+            - Array of the largest volumes [m3], with the shape of the broadcast
+              parameters. NaN where the target is not met without the volume, and
+              infinite where the volume does not affect the uncertainty, as when its
+              correction is turned off.
+        """
+        if volume not in ("dead_volume", "vent_volume"):
+            raise ValueError(f"Unknown volume: {volume}")
+        parameters = np.broadcast_arrays(
+            target,
+            self.get_sample_count(fill_kg),
+            *self.get_parameters(dead_volume, vent_volume, years),
+            k,
+        )
+        shape = parameters[0].shape
+        target, counts, dead_volume, vent_volume, years, k = [
+            np.ravel(value) for value in parameters
+        ]
+
+        def meets_target(volumes, select):
+            other = {"dead_volume": dead_volume[select], "vent_volume": vent_volume[select]}
+            other[volume] = volumes
+            uncertainty, _ = self.calculate_uncertainty(
+                counts[select],
+                other["dead_volume"],
+                other["vent_volume"],
+                years[select],
+                k[select],
+            )
+            return uncertainty <= target[select]
+
+        everything = np.arange(target.size)
+        feasible = meets_target(np.zeros(target.size), everything)
+        # Doubles the upper bound until it misses the target.
+        low = np.zeros(target.size)
+        high = np.full(target.size, 1e-3)
+        active = np.flatnonzero(feasible)
+        for _ in range(iterations):
+            if not active.size:
+                break
+            meets = meets_target(high[active], active)
+            low[active[meets]] = high[active[meets]]
+            high[active[meets]] *= 2
+            active = active[meets]
+        unbounded = np.zeros(target.size, dtype=bool)
+        unbounded[active] = True
+
+        active = np.flatnonzero(feasible & ~unbounded)
+        for _ in range(iterations):
+            if not active.size:
+                break
+            middle = (low[active] + high[active]) / 2
+            meets = meets_target(middle, active)
+            low[active] = np.where(meets, middle, low[active])
+            high[active] = np.where(meets, high[active], middle)
+        result = np.where(unbounded, np.inf, low)
+        return np.where(feasible, result, np.nan).reshape(shape)
@@ -0,0 +1,315 @@
+"""
+This module contains the SampleChainKernel class, which computes the per sample
+uncertainty breakdown of a filling, and the running totals, in one compiled pass.
+Numba is used when it is installed. Otherwise the kernel falls back to the NumPy
+array methods of UncertaintyTools, giving the same results.
+
+Classes:
+    SampleChainKernel
+Functions:
+    interpolate: Linear interpolation of a single value.
+    sample_chain: The per sample loop, compiled by Numba when avaliable.
+"""
+import numpy as np
+from hrs_config import HRSConfiguration
+from correction import Correction
+from fill_state import FillState
+from uncertainty_tools import UncertaintyTools
+from instrumentation import timed
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# Rows of the output of sample_chain, in the order of calculate_sample_arrays().
+SAMPLE_SERIES = (
+    "abs_cfm",
+    "abs_total",
+    "comb_rel_k",
+    "rel_cfm_k",
+    "rel_temp",
+    "rel_pres",
+    "rel_ltd",
+    "abs_temp",
+    "abs_pres",
+    "abs_ltd",
+)
+
+
+def interpolate(x, xp, fp):
+    """
+    Linear interpolation of a single value, equal to np.interp(), which the kernel
+    calls without allocating arrays.
+
+    Parameters:
+        - x: The value to interpolate at.
+        - xp: Increasing x-coordinates of the data points.
+        - fp: y-coordinates of the data points.
+
+    Returns:
+        - The interpolated value.
+    """
+    last = xp.shape[0] - 1
+    if x <= xp[0]:
+        return fp[0]
+    if x >= xp[last]:
+        return fp[last]
+    low = 0
+    high = last
+    while high - low > 1:
+        middle = (low + high) // 2
+        if xp[middle] <= x:
+            low = middle
+        else:
+            high = middle
+    slope = (fp[high] - fp[low]) / (xp[high] - xp[low])
+    return fp[low] + slope * (x - xp[low])
+
+
+def sample_chain(
+    flowrates,
+    temperatures,
+    pressures,
+    curve_flowrates,
+    curves,
+    multiple,
+    single_values,
+    temperature_contribution,
+    pressure_contribution,
+    relative_annual,
+    has_previous,
+    previous_temperature,
+    k,
+    formatting,
+    out,
+    totals,
+):
+    """
+    Calculates the per sample uncertainties in a single loop, comparing each temperature
+    to the one of the previous sample. The meter components are given in the order:
+    calibration deviation, calibration repeatability, calibration reference, field
+    repeatability and field condition.
+
+    Parameters:
+        - Flowrates, temperatures, pressures: Sample arrays [kg/min], [C], [bar]
+        - Curve flowrates: Flowrates of the calibration curves [kg/min]
+        - Curves: 2D array with the relative uncertainty curve of each component.
+        - Multiple: Whether each component varies with flowrate.
+        - Single values: The single value of each component.
+        - Temperature contribution: Temperature effect [kg/min]
+        - Pressure contribution: Relative pressure effect per bar.
+        - Relative annual: Relative long term drift [%]
+        - Has previous, previous temperature: Temperature before the first sample [C]
+        - k: Coverage factor
+        - Formatting: Duration of each sample [min]
+        - Out: 2D output array, one row per entry of SAMPLE_SERIES.
+        - Totals: Output array for mass, cfm, total, temperature, pressure and drift [kg].
+    """
+    previous = previous_temperature
+    for i in range(flowrates.shape[0]):
+        flowrate = flowrates[i]
+        temperature = temperatures[i]
+        pressure = pressures[i]
+
+        cfm_variance = 0.0
+        for component in range(5):
+            if multiple[component]:
+                relative = interpolate(flowrate, curve_flowrates, curves[component])
+                absolute = relative * flowrate
+            elif component == 1:
+                # A single calibration repeatability is used as an absolute value.
+                absolute = single_values[component]
+            else:
+                absolute = single_values[component] * flowrate
+            cfm_variance += absolute * absolute
+
+        if has_previous and temperature == previous:
+            abs_temp = 0.0
+        else:
+            abs_temp = temperature_contribution
+        rel_pres = pressure_contribution * pressure * (-1)
+        abs_pres = rel_pres * flowrate / 100
+        abs_ltd = relative_annual * flowrate / 100
+
+        if flowrate != 0:
+            rel_temp = abs_temp / flowrate * 100
+            abs_cfm = np.sqrt(cfm_variance)
+            misc_variance = abs_temp * abs_temp + abs_pres * abs_pres + abs_ltd * abs_ltd
+            abs_total = np.sqrt(cfm_variance + misc_variance)
+            rel_cfm_variance = cfm_variance / (flowrate * flowrate) * 10000
+            rel_misc_variance = (
+                rel_temp * rel_temp
+                + rel_pres * rel_pres
+                + relative_annual * relative_annual
+            )
+            comb_rel_k = np.sqrt(rel_cfm_variance + rel_misc_variance) * k
+            rel_cfm_k = np.sqrt(rel_cfm_variance) * k
+        else:
+            rel_temp = 0.0
+            abs_cfm = 0.0
+            abs_total = 0.0
+            comb_rel_k = 0.0
+            rel_cfm_k = 0.0
+
+        out[0, i] = abs_cfm
+        out[1, i] = abs_total
+        out[2, i] = comb_rel_k
+        out[3, i] = rel_cfm_k
+        out[4, i] = rel_temp
+        out[5, i] = rel_pres
+        out[6, i] = relative_annual
+        out[7, i] = abs_temp
+        out[8, i] = abs_pres
+        out[9, i] = abs_ltd
+
+        totals[0] += flowrate * formatting
+        totals[1] += abs_cfm * formatting
+        totals[2] += abs_total * formatting
+        totals[3] += abs_temp * formatting
+        totals[4] += abs_pres * formatting
+        totals[5] += abs_ltd * formatting
+        previous = temperature
+        has_previous = True
+
+
+if NUMBA_AVAILABLE:
+    interpolate = numba.njit(cache=True, nogil=True)(interpolate)
+    sample_chain = numba.njit(cache=True, nogil=True)(sample_chain)
+
+
+class SampleChainKernel:
+    """
+    This class evaluates the per sample uncertainty chain of a filling, by the compiled
+    loop when Numba is avaliable, and by the NumPy array methods otherwise.
+    """
+
+    def __init__(self, hrs_config: HRSConfiguration, use_jit=True):
+        """
+        Parameters:
+            - hrs_config: The HRS configuration.
+            - use_jit: Use the Numba kernel when it is installed.
+        """
+        self.hrs_config = hrs_config
+        self.uncertainty_tools = UncertaintyTools(hrs_config, Correction(hrs_config))
+        self.use_jit = use_jit and NUMBA_AVAILABLE
+
+    def get_curve_arrays(self):
+        """
+        Collects the calibration curves and single values of the meter components from
+        the HRS configuration, in the order used by sample_chain().
+
+        Returns:
+            - Curve flowrates, curves, multiple and single values as arrays.
+        """
+        config = self.hrs_config
+        components = (
+            (
+                config.multiple_calibration_deviation_bool,
+                config.get_calibration_deviation(),
+            ),
+            (
+                config.multiple_calibration_repeatability_bool,
+                config.get_calibration_repeatability(),
+            ),
+            (
+                config.multiple_calibration_reference_bool,
+                config.get_calibration_reference(),
+            ),
+            (
+                config.multiple_field_repeatability_bool,
+                config.get_field_repeatability(),
+            ),
+            (config.multiple_field_condition_bool, config.get_field_condition()),
+        )
+        curve_flowrates = np.asarray(config.flowrates_kg_min, dtype=float)
+        curves = np.zeros((5, len(curve_flowrates)))
+        multiple = np.zeros(5, dtype=np.bool_)
+        single_values = np.zeros(5)
+        for index, (multiple_bool, uncertainty) in enumerate(components):
+            if multiple_bool:
+                multiple[index] = True
+                curves[index] = uncertainty
+            else:
+                single_values[index] = uncertainty
+        return curve_flowrates, curves, multiple, single_values
+
+    @timed("jit_kernels.evaluate")
+    def evaluate(
+        self,
+        flowrates,
+        temperatures,
+        pressures,
+        k,
+        fill_state=None,
+        formatting=1 / 60,
+        timestamps=None,
+    ):
+        """
+        Calculates the per sample breakdown of a filling, and adds the samples to the
+        running totals of the fill state. Timestamped samples are integrated by the
+        trapezoidal rule instead of the running totals of the loop.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - k: Coverage factor
+            - Fill state: State of the filling, which the totals are added to.
+            - Formatting: Duration of each sample [min]
+            - Timestamps: Optional array of sample times [s]
+
+        Returns:
+            - Sample arrays: Dictionary of arrays, as returned by calculate_sample_arrays()
+            - Fill state: The updated fill state.
+        """
+        flowrates = np.ascontiguousarray(flowrates, dtype=float)
+        temperatures = np.ascontiguousarray(temperatures, dtype=float)
+        pressures = np.ascontiguousarray(pressures, dtype=float)
+        if fill_state is None:
+            fill_state = FillState()
+        if len(flowrates) == 0:
+            return {name: np.zeros(0) for name in SAMPLE_SERIES}, fill_state
+
+        if not self.use_jit:
+            sample_arrays = self.uncertainty_tools.calculate_sample_arrays(
+                flowrates, temperatures, pressures, k, fill_state
+            )
+            fill_state.record_samples(
+                flowrates, temperatures, sample_arrays, formatting, timestamps
+            )
+            return sample_arrays, fill_state
+
+        curve_flowrates, curves, multiple, single_values = self.get_curve_arrays()
+        out = np.empty((len(SAMPLE_SERIES), len(flowrates)))
+        totals = np.zeros(6)
+        has_previous = fill_state.previous_temperature is not None
+        sample_chain(
+            flowrates,
+            temperatures,
+            pressures,
+            curve_flowrates,
+            curves,
+            multiple,
+            single_values,
+            float(self.hrs_config.temperature_contribution),
+            float(self.hrs_config.pressure_contribution),
+            float(self.uncertainty_tools.calculate_relative_annual_dev()),
+            has_previous,
+            float(fill_state.previous_temperature) if has_previous else 0.0,
+            float(k),
+            float(formatting),
+            out,
+            totals,
+        )
+        sample_arrays = dict(zip(SAMPLE_SERIES, out))
+        if timestamps is not None:
+            fill_state.record_samples(
+                flowrates, temperatures, sample_arrays, timestamps=timestamps
+            )
+        else:
+            fill_state.add_totals(totals)
+            fill_state.previous_temperature = temperatures[-1]
+        return sample_arrays, fill_state
@@ -0,0 +1,265 @@
+"""
+This module contains the LiveDashboard class, which plots the flowrate, pressure,
+temperature and expanded uncertainty of a filling while its samples arrive from a
+streaming source, such as GenerateFlowData.stream_filling_protocol(). The samples are
+read by a background thread, and the figure is redrawn by a timer at a bounded frame
+rate, independent of the sample rate. A 100 Hz feed is therefore drawn the same number
+of times per second as a 1 Hz feed, with every sample received since the last frame
+evaluated at once.
+
+Only the lines are redrawn for each frame, on top of a saved background of the axes
+(blitting). The whole figure is only redrawn when the data grows out of the axis limits.
+The lines are reduced by IncrementalLTTB, which only selects the points of the newest
+samples again, so a frame costs the same at the end of a long filling as at its start.
+
+Classes:
+    LiveDashboard
+"""
+import queue
+import threading
+import numpy as np
+import matplotlib.pyplot as plt
+
+from fill_state import FillState
+from uncertainty_tools import UncertaintyTools
+from downsampling import IncrementalLTTB
+from instrumentation import timed
+
+
+class LiveDashboard:
+    """
+    This class plots a filling live, as its samples arrive. The samples are given as
+    blocks of timestamps [s], flowrates [kg/s], pressures [bar] and temperatures [C].
+    """
+
+    series = ("flowrates", "pressures", "temperatures", "comb_rel_k")
+
+    def __init__(self, uncertainty_tools: UncertaintyTools, k, max_fps=10, max_points=2000):
+        """
+        Parameters:
+            - uncertainty_tools: UncertaintyTools calculating the uncertainty of the samples.
+            - k: Coverage factor of the expanded uncertainty.
+            - max_fps: The largest number of frames drawn per second.
+            - max_points: The largest number of points drawn per line.
+        """
+        self.uncertainty_tools = uncertainty_tools
+        self.k = k
+        self.max_fps = max_fps
+        self.downsamplers = {name: IncrementalLTTB(max_points) for name in self.series}
+        self.fill_state = FillState()
+        self.samples = queue.Queue()
+        self.source_finished = threading.Event()
+        self.reader = None
+        self.timer = None
+
+        self.sample_count = 0
+        self.timestamps = np.zeros(1024)
+        self.values = {name: np.zeros(1024) for name in self.series}
+        self.frames_drawn = 0
+
+        self.figure = None
+        self.axes = None
+        self.lines = None
+        self.background = None
+
+    def read_source(self, source):
+        """
+        Reads every block of a streaming source into the sample queue. Runs on the
+        background thread started by start_reading().
+
+        Parameters:
+            - source: Iterable of blocks of timestamps, flowrates, pressures and
+              temperatures.
+        """
+        try:
+            for block in source:
+                self.samples.put(block)
+        finally:
+            self.source_finished.set()
+
+    def start_reading(self, source):
+        """
+        Starts reading a streaming source on a background thread.
+
+        Parameters:
+            - source: Iterable of blocks of timestamps, flowrates, pressures and
+              temperatures.
+        """
+        self.source_finished.clear()
+        self.reader = threading.Thread(target=self.read_source, args=(source,), daemon=True)
+        self.reader.start()
+
+    def is_finished(self):
+        """Returns True when the source is exhausted and every sample is evaluated."""
+        return self.source_finished.is_set() and self.samples.empty()
+
+    def append(self, timestamps, values):
+        """
+        Appends samples to the stored series, growing the arrays by doubling.
+
+        Parameters:
+            - timestamps: Array of sample times [s]
+            - values: Dictionary of series name: array of values.
+        """
+        count = self.sample_count + len(timestamps)
+        if count > len(self.timestamps):
+            capacity = max(count, 2 * len(self.timestamps))
+            self.timestamps = np.resize(self.timestamps, capacity)
+            for name in self.series:
+                self.values[name] = np.resize(self.values[name], capacity)
+        self.timestamps[self.sample_count : count] = timestamps
+        for name in self.series:
+            self.values[name][self.sample_count : count] = values[name]
+        self.sample_count = count
+
+    @timed("live_dashboard.evaluate")
+    def evaluate_received(self):
+        """
+        Evaluates every sample received since the previous call, and appends them to the
+        stored series.
+
+        Returns:
+            - The number of samples evaluated.
+        """
+        blocks = []
+        while True:
+            try:
+                blocks.append(self.samples.get_nowait())
+            except queue.Empty:
+                break
+        if not blocks:
+            return 0
+        timestamps, flowrates_kg_sec, pressures, temperatures = (
+            np.concatenate(arrays) for arrays in zip(*blocks)
+        )
+        flowrates = flowrates_kg_sec * 60
+        sample_arrays = self.uncertainty_tools.calculate_sample_arrays(
+            flowrates, temperatures, pressures, self.k, self.fill_state
+        )
+        self.fill_state.record_samples(
+            flowrates, temperatures, sample_arrays, timestamps=timestamps
+        )
+        self.append(
+            timestamps,
+            {
+                "flowrates": flowrates,
+                "pressures": pressures,
+                "temperatures": temperatures,
+                "comb_rel_k": sample_arrays["comb_rel_k"],
+            },
+        )
+        return len(timestamps)
+
+    def create_figure(self):
+        """
+        Creates the figure, with one axis per series sharing the time axis, and lines
+        which are only drawn by blitting.
+        """
+        self.figure, self.axes = plt.subplots(4, 1, sharex=True, figsize=(10, 9))
+        labels = [
+            "Flowrate (kg/min)",
+            "Pressure (bar)",
+            "Temperature (°C)",
+            f"Rel. uncertainty (%), k={self.k}",
+        ]
+        colors = ["tab:red", "tab:blue", "tab:green", "black"]
+        self.lines = []
+        for axis, label, color in zip(self.axes, labels, colors):
+            (line,) = axis.plot([], [], color=color, animated=True)
+            axis.set_ylabel(label)
+            axis.set_ylim(0, 1)
+            axis.grid(True)
+            self.lines.append(line)
+        self.axes[-1].set_xlabel("Time (s)")
+        self.axes[0].set_xlim(0, 1)
+        self.axes[0].set_title("Live filling")
+        self.figure.tight_layout()
+        self.figure.canvas.mpl_connect("draw_event", self.on_draw)
+
+    def on_draw(self, event):
+        """
+        Saves the background of the figure after a full redraw, such as after resizing
+        the window, and draws the lines on top of it.
+        """
+        canvas = self.figure.canvas
+        self.background = canvas.copy_from_bbox(self.figure.bbox)
+        for line in self.lines:
+            self.figure.draw_artist(line)
+
+    def update_limits(self):
+        """
+        Extends the axis limits which the data has grown out of, with margin to grow.
+
+        Returns:
+            - True if any limit changed, requiring a full redraw.
+        """
+        count = self.sample_count
+        changed = False
+        last_time = self.timestamps[count - 1]
+        if last_time > self.axes[0].get_xlim()[1]:
+            self.axes[0].set_xlim(self.timestamps[0], max(1.5 * last_time, 1))
+            changed = True
+        for axis, name in zip(self.axes, self.series):
+            values = self.values[name][:count]
+            low, high = axis.get_ylim()
+            data_low, data_high = np.min(values), np.max(values)
+            if data_low < low or data_high > high:
+                margin = 0.1 * max(data_high - data_low, abs(data_high), 1e-9)
+                axis.set_ylim(min(low, data_low - margin), max(high, data_high + margin))
+                changed = True
+        return changed
+
+    @timed("live_dashboard.frame")
+    def draw_frame(self):
+        """
+        Evaluates the received samples, and draws them. Called by the timer once per
+        frame.
+
+        Returns:
+            - The number of samples evaluated.
+        """
+        evaluated = self.evaluate_received()
+        if evaluated == 0:
+            if self.is_finished() and self.timer is not None:
+                self.timer.stop()
+            return 0
+        count = self.sample_count
+        times = self.timestamps[:count]
+        for line, name in zip(self.lines, self.series):
+            values = self.values[name][:count]
+            index = self.downsamplers[name].update(times, values)
+            line.set_data(times[index], values[index])
+
+        canvas = self.figure.canvas
+        if self.update_limits() or self.background is None:
+            # Redraws the axes, and the lines through on_draw().
+            canvas.draw()
+        else:
+            canvas.restore_region(self.background)
+            for line in self.lines:
+                self.figure.draw_artist(line)
+            canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+        self.frames_drawn += 1
+        return evaluated
+
+    def run(self, source, show=True):
+        """
+        Plots a filling live, as its samples arrive from a streaming source.
+
+        Parameters:
+            - source: Iterable of blocks of timestamps, flowrates, pressures and
+              temperatures, such as GenerateFlowData.stream_filling_protocol()
+            - show: If True, shows the figure and blocks until it is closed.
+
+        Returns:
+            - The fill state, containing the totals of the samples evaluated.
+        """
+        self.create_figure()
+        self.start_reading(source)
+        self.timer = self.figure.canvas.new_timer(interval=int(1000 / self.max_fps))
+        self.timer.add_callback(self.draw_frame)
+        self.timer.start()
+        if show:
+            plt.show()
+        return self.fill_state
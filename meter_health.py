@@ -0,0 +1,464 @@
+"""
+This module contains an online monitor of the health of the meters of a station, fed
+with the live samples of every dispenser. Each sample updates a fixed number of rolling
+statistics, so the monitor keeps up with 100 Hz logs of every dispenser on one core and
+flags a failing meter during the filling:
+    - Noise: EWMA of the squared flowrate residuals, where the residual is the deviation
+      from a Holt (level and trend) prediction, normalized by the standard deviation of
+      the prediction error of a meter with the calibrated repeatability at the flowrate.
+      A healthy meter averages 1.
+    - Shift: Two-sided CUSUM of the flowrate residuals against a slow reference, a
+      second Holt prediction with a time constant in seconds, detecting steps of the
+      meter reading which the noise average spreads out. The fast prediction follows a
+      step within a few samples, after which its residuals sum to zero, while the
+      reference follows it only over its time constant. The slack covers the error of
+      the reference at a legitimate change of the flowrate slope. A drift slower than
+      the flowrate changes of a filling cannot be told from the flowrate alone, and is
+      left to the recalibration planning of drift_planner.
+    - Temperature steps: EWMA of the fraction of samples where the temperature changed,
+      each of which adds the temperature contribution to the uncertainty.
+    - Pressure consistency: EWMA of the fraction of samples where the meter reports flow
+      without the pressure rising, or the pressure rises without flow.
+    - Calibrated range: EWMA of the fraction of flowing samples outside the flowrates of
+      the calibration curves, HRSConfiguration.flowrates_kg_min.
+
+Classes:
+    MeterCurves
+    MeterMonitor
+    StationHealthMonitor
+Functions:
+    calculate_prediction_variance: Returns the variance of the Holt prediction error.
+    calculate_corner_error: Returns the largest Holt prediction error after a change of
+                            slope.
+"""
+import numpy as np
+
+from fill_state import FillState
+from uncertainty_tools import UncertaintyTools
+
+# Flags returned by MeterMonitor.update(), combined as a bit mask.
+NOISE = 1
+SHIFT = 2
+TEMPERATURE_STEPS = 4
+PRESSURE_CONSISTENCY = 8
+OUT_OF_RANGE = 16
+
+FLAG_NAMES = {
+    NOISE: "noise",
+    SHIFT: "shift",
+    TEMPERATURE_STEPS: "temperature_steps",
+    PRESSURE_CONSISTENCY: "pressure_consistency",
+    OUT_OF_RANGE: "out_of_range",
+}
+
+
+def calculate_prediction_variance(level_alpha, trend_beta, samples=1000):
+    """
+    Calculates the variance of the error of the Holt one step prediction, for samples
+    with unit variance and independent errors. The prediction is a weighted sum of the
+    previous samples, so the variance of the error is 1 plus the sum of the squared
+    weights, found from the response of the prediction to a single unit sample.
+
+    Parameters:
+        - level_alpha, trend_beta: Smoothing of the level and trend of the prediction.
+        - samples: Number of weights summed.
+
+    Returns:
+        - Variance of the prediction error, relative to the variance of the samples.
+    """
+    level = level_alpha
+    trend = level_alpha * trend_beta
+    variance = 1.0
+    for _ in range(samples):
+        predicted = level + trend
+        variance += predicted * predicted
+        level = predicted - level_alpha * predicted
+        trend -= level_alpha * trend_beta * predicted
+    return variance
+
+
+def calculate_corner_error(level_alpha, trend_beta, samples=1000):
+    """
+    Calculates the largest error of the Holt one step prediction after the slope of
+    noiseless samples changes by one per sample, such as at the end of a flowrate ramp.
+
+    Parameters:
+        - level_alpha, trend_beta: Smoothing of the level and trend of the prediction.
+        - samples: Number of samples followed after the change.
+
+    Returns:
+        - Largest prediction error, relative to the change of the samples per sample.
+    """
+    level = 0.0
+    trend = 0.0
+    largest = 0.0
+    for sample in range(1, samples + 1):
+        predicted = level + trend
+        error = sample - predicted
+        largest = max(largest, abs(error))
+        level_next = predicted + level_alpha * error
+        trend += trend_beta * (level_next - level - trend)
+        level = level_next
+    return largest
+
+
+class MeterCurves:
+    """
+    This class tabulates the calibrated uncertainty curves of a meter on an even grid of
+    flowrates, so the uncertainty at a flowrate is looked up in constant time.
+    """
+
+    __slots__ = ("low", "high", "step", "repeatability")
+
+    def __init__(self, uncertainty_tools: UncertaintyTools, points=256):
+        """
+        Parameters:
+            - uncertainty_tools: The UncertaintyTools of the station.
+            - points: Number of flowrates in the table.
+        """
+        flowrates = uncertainty_tools.hrs_config.flowrates_kg_min
+        self.low = float(np.min(flowrates))
+        self.high = float(np.max(flowrates))
+        grid = np.linspace(self.low, self.high, points)
+        self.step = (self.high - self.low) / (points - 1)
+        components = uncertainty_tools.calculate_component_arrays(
+            grid, np.zeros(points), np.zeros(points), FillState()
+        )
+        # Absolute repeatability of the meter [kg/min]
+        repeatability = np.sqrt(
+            np.square(components["calibration_repeatability"])
+            + np.square(components["field_repeatability"])
+        )
+        self.repeatability = repeatability.tolist()
+
+    def get_repeatability(self, flowrate):
+        """
+        Returns the calibrated repeatability at a flowrate [kg/min], by linear
+        interpolation of the table. Flowrates outside the calibrated range are given the
+        repeatability at the nearest end of the range.
+        """
+        if flowrate <= self.low:
+            return self.repeatability[0]
+        if flowrate >= self.high:
+            return self.repeatability[-1]
+        position = (flowrate - self.low) / self.step
+        index = int(position)
+        lower = self.repeatability[index]
+        return lower + (self.repeatability[index + 1] - lower) * (position - index)
+
+
+class MeterMonitor:
+    """
+    This class holds the rolling statistics of the meter of one dispenser. Every update
+    takes constant time and memory.
+
+    The default limits of the flowrate residuals were set on simulated fillings of
+    GenerateFlowData, with noise equal to the calibrated repeatability. At 10 Hz and
+    100 Hz the noise of a healthy meter stays below 1.2. At 1 Hz the change of slope at
+    the end of the flowrate ramp is larger than the repeatability between two samples,
+    raising the noise to at most 11.5 over 2500 fillings. The noise limit of 16 flags
+    noise of about four times the repeatability. The CUSUM of a healthy meter stays
+    below 2.5 at any sampling rate, with the limit at 10. On 4 kg fillings, a step of
+    the meter reading anywhere in the filling is flagged from 3% at 100 Hz, 10% at
+    10 Hz and 20% at 1 Hz, where the flowrate changes by more than the repeatability
+    between samples. A linear drift of 10% over the filling is not flagged.
+    """
+
+    __slots__ = (
+        "curves",
+        "time_constant",
+        "level_alpha",
+        "trend_beta",
+        "prediction_std",
+        "reference_time",
+        "slope_change",
+        "references",
+        "noise_limit",
+        "cusum_slack",
+        "cusum_limit",
+        "temperature_step_limit",
+        "consistency_limit",
+        "range_limit",
+        "range_margin",
+        "min_pressure_rate",
+        "warmup",
+        "samples",
+        "flowing_time",
+        "level",
+        "trend",
+        "reference_level",
+        "reference_trend",
+        "noise",
+        "cusum_high",
+        "cusum_low",
+        "temperature_steps",
+        "pressure_rate",
+        "inconsistency",
+        "out_of_range",
+        "previous_temperature",
+        "previous_pressure",
+        "alarms",
+    )
+
+    def __init__(
+        self,
+        curves: MeterCurves,
+        time_constant=30.0,
+        level_alpha=0.5,
+        trend_beta=0.5,
+        reference_time=0.25,
+        slope_change=0.05,
+        noise_limit=16.0,
+        cusum_slack=1.0,
+        cusum_limit=10.0,
+        temperature_step_limit=0.9,
+        consistency_limit=0.2,
+        range_limit=0.2,
+        range_margin=0.01,
+        min_pressure_rate=0.1,
+        warmup=5.0,
+    ):
+        """
+        Parameters:
+            - curves: The MeterCurves of the meter.
+            - time_constant: Time constant of the rolling averages [s], so the
+              averages cover the same time at any sampling rate.
+            - level_alpha, trend_beta: Smoothing of the level and trend of the flowrate
+              prediction.
+            - reference_time: Time constant of the reference of the CUSUM [s], which is
+              never faster than the prediction.
+            - slope_change: Largest sudden change of the flowrate slope of a healthy
+              filling, such as at the end of the flowrate ramp [kg/min/s]
+            - noise_limit: Largest mean squared normalized residual, 1 for a healthy
+              meter.
+            - cusum_slack, cusum_limit: Slack subtracted from each normalized residual
+              against the reference, on top of the largest residual of a change of
+              slope, and the largest cumulative sum.
+            - temperature_step_limit: Largest fraction of samples with a temperature step.
+            - consistency_limit: Largest fraction of samples where flow and pressure
+              disagree.
+            - range_limit: Largest fraction of flowing samples outside the calibration.
+            - range_margin: Relative margin around the calibrated flowrates, so noise at
+              the ends of the range is not counted as outside.
+            - min_pressure_rate: Smallest pressure rise counted as filling [bar/s]
+            - warmup: Time of flow before the flowrate residuals are counted [s], while
+              the prediction settles on the start of the filling.
+        """
+        self.curves = curves
+        self.time_constant = time_constant
+        self.level_alpha = level_alpha
+        self.trend_beta = trend_beta
+        self.prediction_std = calculate_prediction_variance(level_alpha, trend_beta) ** 0.5
+        self.reference_time = reference_time
+        self.slope_change = slope_change
+        # Smoothing, prediction error and change of slope error of the reference, per
+        # sample duration.
+        self.references = {}
+        self.noise_limit = noise_limit
+        self.cusum_slack = cusum_slack
+        self.cusum_limit = cusum_limit
+        self.temperature_step_limit = temperature_step_limit
+        self.consistency_limit = consistency_limit
+        self.range_limit = range_limit
+        self.range_margin = range_margin
+        self.min_pressure_rate = min_pressure_rate
+        self.warmup = warmup
+        self.alarms = 0
+        self.reset()
+
+    def reset(self):
+        """Resets the statistics, such as at the start of a filling. Alarms are kept."""
+        self.samples = 0
+        self.flowing_time = 0.0
+        self.level = None
+        self.trend = 0.0
+        self.reference_level = None
+        self.reference_trend = 0.0
+        self.noise = 0.0
+        self.cusum_high = 0.0
+        self.cusum_low = 0.0
+        self.temperature_steps = 0.0
+        self.pressure_rate = 0.0
+        self.inconsistency = 0.0
+        self.out_of_range = 0.0
+        self.previous_temperature = None
+        self.previous_pressure = None
+
+    def get_reference(self, duration):
+        """
+        Calculates the smoothing of the reference for a sample duration, the standard
+        deviation of its prediction error relative to the repeatability, and its largest
+        prediction error [kg/min] after a change of slope of slope_change, and stores
+        them for the following samples.
+        """
+        alpha = min(self.level_alpha, duration / self.reference_time)
+        beta = min(self.trend_beta, duration / self.reference_time)
+        samples = max(1000, int(20 / min(alpha, beta)))
+        std = calculate_prediction_variance(alpha, beta, samples) ** 0.5
+        corner_error = (
+            calculate_corner_error(alpha, beta, samples) * self.slope_change * duration
+        )
+        reference = (alpha, beta, std, corner_error)
+        self.references[duration] = reference
+        return reference
+
+    def update(self, flowrate, temperature, pressure, duration=1.0):
+        """
+        Adds a sample to the statistics.
+
+        Parameters:
+            - Flowrate: Measured flowrate [kg/min]
+            - Temperature: Measured temperature [C]
+            - Pressure: Measured pressure [bar]
+            - Duration: Time since the previous sample [s]
+
+        Returns:
+            - Bit mask of the flags raised by the sample, 0 when healthy.
+        """
+        alpha = min(1.0, duration / self.time_constant)
+        flags = 0
+        self.samples += 1
+
+        if self.previous_temperature is not None:
+            step = 1.0 if temperature != self.previous_temperature else 0.0
+            self.temperature_steps += alpha * (step - self.temperature_steps)
+            if self.temperature_steps > self.temperature_step_limit:
+                flags |= TEMPERATURE_STEPS
+        self.previous_temperature = temperature
+
+        if self.previous_pressure is not None:
+            rate = (pressure - self.previous_pressure) / duration
+            self.pressure_rate += alpha * (rate - self.pressure_rate)
+            if flowrate > 0:
+                inconsistent = self.pressure_rate <= 0
+            else:
+                inconsistent = self.pressure_rate > self.min_pressure_rate
+            self.inconsistency += alpha * (inconsistent - self.inconsistency)
+            if self.inconsistency > self.consistency_limit:
+                flags |= PRESSURE_CONSISTENCY
+        self.previous_pressure = pressure
+
+        if flowrate > 0:
+            self.flowing_time += duration
+            outside = (
+                flowrate < self.curves.low * (1 - self.range_margin)
+                or flowrate > self.curves.high * (1 + self.range_margin)
+            )
+            self.out_of_range += alpha * (outside - self.out_of_range)
+            if self.out_of_range > self.range_limit:
+                flags |= OUT_OF_RANGE
+
+            if self.level is None:
+                self.level = flowrate
+                self.reference_level = flowrate
+            else:
+                repeatability = self.curves.get_repeatability(flowrate)
+                predicted = self.level + self.trend * duration
+                residual = (flowrate - predicted) / (repeatability * self.prediction_std)
+                level = predicted + self.level_alpha * (flowrate - predicted)
+                self.trend += self.trend_beta * ((level - self.level) / duration - self.trend)
+                self.level = level
+
+                reference = self.references.get(duration)
+                if reference is None:
+                    reference = self.get_reference(duration)
+                reference_alpha, reference_beta, reference_std, corner_error = reference
+                predicted = self.reference_level + self.reference_trend * duration
+                scale = repeatability * reference_std
+                shift = (flowrate - predicted) / scale
+                slack = self.cusum_slack + corner_error / scale
+                level = predicted + reference_alpha * (flowrate - predicted)
+                self.reference_trend += reference_beta * (
+                    (level - self.reference_level) / duration - self.reference_trend
+                )
+                self.reference_level = level
+                if self.flowing_time > self.warmup:
+                    self.noise += alpha * (residual * residual - self.noise)
+                    self.cusum_high = max(0.0, self.cusum_high + shift - slack)
+                    self.cusum_low = max(0.0, self.cusum_low - shift - slack)
+                    if self.noise > self.noise_limit:
+                        flags |= NOISE
+                    if max(self.cusum_high, self.cusum_low) > self.cusum_limit:
+                        flags |= SHIFT
+        else:
+            # The predictions start over when the flow resumes.
+            self.level = None
+            self.trend = 0.0
+            self.reference_level = None
+            self.reference_trend = 0.0
+
+        self.alarms |= flags
+        return flags
+
+    def get_statistics(self):
+        """Returns the current rolling statistics and the alarms raised so far."""
+        return {
+            "samples": self.samples,
+            "noise": self.noise,
+            "cusum_high": self.cusum_high,
+            "cusum_low": self.cusum_low,
+            "temperature_steps": self.temperature_steps,
+            "inconsistency": self.inconsistency,
+            "out_of_range": self.out_of_range,
+            "alarms": [name for flag, name in FLAG_NAMES.items() if self.alarms & flag],
+        }
+
+
+class StationHealthMonitor:
+    """
+    This class monitors the meters of every dispenser of a station, sharing the
+    calibrated curves of the station between them.
+    """
+
+    def __init__(self, uncertainty_tools: UncertaintyTools, **limits):
+        """
+        Parameters:
+            - uncertainty_tools: The UncertaintyTools of the station.
+            - limits: Keyword arguments passed to each MeterMonitor.
+        """
+        self.curves = MeterCurves(uncertainty_tools)
+        self.limits = limits
+        self.monitors = {}
+
+    def get_monitor(self, dispenser_id):
+        """Returns the monitor of a dispenser, creating it on its first sample."""
+        monitor = self.monitors.get(dispenser_id)
+        if monitor is None:
+            monitor = MeterMonitor(self.curves, **self.limits)
+            self.monitors[dispenser_id] = monitor
+        return monitor
+
+    def start_fill(self, dispenser_id):
+        """Resets the statistics of a dispenser at the start of a filling."""
+        self.get_monitor(dispenser_id).reset()
+
+    def update(self, dispenser_id, flowrate, temperature, pressure, duration=1.0):
+        """Adds a sample of a dispenser. See MeterMonitor.update()."""
+        return self.get_monitor(dispenser_id).update(
+            flowrate, temperature, pressure, duration
+        )
+
+    def update_block(self, dispenser_id, flowrates, temperatures, pressures, duration=1.0):
+        """
+        Adds a block of samples of a dispenser, such as a block received from a stream.
+
+        Returns:
+            - Bit mask of the flags raised by any sample of the block.
+        """
+        update = self.get_monitor(dispenser_id).update
+        flags = 0
+        for flowrate, temperature, pressure in zip(
+            np.asarray(flowrates, dtype=float).tolist(),
+            np.asarray(temperatures, dtype=float).tolist(),
+            np.asarray(pressures, dtype=float).tolist(),
+        ):
+            flags |= update(flowrate, temperature, pressure, duration)
+        return flags
+
+    def get_flagged(self):
+        """Returns the statistics of the dispensers which have raised alarms."""
+        return {
+            dispenser_id: monitor.get_statistics()
+            for dispenser_id, monitor in self.monitors.items()
+            if monitor.alarms
+        }
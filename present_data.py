@@ -11,10 +11,13 @@ import pandas as pd
 # Presents data.
 from collect_data import CollectData
 from hrs_config import HRSConfiguration
+from fill_state import FillState
 from uncertainty_tools import UncertaintyTools
 from correction import Correction
 from simulate_hrs import GenerateFlowData
 from flow_calculations import FlowProperties
+from instrumentation import timed
+from downsampling import PlotDownsampler
 
 
 class PresentData:
@@ -24,10 +27,14 @@ class PresentData:
     calculate uncertainty based on file data(UncertaintyTools), correct the errors (Correction)
     and finally contains methods to present the data.
     """
-    def __init__(self):
+    def __init__(self, result_cache=None):
         """
         As the PresentData object is created, it sets in motion multiple classes, some which
         are used for parameters for others. Furthermore it reads data, and stores it in varaibles.
+
+        Parameters:
+            - result_cache: Optional ResultCache, reusing the evaluated samples of fillings
+              which have not changed since they were last evaluated.
         """
         self.hrs_config = HRSConfiguration()
         self.data_reader = CollectData(self.hrs_config)
@@ -35,7 +42,11 @@ class PresentData:
         self.uncertainty_tools = UncertaintyTools(self.hrs_config, self.correction)
         self.simulator = GenerateFlowData()
         self.flowproperties = FlowProperties()
+        self.fill_state = None
+        self.result_cache = result_cache
+        self.downsampler = PlotDownsampler()
 
+        self.timestamps = None
         self.flowrates_kg_sec = None
         self.flowrate_kgmin_per_second = None
         self.pressures = None
@@ -73,7 +84,8 @@ class PresentData:
         self.k = None
         self.total_relative_fill_unc_k = None # The total filling uncertainty
 
-    def run_simulation(self, k):
+    @timed("present_data.run_simulation")
+    def run_simulation(self, k, sample_interval=None):
         """
         This method is considered the main() function of the simulation of this framework.
         It collects simulation data, and calculates the different uncertainties over this.
@@ -81,26 +93,131 @@ class PresentData:
 
         Parameters:
             - k: Confidence level to perform calculations at
+            - sample_interval: Optional time between samples [s]. When given, the filling
+              is simulated as a timestamped log, which is integrated by the trapezoidal rule.
 
         Returns:
             - None
         """
         self.k = k
+        self.fill_state = FillState()
         # print(vars(self.hrs_config))
         # Flowrate of kg/sec values. Max 0.06kg/s
-        self.flowrates_kg_sec, self.pressures, self.temperatures = (
-            self.simulator.generate_filling_protocol_kg_sec(1)
-        )
+        if sample_interval is None:
+            self.timestamps = None
+            self.flowrates_kg_sec, self.pressures, self.temperatures = (
+                self.simulator.generate_filling_protocol_kg_sec(1)
+            )
+        else:
+            self.timestamps, self.flowrates_kg_sec, self.pressures, self.temperatures = (
+                self.simulator.generate_filling_protocol_timestamped(1, sample_interval)
+            )
 
         # Flowrate of kg/min values, printed each second. Max 3.6
         self.flowrate_kgmin_per_second = [x * 60 for x in self.flowrates_kg_sec]
 
+        self.evaluate_samples()
+        pressure = self.pressures[-1]
+        temperature = self.temperatures[-1]
+        self.mass_uncorrected = self.fill_state.mass_uncorrected
+        # Convert temp and pres to K and Pa for correction format.
+        self.fill_state.set_post_fill_conditions(pressure * 100000, temperature + 273.15)
+
+        # Calculate the total error, vented error and dead volume error in kg.
+        self.total_error, self.vented_error, self.dead_volume_error = (
+            self.correction.calculate_total_correction_error(
+                self.fill_state.pre_fill_pressure,
+                self.fill_state.pre_fill_temp,
+                self.fill_state.post_fill_pressure,
+                self.fill_state.post_fill_temp,
+            )
+        )
+        self.mass_corrected = self.mass_uncorrected - self.total_error
+
+        # Calculate and return the ABSOLUTE vent and dead volume uncertainty.
+        self.vent_abs_unc, self.dv_abs_unc = (
+            self.uncertainty_tools.return_abs_error_data(self.fill_state)
+        )
+        self.present_mass_data(k)
+
+        # Based on the lists, calculate total absolute and relative uncertainties.
+        (
+            self.tot_rel_temp,
+            self.tot_rel_pres,
+            self.tot_rel_ltd,
+            self.tot_rel_vent,
+            self.tot_rel_dv,
+            self.tot_rel_cfm,
+            self.tot_abs_cfm,
+            self.tot_abs_temp,
+            self.tot_abs_press,
+            self.tot_abs_ltd,
+        ) = self.uncertainty_tools.return_total_system_uncs(
+            self.mass_corrected,
+            self.fill_state,
+            self.dv_abs_unc,
+            self.vent_abs_unc,
+        )
+        # Present everything
+        plt.rcParams["font.family"] = "Times New Roman"
+        plt.rcParams.update({"font.size": 14})
+        self.plot_simulation_variables()
+        self.plot_combined_rel_simulation()
+        self.plot_uncertainty_contributions()
+        self.present_mass_correction_table()
+        self.create_bar_chart()
+        self.create_comparison_bars(1)
+        self.create_pie_charts(0.09)
+        self.run_mass_errors()
+
+    @timed("present_data.sample_loop")
+    def evaluate_samples(self):
+        """
+        Calculates the uncertainties of each sample of the simulated filling, and stores
+        them in the class lists and in the fill state. Timestamped fillings are evaluated
+        by the array methods of UncertaintyTools.
+
+        Parameters:
+            - None
+
+        Returns:
+            - None
+        """
+        if self.result_cache is not None:
+            key = self.result_cache.make_key(
+                self.hrs_config,
+                self.flowrate_kgmin_per_second,
+                self.temperatures,
+                self.pressures,
+                self.timestamps,
+                k=self.k,
+            )
+            result = self.result_cache.get(key)
+            if result is not None:
+                self.restore_samples(*result)
+                return
+        if self.timestamps is not None:
+            self.evaluate_timestamped_samples()
+        else:
+            self.run_sample_loop()
+        if self.result_cache is not None:
+            self.result_cache.put(key, *self.collect_samples())
+
+    def run_sample_loop(self):
+        """
+        Calculates the uncertainties of each sample, one sample at a time.
+
+        Parameters:
+            - None
+
+        Returns:
+            - None
+        """
         timer = 0
         index = 0
         print("Simulating mass flow for a HRS with a 95% confidence interval")
 
         for flowrate in self.flowrate_kgmin_per_second:  # For løkke med kg/min verdier.
-            self.mass_uncorrected += flowrate / 60
             temperature = self.temperatures[index]
             pressure = self.pressures[index]
             index += 1
@@ -111,15 +228,15 @@ class PresentData:
             )
             # Get the absolute cfm + temp + press + annual standard uncertainty
             uncertainty_std_total = self.uncertainty_tools.calculate_total_abs_unc_std(
-               flowrate, temperature, pressure
+               flowrate, temperature, pressure, self.fill_state
             )
             # Get the cfm + temp pres annual relative uncertainy
             comb_rel_uncertainty_k = self.uncertainty_tools.calculate_cfm_rel_unc_k(
-                flowrate, temperature, pressure, self.k
+                flowrate, temperature, pressure, self.k, self.fill_state
             )
             # Get the cfm rel uncertainty
             cfm_rel_uncertainty = self.uncertainty_tools.calculate_cfm_rel_unc_k(
-                flowrate, temperature, pressure, self.k, string="CFM"
+                flowrate, temperature, pressure, self.k, self.fill_state, string="CFM"
             )
             # Save to lists
             self.abs_cfm_uncertainties_std.append(uncertainty_std_cfm)
@@ -130,7 +247,7 @@ class PresentData:
             # Calculate contributions per flowrate, and append to respective lists.
             rel_tt, rel_pp, rel_aa, abs_tt, abs_pp, abs_aa = (
                 self.uncertainty_tools.return_misc_press_data(
-                    flowrate, pressure, temperature
+                    flowrate, pressure, temperature, self.fill_state
                 )
             )
             # Add all these contributions to a list.
@@ -140,72 +257,197 @@ class PresentData:
             self.abs_temp_conts.append(abs_tt)
             self.abs_pres_conts.append(abs_pp)
             self.abs_ltd_conts.append(abs_aa)
-            self.hrs_config.previous_temperature = temperature
+            # Add the sample to the running totals of the filling.
+            self.fill_state.record_sample(
+                flowrate,
+                temperature,
+                uncertainty_std_cfm,
+                uncertainty_std_total,
+                abs_tt,
+                abs_pp,
+                abs_aa,
+            )
             # Lastly print info per flow rate.
             #print(
             #    f"Time: {timer} seconds - Flow rate: {np.around(flowrate, 2)} 
             #    kg/min ± {np.around(comb_rel_uncertainty_k,3)}%"
             #)
             timer += 1
-        # Convert temp and pres to K and Pa for correction format.
-        self.correction.post_fill_pressure = pressure * 100000
-        self.correction.post_fill_temp = temperature + 273.15
 
-        # Calculate the total error, vented error and dead volume error in kg.
-        self.total_error, self.vented_error, self.dead_volume_error = (
-            self.correction.calculate_total_correction_error(
-                self.correction.pre_fill_pressure,
-                self.correction.pre_fill_temp,
-                self.correction.post_fill_pressure,
-                self.correction.post_fill_temp,
-            )
+    def collect_samples(self):
+        """
+        Returns the per sample series and the running totals of the filling, in the
+        format stored by the ResultCache.
+        """
+        sample_arrays = {
+            "abs_cfm": self.abs_cfm_uncertainties_std,
+            "abs_total": self.abs_total_uncs_std,
+            "comb_rel_k": self.comb_rel_unc_k,
+            "rel_cfm_k": self.rel_cfm_uncs,
+            "rel_temp": self.rel_temp_conts,
+            "rel_pres": self.rel_pres_conts,
+            "rel_ltd": self.rel_ltd_conts,
+            "abs_temp": self.abs_temp_conts,
+            "abs_pres": self.abs_pres_conts,
+            "abs_ltd": self.abs_ltd_conts,
+        }
+        summary = {
+            "mass_uncorrected": self.fill_state.mass_uncorrected,
+            "tot_abs_cfm": self.fill_state.tot_abs_cfm,
+            "tot_abs_total": self.fill_state.tot_abs_total,
+            "tot_abs_temp": self.fill_state.tot_abs_temp,
+            "tot_abs_press": self.fill_state.tot_abs_press,
+            "tot_abs_ltd": self.fill_state.tot_abs_ltd,
+            "previous_temperature": self.fill_state.previous_temperature,
+        }
+        return sample_arrays, summary
+
+    def restore_samples(self, sample_arrays, summary):
+        """
+        Restores the per sample series and the running totals of the filling from a
+        result stored by the ResultCache.
+        """
+        self.abs_cfm_uncertainties_std = list(sample_arrays["abs_cfm"])
+        self.abs_total_uncs_std = list(sample_arrays["abs_total"])
+        self.comb_rel_unc_k = list(sample_arrays["comb_rel_k"])
+        self.rel_cfm_uncs = list(sample_arrays["rel_cfm_k"])
+        self.rel_temp_conts = list(sample_arrays["rel_temp"])
+        self.rel_pres_conts = list(sample_arrays["rel_pres"])
+        self.rel_ltd_conts = list(sample_arrays["rel_ltd"])
+        self.abs_temp_conts = list(sample_arrays["abs_temp"])
+        self.abs_pres_conts = list(sample_arrays["abs_pres"])
+        self.abs_ltd_conts = list(sample_arrays["abs_ltd"])
+        for name, value in summary.items():
+            setattr(self.fill_state, name, value)
+
+    def collect_fill_summary(self):
+        """
+        Returns the masses, corrections and totaled uncertainties of the simulated filling,
+        in the format of BatchEvaluator.summarize_fill().
+        """
+        return {
+            "k": self.k,
+            "mass_uncorrected": self.mass_uncorrected,
+            "mass_corrected": self.mass_corrected,
+            "total_error": self.total_error,
+            "vented_error": self.vented_error,
+            "dead_volume_error": self.dead_volume_error,
+            "vent_abs_unc": self.vent_abs_unc,
+            "dv_abs_unc": self.dv_abs_unc,
+            "total_relative_fill_unc_k": self.total_relative_fill_unc_k,
+            "tot_rel_temp": self.tot_rel_temp,
+            "tot_rel_pres": self.tot_rel_pres,
+            "tot_rel_ltd": self.tot_rel_ltd,
+            "tot_rel_vent": self.tot_rel_vent,
+            "tot_rel_dv": self.tot_rel_dv,
+            "tot_rel_cfm": self.tot_rel_cfm,
+            "tot_abs_cfm": self.tot_abs_cfm,
+            "tot_abs_temp": self.tot_abs_temp,
+            "tot_abs_press": self.tot_abs_press,
+            "tot_abs_ltd": self.tot_abs_ltd,
+        }
+
+    def export_fill(self, exporter, station_id, fill_id, fill_time):
+        """
+        Appends the samples and the summary of the simulated filling to the datasets of
+        a ColumnarExporter.
+
+        Parameters:
+            - exporter: The ColumnarExporter.
+            - station_id: Identifier of the station.
+            - fill_id: Identifier of the filling.
+            - fill_time: Start time of the filling, as a datetime.
+
+        Returns:
+            - List of the paths written.
+        """
+        sample_arrays, _ = self.collect_samples()
+        inputs = {
+            "flowrate": self.flowrate_kgmin_per_second,
+            "temperature": self.temperatures,
+            "pressure": self.pressures,
+        }
+        return exporter.write_fill(
+            station_id,
+            fill_id,
+            fill_time,
+            inputs,
+            sample_arrays,
+            self.collect_fill_summary(),
+            self.timestamps,
         )
-        self.mass_corrected = self.mass_uncorrected - self.total_error
 
-        # Calculate and return the ABSOLUTE vent and dead volume uncertainty.
-        self.vent_abs_unc, self.dv_abs_unc = (
-            self.uncertainty_tools.return_abs_error_data(
-                self.correction.pre_fill_pressure,
-                self.correction.pre_fill_temp,
-                self.correction.post_fill_pressure,
-                self.correction.post_fill_temp,
-            )
+    def write_excel(self, writer, station_id, fill_id, fill_time):
+        """
+        Appends the summary, and the samples when included, of the simulated filling to
+        an ExcelResultWriter.
+
+        Parameters:
+            - writer: The ExcelResultWriter.
+            - station_id: Identifier of the station.
+            - fill_id: Identifier of the filling.
+            - fill_time: Start time of the filling, as a datetime.
+        """
+        sample_arrays, _ = self.collect_samples()
+        inputs = {
+            "flowrate": self.flowrate_kgmin_per_second,
+            "temperature": self.temperatures,
+            "pressure": self.pressures,
+        }
+        writer.write_fill(
+            station_id,
+            fill_id,
+            fill_time,
+            inputs,
+            sample_arrays,
+            self.collect_fill_summary(),
+            self.timestamps,
         )
-        self.present_mass_data(k)
 
-        # Based on the lists, calculate total absolute and relative uncertainties.
-        (
-            self.tot_rel_temp,
-            self.tot_rel_pres,
-            self.tot_rel_ltd,
-            self.tot_rel_vent,
-            self.tot_rel_dv,
-            self.tot_rel_cfm,
-            self.tot_abs_cfm,
-            self.tot_abs_temp,
-            self.tot_abs_press,
-            self.tot_abs_ltd,
-        ) = self.uncertainty_tools.return_total_system_uncs(
-            self.mass_corrected,
-            self.abs_cfm_uncertainties_std,
-            self.dv_abs_unc,
-            self.vent_abs_unc,
-            self.abs_temp_conts,
-            self.abs_pres_conts,
-            self.abs_ltd_conts,
+    def archive_fill(self, archive, fill_id):
+        """
+        Appends the samples of the simulated filling to a SampleArchive.
+
+        Parameters:
+            - archive: The SampleArchive, opened for appending.
+            - fill_id: Identifier of the filling.
+        """
+        sample_arrays, _ = self.collect_samples()
+        inputs = {
+            "flowrate": self.flowrate_kgmin_per_second,
+            "temperature": self.temperatures,
+            "pressure": self.pressures,
+        }
+        archive.append_fill(fill_id, inputs, sample_arrays, self.timestamps)
+
+    @timed("present_data.sample_arrays")
+    def evaluate_timestamped_samples(self):
+        """
+        Calculates the uncertainties of every sample of a timestamped filling at once,
+        and integrates them over the timestamps by the trapezoidal rule.
+
+        Parameters:
+            - None
+
+        Returns:
+            - None
+        """
+        sample_arrays = self.uncertainty_tools.calculate_sample_arrays(
+            self.flowrate_kgmin_per_second,
+            self.temperatures,
+            self.pressures,
+            self.k,
+            self.fill_state,
         )
-        # Present everything
-        plt.rcParams["font.family"] = "Times New Roman"
-        plt.rcParams.update({"font.size": 14})
-        self.plot_simulation_variables()
-        self.plot_combined_rel_simulation()
-        self.plot_uncertainty_contributions()
-        self.present_mass_correction_table()
-        self.create_bar_chart()
-        self.create_comparison_bars(1)
-        self.create_pie_charts(0.09)
-        self.run_mass_errors()
+        self.fill_state.record_samples(
+            self.flowrate_kgmin_per_second,
+            self.temperatures,
+            sample_arrays,
+            timestamps=self.timestamps,
+        )
+        self.restore_samples(sample_arrays, {})
 
+    @timed("present_data.run_mass_errors")
     def run_mass_errors(self):
         """
         Presents mass errors based on pressures defined within the function. 
@@ -290,6 +532,7 @@ class PresentData:
         the_table.scale(1, 1.4)
         plt.show()
         
+    @timed("present_data.create_bar_chart")
     def create_bar_chart(self):
         """
         Presents the total absolute uncertainties, after they have accumlated over 
@@ -348,6 +591,7 @@ class PresentData:
         plt.ylabel(ylabel)
         plt.title("Absolute uncertainty contributions k=1")
         plt.show()
+    @timed("present_data.create_comparison_bars")
     def create_comparison_bars(self, reference):
         """
         Presentation method utilized to present the difference between the temperature
@@ -392,6 +636,7 @@ class PresentData:
         plt.show()
 
 
+    @timed("present_data.present_mass_correction_table")
     def present_mass_correction_table(self):
         """
         Creates a visual table showing the measured mass, corrections, and uncertainties 
@@ -402,7 +647,9 @@ class PresentData:
         Returns:
             - None
         """
-        total_uncertainty = (self.vent_abs_unc**2 + self.dv_abs_unc**2) ** 0.5
+        total_uncertainty = self.uncertainty_tools.calculate_correction_uncertainty(
+            self.fill_state
+        )
         #print(f"test:Pressure {self.correction.post_fill_pressure} 
         #Vent: {self.vented_error} Vented uncertainty:{self.vent_abs_unc}")
         data = [
@@ -444,6 +691,7 @@ class PresentData:
         ) 
         plt.show()
 
+    @timed("present_data.plot_uncertainty_contributions")
     def plot_uncertainty_contributions(self):
         """
         Plots the relative uncertainties from the filling process over a logarytgmic y-axis.
@@ -475,9 +723,12 @@ class PresentData:
             labels,
             lines,
         ):
+            flowrates = np.asarray(self.flowrate_kgmin_per_second)
+            data = np.asarray(data)
+            index = self.downsampler.lttb(flowrates, data)
             plt.plot(
-                self.flowrate_kgmin_per_second,
-                data,
+                flowrates[index],
+                data[index],
                 label=label,
                 linestyle=line,
                 color=color,
@@ -497,6 +748,7 @@ class PresentData:
         )  
         plt.show()
 
+    @timed("present_data.plot_simulation_variables")
     def plot_simulation_variables(self):
         """
         Plots the simulated flowrate, pressure, and temperature based on the
@@ -513,7 +765,15 @@ class PresentData:
         color = "tab:red"
         ax1.set_xlabel("Time (s)")
         ax1.set_ylabel("Flowrates (kg/min)", color=color)
-        ax1.plot(self.flowrate_kgmin_per_second, color=color)
+        if self.timestamps is None:
+            times = np.arange(len(self.flowrate_kgmin_per_second))
+        else:
+            times = np.asarray(self.timestamps)
+        flowrates = np.asarray(self.flowrate_kgmin_per_second)
+        pressures = np.asarray(self.pressures)
+        temperatures = np.asarray(self.temperatures)
+        index = self.downsampler.lttb(times, flowrates)
+        ax1.plot(times[index], flowrates[index], color=color)
         ax1.tick_params(axis="y", labelcolor=color)
         ax1.set_ylim([0, max(self.flowrate_kgmin_per_second) * 1.1])
 
@@ -521,7 +781,8 @@ class PresentData:
         ax2 = ax1.twinx()
         color = "tab:blue"
         ax2.set_ylabel("Pressures  (bar)", color=color)
-        ax2.plot(self.pressures, color=color)
+        index = self.downsampler.lttb(times, pressures)
+        ax2.plot(times[index], pressures[index], color=color)
         ax2.tick_params(axis="y", labelcolor=color)
         ax2.set_ylim(
             [min(self.pressures) * 0.9, max(self.pressures) * 1.1]
@@ -534,17 +795,20 @@ class PresentData:
         )  # This offsets the temperature axis
         color = "tab:green"
         ax3.set_ylabel("Temperature (°C)", color=color)
-        ax3.plot(self.temperatures, color=color)
+        index = self.downsampler.lttb(times, temperatures)
+        ax3.plot(times[index], temperatures[index], color=color)
         ax3.tick_params(axis="y", labelcolor=color)
         fig.tight_layout()
         plt.title("Flowrates, Pressures, and Temperature vs. Time")
         plt.show()
 
+    @timed("present_data.plot_combined_rel_simulation")
     def plot_combined_rel_simulation(self):
         """
         Plots the flowrate against the combined relative uncertainties. Linear interpolation is
-        performed between the relative uncertainties, and subsequently hid. The values are
-        collected from class parameters.
+        performed between the smallest and largest relative uncertainty per flowrate bucket,
+        so long fillings are drawn without sorting every sample. The values are collected
+        from class parameters.
 
         Parameters:
             - None
@@ -559,27 +823,15 @@ class PresentData:
 
         # Konverter kg/sec til kg/min
         flowrate_kg_min = flowrate_kg_sec * 60
-        n = 1  # Distance between each linear interpolation
-        flowrate_thinned = flowrate_kg_min[::n]
-        uncertainties_thinned = uncertainties_kg_sec_relative[::n]
 
         plt.figure(figsize=(10, 5))
-        plt.scatter(
-            flowrate_thinned,
-            uncertainties_thinned,
-            color="blue",
-            label="Measured Uncertainty",
-            s=10,
-            alpha=0,
-        )
-        plt.scatter(
-            flowrate_thinned, -uncertainties_thinned, color="blue", s=10, alpha=0
-        )
-        # Linear interpolation
-        if len(flowrate_thinned) > 1:
-            sort_index = np.argsort(flowrate_thinned)
-            x_sorted = flowrate_thinned[sort_index]
-            y_sorted = uncertainties_thinned[sort_index]
+        # Linear interpolation, between the extremes of each flowrate bucket
+        if len(flowrate_kg_min) > 1:
+            index = self.downsampler.min_max(
+                flowrate_kg_min, uncertainties_kg_sec_relative
+            )
+            x_sorted = flowrate_kg_min[index]
+            y_sorted = uncertainties_kg_sec_relative[index]
 
             plt.plot(x_sorted, y_sorted, "k--", label="Upper Bound Interpolation")
             plt.plot(x_sorted, -y_sorted, "k--", label="Lower Bound Interpolation")
@@ -591,6 +843,7 @@ class PresentData:
         plt.legend()
         plt.show()
 
+    @timed("present_data.present_mass_data")
     def present_mass_data(self, k):
         """
         This method utilizes different methods to calculate and presents filling data.
@@ -611,15 +864,11 @@ class PresentData:
         self.total_relative_fill_unc_k = (
             self.uncertainty_tools.calculate_total_system_rel_unc_k(
                 self.mass_corrected,
-                self.abs_total_uncs_std,
-                self.correction.pre_fill_pressure,
-                self.correction.pre_fill_temp,
-                self.correction.post_fill_pressure,
-                self.correction.post_fill_temp,
+                self.fill_state,
                 k,
             )
         )
-        tot_cfm = self.uncertainty_tools.calculate_total_combined_unc(self.abs_cfm_uncertainties_std, 1/60)
+        tot_cfm = self.fill_state.tot_abs_cfm
         rel_cfm = ((tot_cfm*100)/self.mass_corrected)*k
 
         # Prints results.
@@ -648,6 +897,7 @@ class PresentData:
         plt.tight_layout()  
         plt.show()
 
+    @timed("present_data.create_pie_charts")
     def create_pie_charts(self, zoom_threshold):
         """
         Create a pie chart, where ecah total relative ucnertainty is shown as a percentage
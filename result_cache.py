@@ -0,0 +1,230 @@
+"""
+This module contains the ResultCache class, a content addressed cache of evaluated
+fillings stored on disk. The key is a hash of the HRS configuration, the sample arrays of
+the filling, the options of the evaluation and the source code of the calculations, so a
+result is reused only when none of them has changed. The values are stored as uncompressed NumPy .npz files.
+
+The cache is bounded in size, evicting the least recently used results. Results are
+written to a temporary file and moved into place, so several processes can share the
+same cache directory without reading partially written results.
+
+Classes:
+    ResultCache
+"""
+import hashlib
+import os
+import tempfile
+import zipfile
+import numpy as np
+from hrs_config import HRSConfiguration
+
+# Modules whose source code affects the cached results. Only the numeric modules are
+# hashed, so changes to the presentation do not invalidate the cache.
+CODE_MODULES = (
+    "hrs_config.py",
+    "fill_state.py",
+    "flow_calculations.py",
+    "correction.py",
+    "dual_numbers.py",
+    "uncertainty_tools.py",
+    "time_integration.py",
+    "batch_evaluator.py",
+    "jit_kernels.py",
+)
+
+
+def get_code_version():
+    """
+    Returns a hash of the source code of the calculations.
+    """
+    program_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for module in CODE_MODULES:
+        with open(os.path.join(program_dir, module), "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    This class stores and retrieves evaluated fillings, as a dictionary of sample arrays
+    and a dictionary of summary values, keyed by the fingerprint of their inputs.
+    """
+
+    def __init__(self, directory, max_bytes=1024**3):
+        """
+        Parameters:
+            - directory: Directory of the cache, created if missing.
+            - max_bytes: Largest total size of the cached results [bytes]
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.code_version = get_code_version()
+        os.makedirs(directory, exist_ok=True)
+
+    def make_key(self, hrs_config: HRSConfiguration, *arrays, **parameters):
+        """
+        Returns the key of a result.
+
+        Parameters:
+            - hrs_config: The HRS configuration used.
+            - *arrays: The input sample arrays, such as flowrates and temperatures.
+            - **parameters: Other inputs, such as the coverage factor.
+
+        Returns:
+            - Hexadecimal key.
+        """
+        digest = hashlib.sha256()
+        digest.update(self.code_version.encode("utf-8"))
+        digest.update(hrs_config.fingerprint().encode("utf-8"))
+        digest.update(repr(sorted(parameters.items())).encode("utf-8"))
+        for array in arrays:
+            if array is None:
+                digest.update(b"None")
+                continue
+            array = np.ascontiguousarray(array, dtype=float)
+            digest.update(repr(array.shape).encode("utf-8"))
+            digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        """Returns the path of the file storing a result."""
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """
+        Retrieves a result, and marks it as recently used.
+
+        Parameters:
+            - key: Key returned by make_key().
+
+        Returns:
+            - Sample arrays and summary dictionaries, or None if the result is not cached.
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as data:
+                sample_arrays = {}
+                summary = {}
+                for name in data.files:
+                    group, field = name.split("/", 1)
+                    if group == "samples":
+                        sample_arrays[field] = data[name]
+                    else:
+                        summary[field] = data[name].item()
+            os.utime(path)
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+            # Missing, evicted by another process, truncated or corrupt.
+            return None
+        return sample_arrays, summary
+
+    def put(self, key, sample_arrays, summary):
+        """
+        Stores a result, and evicts the least recently used results if the cache is full.
+
+        Parameters:
+            - key: Key returned by make_key().
+            - sample_arrays: Dictionary of sample arrays.
+            - summary: Dictionary of numbers.
+        """
+        contents = {
+            "samples/" + name: np.asarray(array) for name, array in sample_arrays.items()
+        }
+        contents.update(
+            {
+                "summary/" + name: np.asarray(value)
+                for name, value in summary.items()
+                if value is not None
+            }
+        )
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as file:
+                np.savez(file, **contents)
+            os.replace(temporary_path, self.get_path(key))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache fits within max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".npz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Already evicted by another process, or in use.
+                pass
+            total -= size
+
+    def evaluate_fill(
+        self,
+        evaluator,
+        flowrates,
+        temperatures,
+        pressures,
+        k,
+        fill_state=None,
+        timestamps=None,
+        decimation_tolerance=None,
+    ):
+        """
+        Returns the cached result of BatchEvaluator.evaluate_fill(), evaluating and
+        storing it if it is not cached. The fill state is only updated when the filling
+        is evaluated, the summary holds the results in both cases. The key includes the
+        options of the evaluator which change the result.
+
+        Parameters:
+            - evaluator: The BatchEvaluator.
+            - Remaining parameters: As for BatchEvaluator.evaluate_fill().
+
+        Returns:
+            - Sample arrays and summary dictionaries.
+        """
+        parameters = {
+            "k": k,
+            "correlated_corrections": evaluator.uncertainty_tools.correlated_corrections,
+            "decimation_tolerance": decimation_tolerance,
+        }
+        if fill_state is not None:
+            parameters["pre_fill"] = (
+                fill_state.pre_fill_pressure,
+                fill_state.pre_fill_temp,
+                fill_state.previous_temperature,
+            )
+        key = self.make_key(
+            evaluator.hrs_config,
+            flowrates,
+            temperatures,
+            pressures,
+            timestamps,
+            **parameters,
+        )
+        result = self.get(key)
+        if result is None:
+            result = evaluator.evaluate_fill(
+                flowrates,
+                temperatures,
+                pressures,
+                k,
+                fill_state,
+                timestamps,
+                decimation_tolerance,
+            )
+            self.put(key, *result)
+        return result
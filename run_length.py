@@ -0,0 +1,454 @@
+"""
+This module contains the CompressedFill class, a run-length representation of the
+samples of a filling. Fillings spend most of their time on plateaus, where the flowrate
+is held at the limit of the dispenser, the temperature at the limit of the pre-cooler,
+and the pressure rises at a constant rate. Each plateau is stored as one run, instead of
+every sample.
+
+Each series is split into straight lines, and the runs are the pieces where no series
+changes line. Sample j of a run is reconstructed as origin + (offset + j) * step, where
+the origin is the first sample of the line, and the offset the position of the run on
+the line. This is the formula of np.linspace, so evenly spaced series are reproduced
+exactly. The encoding is lossless: a line is split wherever the reconstruction is not
+bit for bit equal to the sample, so decode() returns the arrays which were encoded.
+
+Logged samples are rounded to the resolution of the instrument, such as 0.01 bar, so a
+constant ramp is not a straight line bit for bit. Such series are encoded on a declared
+number of decimals: the line is fitted in units of the last decimal, and sample j is
+reconstructed as round(origin + (offset + j) * step, decimals). The reconstruction is
+still checked against every sample, so decode() returns the arrays which were encoded.
+
+The runs are evaluated by UncertaintyTools.calculate_run_totals(), without decoding the
+samples of runs at a constant flowrate.
+
+Classes:
+    CompressedFill
+"""
+import numpy as np
+
+from columnar_export import INPUT_SERIES
+
+
+def get_scales(decimals):
+    """
+    Returns the factor from the unit of each series to the unit of its last decimal, or
+    NaN for a series stored exactly.
+
+    Parameters:
+        - decimals: Number of decimals of each series, None for a series stored exactly.
+    """
+    return np.array([np.nan if places is None else 10.0**places for places in decimals])
+
+
+def quantize(lines, scales):
+    """
+    Rounds the values of lines given in units of the last decimal, and returns them in
+    the units of the series. Series stored exactly are returned unchanged.
+
+    Parameters:
+        - lines: Array of values, one row per series.
+        - scales: Array returned by get_scales().
+    """
+    lines = np.array(lines, dtype=float)
+    for row in np.flatnonzero(~np.isnan(scales)):
+        lines[row] = np.rint(lines[row]) / scales[row]
+    return lines
+
+
+def reconstruct(lengths, origins, offsets, steps, scales=None):
+    """
+    Returns the samples of runs.
+
+    Parameters:
+        - lengths: Array of the number of samples of each run.
+        - origins: Array of the origin of the line of each run, one row per series.
+        - offsets: Array of the position of each run on its line, shaped as origins.
+        - steps: Array of the step per sample of the line of each run, shaped as origins.
+        - scales: Optional array returned by get_scales(), one value per series.
+
+    Returns:
+        - Array of the samples, one row per series.
+    """
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(int(np.sum(lengths))) - np.repeat(starts, lengths)
+    positions = np.repeat(offsets, lengths, axis=-1) + positions
+    lines = np.repeat(origins, lengths, axis=-1) + positions * np.repeat(
+        steps, lengths, axis=-1
+    )
+    if scales is None:
+        return lines
+    return quantize(lines, scales)
+
+
+def fit_lines(values, starts, ends):
+    """
+    Fits straight lines to pieces of a series of whole numbers by least squares, each
+    rounding to the first sample of its piece.
+
+    Parameters:
+        - values: Array of samples.
+        - starts: Array of the first sample of each piece, in increasing order.
+        - ends: Array of the last sample of each piece.
+
+    Returns:
+        - Array of the value of each line at its first sample.
+        - Array of the step per sample of each line.
+    """
+    lengths = ends - starts + 1
+    sample_count = int(np.sum(lengths))
+    pieces = np.repeat(np.arange(len(starts)), lengths)
+    indices = np.arange(sample_count) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    # Positions from the middle of each piece, and values from its first sample, keep
+    # the sums small enough for long pieces.
+    centered = indices - (lengths[pieces] - 1) / 2
+    relative = values[starts[pieces] + indices] - values[starts[pieces]]
+    segments = np.cumsum(lengths) - lengths
+    sums = np.add.reduceat(relative, segments)
+    products = np.add.reduceat(centered * relative, segments)
+    # The sum of the squared centered positions, (n^3 - n) / 12.
+    squares = (lengths.astype(float) ** 3 - lengths) / 12
+    with np.errstate(divide="ignore", invalid="ignore"):
+        steps = np.where(lengths > 1, products / squares, 0.0)
+    origins = values[starts] + sums / lengths - steps * (lengths - 1) / 2
+    # The first sample of a line is never checked, so the line is kept within rounding
+    # of it.
+    origins = np.clip(origins, values[starts] - 0.49, values[starts] + 0.49)
+    # A line through a NaN sample is replaced by a constant line, which is split at the
+    # next sample.
+    finite = np.isfinite(origins) & np.isfinite(steps)
+    origins = np.where(finite, origins, values[starts])
+    steps = np.where(finite, steps, 0.0)
+    return origins, steps
+
+
+def split_lines(values, max_rounds=16, rounded=False):
+    """
+    Splits a series into straight lines, each reconstructed exactly from its origin and
+    its step.
+
+    Parameters:
+        - values: Array of samples.
+        - max_rounds: Number of rounds splitting each line only once, after which the
+          lines are split at every mismatch.
+        - rounded: Whether the samples are whole numbers, reconstructed by rounding the
+          lines. The lines are then fitted by least squares, so the origin of a line is
+          not its first sample, and a line is split where it is furthest from the chord
+          between its first and last sample, instead of at its first mismatch.
+
+    Returns:
+        - Boolean array marking the first sample of each line.
+        - Array of the origin of the line starting at each sample, zero elsewhere.
+        - Array of the step of the line starting at each sample, zero elsewhere.
+    """
+    sample_count = len(values)
+    line_start = np.zeros(sample_count, dtype=bool)
+    line_start[:1] = True
+    # Candidate lines, allowing for the rounding of the samples.
+    second_differences = values[2:] - 2 * values[1:-1] + values[:-2]
+    if rounded:
+        # The second differences of a rounded line are -1, 0 or 1.
+        tolerance = 1.0
+    else:
+        finite = values[np.isfinite(values)]
+        tolerance = 8 * np.spacing(np.max(np.abs(finite))) if len(finite) else 0.0
+    line_start[2:] |= ~(np.abs(second_differences) <= tolerance)
+
+    origins = np.zeros(sample_count)
+    steps = np.zeros(sample_count)
+    new_starts = np.flatnonzero(line_start)
+    for round_number in range(sample_count):
+        starts = np.flatnonzero(line_start)
+        ends = np.append(starts[1:], sample_count) - 1
+        new_ends = ends[np.searchsorted(starts, new_starts)]
+        if rounded:
+            origins[new_starts], steps[new_starts] = fit_lines(
+                values, new_starts, new_ends
+            )
+        else:
+            # New lines are given the step between their first and last sample.
+            lengths = new_ends - new_starts
+            new_steps = (values[new_ends] - values[new_starts]) / np.maximum(lengths, 1)
+            # A step of NaN or infinity would not even reconstruct the first sample.
+            steps[new_starts] = np.where(np.isfinite(new_steps), new_steps, 0.0)
+            origins[new_starts] = values[new_starts]
+        line = np.cumsum(line_start) - 1
+        positions = np.arange(sample_count) - starts[line]
+        reconstructed = origins[starts][line] + positions * steps[starts][line]
+        if rounded:
+            reconstructed = np.rint(reconstructed)
+        mismatch = reconstructed != values
+        # NaN samples never match, and are left as lines of their own.
+        mismatch &= ~line_start
+        indices = np.flatnonzero(mismatch)
+        if len(indices) == 0:
+            break
+        if round_number < max_rounds:
+            first = np.ones(len(indices), dtype=bool)
+            first[1:] = line[indices[1:]] != line[indices[:-1]]
+            indices = indices[first]
+            if rounded:
+                # The least squares line of a piece with a corner misses near its start,
+                # so the piece is split at the corner, and both parts are fitted again.
+                indices = split_at_corners(
+                    values, starts, ends, line, positions, indices
+                )
+                new_starts = np.union1d(starts[line[indices]], indices)
+                line_start[indices] = True
+                continue
+        line_start[indices] = True
+        new_starts = indices
+    return line_start, origins, steps
+
+
+def split_at_corners(values, starts, ends, line, positions, first_mismatches):
+    """
+    Returns where to split the lines of a series with a mismatch: at the sample furthest
+    from the chord between the first and last sample of the line, where the line has a
+    corner, or else at the first mismatch.
+
+    Parameters:
+        - values: Array of samples.
+        - starts, ends: Arrays of the first and last sample of each line.
+        - line: Array of the line of each sample.
+        - positions: Array of the position of each sample within its line.
+        - first_mismatches: Array of the first mismatch of each line with a mismatch.
+
+    Returns:
+        - Array of the samples starting new lines.
+    """
+    slopes = (values[ends] - values[starts]) / np.maximum(ends - starts, 1)
+    deviations = np.abs(values[starts][line] + positions * slopes[line] - values)
+    # NaN samples are split from the line, and the first sample is never split.
+    deviations = np.where(np.isnan(deviations), np.inf, deviations)
+    deviations[starts] = -1.0
+    mismatched = line[first_mismatches]
+    largest = np.maximum.reduceat(deviations, starts)[mismatched]
+    corners = np.empty(len(mismatched), dtype=np.int64)
+    for position, (start, end, deviation) in enumerate(
+        zip(starts[mismatched], ends[mismatched], largest)
+    ):
+        matches = deviations[start : end + 1] == deviation
+        corners[position] = start + int(np.argmax(matches))
+    # The samples of a rounded line are within one unit of its chord, so a line only has
+    # a corner further away.
+    return np.where(largest > 1, corners, first_mismatches)
+
+
+class CompressedFill:
+    """
+    This class holds the runs of a filling sampled at a constant interval. Timestamped
+    fillings are evaluated from their samples, by BatchEvaluator.evaluate_fill().
+    """
+
+    def __init__(self, lengths, origins, offsets, steps, decimals=None):
+        """
+        Parameters:
+            - lengths: Array of the number of samples of each run.
+            - origins: Array of the origin of the line of each run, with a row for the
+              flowrate [kg/min], temperature [C] and pressure [bar].
+            - offsets: Array of the position of each run on its line, shaped as origins.
+            - steps: Array of the step per sample of the line of each run, shaped as
+              origins.
+            - decimals: Number of decimals of each series, None for a series stored
+              exactly. The origins and steps of a series with decimals are given in
+              units of its last decimal. Defaults to every series stored exactly.
+        """
+        shape = (len(INPUT_SERIES), -1)
+        if decimals is None:
+            decimals = (None,) * len(INPUT_SERIES)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.origins = np.asarray(origins, dtype=float).reshape(shape)
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(shape)
+        self.steps = np.asarray(steps, dtype=float).reshape(shape)
+        self.decimals = tuple(
+            None if places is None else int(places) for places in decimals
+        )
+        self.scales = get_scales(self.decimals)
+
+    @classmethod
+    def encode(cls, flowrates, temperatures, pressures, decimals=None):
+        """
+        Encodes the samples of a filling.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - Decimals: Optional number of decimals each series is logged with, such as
+              (3, 1, 2), None for a series stored exactly. Every sample of such a series
+              must be rounded to its decimals.
+
+        Returns:
+            - The CompressedFill of the samples.
+        """
+        if decimals is None:
+            decimals = (None,) * len(INPUT_SERIES)
+        scales = get_scales(decimals)
+        values = np.vstack(
+            (
+                np.asarray(flowrates, dtype=float),
+                np.asarray(temperatures, dtype=float),
+                np.asarray(pressures, dtype=float),
+            )
+        )
+        for row in np.flatnonzero(~np.isnan(scales)):
+            series = values[row].copy()
+            values[row] = np.rint(series * scales[row])
+            if not np.all((values[row] / scales[row] == series) | np.isnan(series)):
+                raise ValueError(
+                    f"The {INPUT_SERIES[row]} series is not rounded to "
+                    f"{decimals[row]} decimals."
+                )
+        sample_count = values.shape[1]
+        if sample_count == 0:
+            empty = np.empty((len(INPUT_SERIES), 0))
+            return cls(np.empty(0), empty, empty, empty, decimals)
+
+        lines = [
+            split_lines(series, rounded=not np.isnan(scale))
+            for series, scale in zip(values, scales)
+        ]
+        run_start = np.logical_or.reduce([line_start for line_start, _, _ in lines])
+        starts = np.flatnonzero(run_start)
+        origins = np.empty((len(INPUT_SERIES), len(starts)))
+        offsets = np.empty((len(INPUT_SERIES), len(starts)), dtype=np.int64)
+        steps = np.empty((len(INPUT_SERIES), len(starts)))
+        for row, (line_start, line_origins, line_steps) in enumerate(lines):
+            line_starts = np.flatnonzero(line_start)
+            first = line_starts[np.searchsorted(line_starts, starts, side="right") - 1]
+            origins[row] = line_origins[first]
+            offsets[row] = starts - first
+            steps[row] = line_steps[first]
+        lengths = np.diff(np.append(starts, sample_count))
+        return cls(lengths, origins, offsets, steps, decimals)
+
+    def decode(self):
+        """
+        Returns:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+        """
+        flowrates, temperatures, pressures = reconstruct(
+            self.lengths, self.origins, self.offsets, self.steps, self.scales
+        )
+        return flowrates, temperatures, pressures
+
+    def get_sample_count(self):
+        """Returns the number of samples of the filling."""
+        return int(np.sum(self.lengths))
+
+    def get_run_count(self):
+        """Returns the number of runs of the filling."""
+        return len(self.lengths)
+
+    def get_run_values(self, runs, positions, rounded=True):
+        """
+        Returns samples of runs, as reconstructed by decode().
+
+        Parameters:
+            - runs: Array of the index of the run of each sample.
+            - positions: Array of the position of each sample within its run.
+            - rounded: Whether the series with decimals are rounded, or given on their
+              lines.
+
+        Returns:
+            - Array of the samples, one row per series.
+        """
+        lines = (
+            self.origins[:, runs]
+            + (self.offsets[:, runs] + positions) * self.steps[:, runs]
+        )
+        if rounded:
+            return quantize(lines, self.scales)
+        return lines / self.get_units(np.ndim(lines))
+
+    def get_units(self, ndim=2):
+        """
+        Returns the size of the unit of the lines of each series, in the unit of the
+        series, shaped to divide arrays with one row per series.
+        """
+        units = np.where(np.isnan(self.scales), 1.0, self.scales)
+        return units.reshape((-1,) + (1,) * (ndim - 1))
+
+    def get_steps(self):
+        """Returns the step per sample of the line of each run, in the series unit."""
+        return self.steps / self.get_units()
+
+    def get_changes(self):
+        """
+        Returns whether the samples after the first of each run differ from the sample
+        before them, as counted by the temperature effect of
+        calculate_abs_temp_per_sample().
+
+        Returns:
+            - Array with one row per series, and for each run 0 when no sample after the
+              first differs from the sample before it, 1 when every one differs, and -1
+              when only some differ.
+        """
+        changes = np.where(self.steps != 0, 1, 0)
+        for row in np.flatnonzero(~np.isnan(self.scales)):
+            step = np.abs(self.steps[row])
+            # Lines rising by less than a unit per sample change the rounded sample by
+            # one unit or not at all, so the changes are counted from the ends of the
+            # run. Lines rising by two units or more change it at every sample, with a
+            # margin for the rounding of the lines.
+            first = self.origins[row] + self.offsets[row] * self.steps[row]
+            last = first + (self.lengths - 1) * self.steps[row]
+            changed = np.abs(np.rint(last) - np.rint(first))
+            slow = np.where(
+                changed == 0, 0, np.where(changed == self.lengths - 1, 1, -1)
+            )
+            changes[row] = np.where(
+                step == 0, 0, np.where(step < 0.9, slow, np.where(step > 3, 1, -1))
+            )
+        return changes
+
+    def get_values(self, positions):
+        """
+        Returns samples of each run, as reconstructed by decode().
+
+        Parameters:
+            - positions: Array of the position of a sample within each run.
+
+        Returns:
+            - Array of the samples, one row per series.
+        """
+        return self.get_run_values(np.arange(len(self.lengths)), positions)
+
+    def get_first_values(self):
+        """Returns the first sample of each run, one row per series."""
+        return self.get_values(0)
+
+    def get_last_values(self):
+        """Returns the last sample of each run, one row per series."""
+        return self.get_values(self.lengths - 1)
+
+    def save(self, path):
+        """Saves the runs to an uncompressed NumPy .npz file."""
+        np.savez(
+            path,
+            lengths=self.lengths,
+            origins=self.origins,
+            offsets=self.offsets,
+            steps=self.steps,
+            decimals=[np.nan if places is None else places for places in self.decimals],
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Returns the CompressedFill saved to a file by save()."""
+        with np.load(path) as data:
+            decimals = None
+            if "decimals" in data.files:
+                decimals = [
+                    None if np.isnan(places) else int(places)
+                    for places in data["decimals"]
+                ]
+            return cls(
+                data["lengths"],
+                data["origins"],
+                data["offsets"],
+                data["steps"],
+                decimals,
+            )
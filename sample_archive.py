@@ -0,0 +1,252 @@
+"""
+This module contains the SampleArchive class, an append-only binary archive of the per
+sample breakdown of evaluated fillings. Every sample is stored as a fixed-width record of
+its inputs and the ten series returned by calculate_sample_arrays(), and a separate index
+maps each fill ID to the offset and length of its records. Both files are opened with
+np.memmap, so the series of any filling are sliced from the archive without copying or
+parsing, and months of fillings are kept on disk instead of in memory.
+
+A single writer appends the records of a filling before its index entry, so readers never
+see an index entry whose records are incomplete, and read the archive without locks. The
+files are little-endian, and can be shared between machines.
+
+Classes:
+    SampleArchive
+"""
+import json
+import os
+import threading
+import numpy as np
+
+from columnar_export import INPUT_SERIES
+
+# The series returned by calculate_sample_arrays(), in the order they are stored.
+SAMPLE_SERIES = (
+    "abs_cfm",
+    "abs_total",
+    "comb_rel_k",
+    "rel_cfm_k",
+    "rel_temp",
+    "rel_pres",
+    "rel_ltd",
+    "abs_temp",
+    "abs_pres",
+    "abs_ltd",
+)
+
+# One record per sample. The time is NaN for fillings without timestamps.
+RECORD_DTYPE = np.dtype(
+    [("time_s", "<f8")] + [(name, "<f8") for name in INPUT_SERIES + SAMPLE_SERIES]
+)
+
+# One entry per filling: the fill ID, and the offset and length in records.
+INDEX_DTYPE = np.dtype([("fill_id", "S64"), ("offset", "<i8"), ("length", "<i8")])
+
+FORMAT_VERSION = 1
+
+
+class SampleArchive:
+    """
+    This class appends fillings to an archive directory and reads their samples as views
+    of the memory mapped files. The directory holds samples.bin, index.bin and
+    format.json, which describes the record layout.
+    """
+
+    def __init__(self, directory, mode="r"):
+        """
+        Parameters:
+            - directory: Directory of the archive. Created if missing when appending.
+            - mode: "r" to read, or "a" to append fillings and read.
+        """
+        if mode not in ("r", "a"):
+            raise ValueError(f"Unknown mode: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.data_path = os.path.join(directory, "samples.bin")
+        self.index_path = os.path.join(directory, "index.bin")
+        self.lock = threading.Lock()
+        if mode == "a":
+            os.makedirs(directory, exist_ok=True)
+            self.check_format(create=True)
+            self.recover()
+        else:
+            self.check_format(create=False)
+        self.data = None
+        self.index_count = 0
+        # Fill ID: (offset, length), the latest entry of a fill ID replacing earlier ones.
+        self.index = {}
+        self.refresh()
+
+    def get_format(self):
+        """Returns the description of the record layout, stored in format.json."""
+        return {
+            "version": FORMAT_VERSION,
+            "record": [list(field) for field in RECORD_DTYPE.descr],
+            "index": [list(field) for field in INDEX_DTYPE.descr],
+        }
+
+    def check_format(self, create):
+        """
+        Checks that the archive uses the record layout of this module, writing the
+        layout of a new archive when create is True.
+        """
+        path = os.path.join(self.directory, "format.json")
+        if not os.path.exists(path):
+            if not create:
+                raise FileNotFoundError(f"No sample archive in {self.directory}")
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(self.get_format(), file, indent=2)
+            return
+        with open(path, encoding="utf-8") as file:
+            stored = json.load(file)
+        if stored != self.get_format():
+            raise ValueError(f"The archive in {self.directory} has a different format.")
+
+    def recover(self):
+        """
+        Removes the data of an append which was interrupted before its index entry was
+        written, so the next filling is appended directly after the indexed records.
+        """
+        for path in (self.data_path, self.index_path):
+            if not os.path.exists(path):
+                open(path, "wb").close()
+        index_count = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        end = 0
+        if index_count:
+            entries = np.fromfile(self.index_path, dtype=INDEX_DTYPE, count=index_count)
+            end = int(np.max(entries["offset"] + entries["length"]))
+        with open(self.index_path, "r+b") as file:
+            file.truncate(index_count * INDEX_DTYPE.itemsize)
+        with open(self.data_path, "r+b") as file:
+            file.truncate(end * RECORD_DTYPE.itemsize)
+
+    def refresh(self):
+        """
+        Reads the index entries appended since the last refresh, and maps the records
+        they reference. Called by the reading methods, so fillings appended by a writer
+        in another process become visible.
+        """
+        with self.lock:
+            if not os.path.exists(self.index_path):
+                return
+            index_count = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+            if index_count == self.index_count:
+                return
+            entries = np.memmap(
+                self.index_path, dtype=INDEX_DTYPE, mode="r", shape=(index_count,)
+            )[self.index_count :]
+            for fill_id, offset, length in entries.tolist():
+                self.index[fill_id.decode("utf-8")] = (offset, length)
+            self.index_count = index_count
+            end = int(np.max(entries["offset"] + entries["length"]))
+            if end and (self.data is None or len(self.data) < end):
+                # The records of every indexed filling are written, so the data file
+                # is at least as long as the end of the latest entry.
+                self.data = np.memmap(
+                    self.data_path,
+                    dtype=RECORD_DTYPE,
+                    mode="r",
+                    shape=(os.path.getsize(self.data_path) // RECORD_DTYPE.itemsize,),
+                )
+
+    def make_records(self, inputs, sample_arrays, timestamps=None):
+        """
+        Creates the records of the samples of a filling.
+
+        Parameters:
+            - inputs: Dictionary with the flowrate [kg/min], temperature [C] and pressure
+              [bar] arrays of the samples.
+            - sample_arrays: Dictionary of arrays, as returned by calculate_sample_arrays()
+            - timestamps: Optional array of sample times [s]
+
+        Returns:
+            - Structured array of RECORD_DTYPE.
+        """
+        records = np.empty(len(inputs["flowrate"]), dtype=RECORD_DTYPE)
+        records["time_s"] = np.nan if timestamps is None else timestamps
+        for name in INPUT_SERIES:
+            records[name] = inputs[name]
+        for name in SAMPLE_SERIES:
+            records[name] = sample_arrays[name]
+        return records
+
+    def append_fills(self, fills):
+        """
+        Appends fillings to the archive, writing every record before the index entries.
+        Appending a fill ID which is already archived replaces it for the readers.
+
+        Parameters:
+            - fills: List of (fill id, inputs, sample arrays, timestamps or None), as
+              described in make_records().
+        """
+        if self.mode != "a":
+            raise PermissionError("The archive is opened for reading.")
+        blocks = []
+        entries = np.empty(len(fills), dtype=INDEX_DTYPE)
+        with self.lock:
+            offset = os.path.getsize(self.data_path) // RECORD_DTYPE.itemsize
+            for entry, (fill_id, inputs, sample_arrays, timestamps) in zip(entries, fills):
+                encoded = str(fill_id).encode("utf-8")
+                if len(encoded) > INDEX_DTYPE["fill_id"].itemsize:
+                    raise ValueError(f"Fill ID is longer than 64 bytes: {fill_id}")
+                records = self.make_records(inputs, sample_arrays, timestamps)
+                entry["fill_id"] = encoded
+                entry["offset"] = offset
+                entry["length"] = len(records)
+                offset += len(records)
+                blocks.append(records)
+            with open(self.data_path, "ab") as file:
+                for records in blocks:
+                    file.write(records.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            with open(self.index_path, "ab") as file:
+                file.write(entries.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+
+    def append_fill(self, fill_id, inputs, sample_arrays, timestamps=None):
+        """Appends a single filling. See append_fills()."""
+        self.append_fills([(fill_id, inputs, sample_arrays, timestamps)])
+
+    def get_fill_ids(self):
+        """Returns the IDs of the archived fillings, in the order they were appended."""
+        self.refresh()
+        return list(self.index)
+
+    def contains(self, fill_id):
+        """Returns whether a filling is archived."""
+        self.refresh()
+        return str(fill_id) in self.index
+
+    def get_fill(self, fill_id):
+        """
+        Returns the records of a filling, as a read-only view of the archive. A series is
+        selected by its name, such as get_fill(fill_id)["abs_total"].
+
+        Parameters:
+            - fill_id: Identifier of the filling.
+
+        Returns:
+            - Structured array of RECORD_DTYPE.
+        """
+        self.refresh()
+        offset, length = self.index[str(fill_id)]
+        if length == 0:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return self.data[offset : offset + length]
+
+    def get_series(self, fill_id, names=SAMPLE_SERIES):
+        """
+        Returns series of a filling in the format of calculate_sample_arrays(), as views
+        of the archive.
+
+        Parameters:
+            - fill_id: Identifier of the filling.
+            - names: Names of the series.
+
+        Returns:
+            - Dictionary of arrays.
+        """
+        records = self.get_fill(fill_id)
+        return {name: records[name] for name in names}
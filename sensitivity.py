@@ -0,0 +1,252 @@
+"""
+This module contains a global sensitivity analysis of the corrected mass of a filling,
+giving the first and total order Sobol indices of every uncertain input. The pie and bar
+charts of PresentData show the share of each contribution in the totaled budget, which
+only describes the first order effects. The Sobol indices also capture the interactions,
+such as between the dead volume and the densities of the pre- and post-fill conditions.
+
+The indices are estimated by the sampling scheme of Saltelli, with the first order
+estimator of Saltelli (2010) and the total order estimator of Jansen. The model is
+evaluated for whole sample matrices at once with NumPy, and the matrices may be split
+into chunks evaluated by a process pool.
+
+Classes:
+    CorrectedMassModel
+    SobolAnalysis
+Functions:
+    evaluate_chunk: Evaluates a chunk of samples, run by the process pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from hrs_config import HRSConfiguration
+from fill_state import FillState
+from correction import Correction
+from uncertainty_tools import UncertaintyTools
+from instrumentation import timed
+
+
+class CorrectedMassModel:
+    """
+    This class models the corrected mass of a filling as a function of its uncertain
+    inputs. The meter components are given as the error they cause in the measured mass,
+    fully correlated over the filling. The pre- and post-fill conditions and the volumes
+    enter the dead volume and vent corrections.
+    """
+
+    def __init__(
+        self,
+        hrs_config: HRSConfiguration,
+        flowrates,
+        temperatures,
+        pressures,
+        fill_state: FillState = None,
+        formatting=1 / 60,
+    ):
+        """
+        Parameters:
+            - hrs_config: The HRS configuration.
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - Fill state: State of the filling, holding the pre-fill conditions.
+            - Formatting: Duration of each sample [min]
+        """
+        if fill_state is None:
+            fill_state = FillState()
+        self.correction = Correction(hrs_config)
+        uncertainty_tools = UncertaintyTools(hrs_config, self.correction)
+        flowrates = np.asarray(flowrates, dtype=float)
+        components = uncertainty_tools.calculate_component_arrays(
+            flowrates, temperatures, pressures, fill_state
+        )
+        flowing = flowrates != 0
+        self.measured_mass = float(np.sum(flowrates)) * formatting
+
+        post_press = float(pressures[-1]) * 100000
+        post_temp = float(temperatures[-1]) + 273.15
+        pre_press = fill_state.pre_fill_pressure
+        pre_temp = fill_state.pre_fill_temp
+        dead_volume_unc = (
+            hrs_config.get_dead_volume_uncertainty()
+            if hrs_config.correct_for_dead_volume_bool
+            else 0.0
+        )
+        vent_volume_unc = (
+            hrs_config.get_depressurization_vent_volume_unc()
+            if hrs_config.correct_for_depress_bool
+            else 0.0
+        )
+        # Name, nominal value and standard uncertainty of each input.
+        self.inputs = [
+            (
+                name,
+                0.0,
+                abs(float(np.sum(np.where(flowing, values, 0.0)))) * formatting,
+            )
+            for name, values in components.items()
+        ]
+        self.inputs += [
+            ("pre_fill_pressure", pre_press, hrs_config.get_pressure_uncertainty(pre_press)),
+            ("pre_fill_temp", pre_temp, hrs_config.get_temperature_uncertainty(pre_temp)),
+            ("post_fill_pressure", post_press, hrs_config.get_pressure_uncertainty(post_press)),
+            ("post_fill_temp", post_temp, hrs_config.get_temperature_uncertainty(post_temp)),
+            ("dead_volume", hrs_config.get_dead_volume(), dead_volume_unc),
+            ("vent_volume", hrs_config.get_depressurization_vent_volume(), vent_volume_unc),
+        ]
+        self.meter_count = len(components)
+
+    def get_names(self):
+        """Returns the names of the inputs, in the order of the sample columns."""
+        return [name for name, _, _ in self.inputs]
+
+    def sample(self, sample_count, rng):
+        """
+        Draws samples of the inputs, as independent normal distributions.
+
+        Parameters:
+            - Sample count: Number of samples.
+            - rng: NumPy random generator.
+
+        Returns:
+            - Array of samples, with one column per input.
+        """
+        nominal = np.array([value for _, value, _ in self.inputs], dtype=float)
+        std = np.array([value for _, _, value in self.inputs], dtype=float)
+        return nominal + std * rng.standard_normal((sample_count, len(self.inputs)))
+
+    def evaluate(self, samples):
+        """
+        Evaluates the corrected mass for every row of a sample matrix.
+
+        Parameters:
+            - Samples: Array of samples, with one column per input.
+
+        Returns:
+            - Array of corrected masses [kg]
+        """
+        meter_error = np.sum(samples[:, : self.meter_count], axis=1)
+        (
+            pre_press,
+            pre_temp,
+            post_press,
+            post_temp,
+            dead_volume,
+            vent_volume,
+        ) = samples[:, self.meter_count :].T
+        density = self.correction.flow_properties.calculate_hydrogen_density
+        prev_density = density(pre_press, pre_temp)
+        curr_density = density(post_press, post_temp)
+        dv_mass_error = self.correction.calculate_dead_volume_mass_error(
+            prev_density, curr_density, dead_volume
+        )
+        vented_mass = self.correction.calculate_vented_mass_error(vent_volume, curr_density)
+        return self.measured_mass + meter_error - dv_mass_error - vented_mass
+
+
+def evaluate_chunk(model, samples):
+    """
+    Evaluates a chunk of samples. Defined at module level, so it can be run by a
+    process pool.
+    """
+    return model.evaluate(samples)
+
+
+class SobolAnalysis:
+    """
+    This class estimates the first and total order Sobol indices of the inputs of a
+    CorrectedMassModel.
+    """
+
+    def __init__(self, model: CorrectedMassModel, max_workers=None, chunk_size=65536):
+        """
+        Parameters:
+            - model: The CorrectedMassModel.
+            - max_workers: Number of processes evaluating the chunks. With None, every
+              chunk is evaluated in this process.
+            - chunk_size: Number of samples per chunk.
+        """
+        self.model = model
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+
+    def evaluate(self, samples):
+        """
+        Evaluates a sample matrix in chunks, in this process or in the process pool.
+
+        Parameters:
+            - Samples: Array of samples, with one column per input.
+
+        Returns:
+            - Array of corrected masses [kg]
+        """
+        chunks = [
+            samples[start : start + self.chunk_size]
+            for start in range(0, len(samples), self.chunk_size)
+        ]
+        if self.max_workers is None or len(chunks) == 1:
+            results = [self.model.evaluate(chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(
+                    executor.map(evaluate_chunk, [self.model] * len(chunks), chunks)
+                )
+        return np.concatenate(results)
+
+    @timed("sensitivity.sobol")
+    def analyze(self, sample_count=10000, seed=None):
+        """
+        Estimates the Sobol indices from sample_count * (inputs + 2) model evaluations.
+        Two independent sample matrices A and B are drawn, and for each input j the
+        matrix AB_j equals A with column j taken from B. The indices are
+            - First order (Saltelli): S_j = mean(f(B) * (f(AB_j) - f(A))) / V
+            - Total order (Jansen): ST_j = mean((f(A) - f(AB_j))^2) / (2 * V)
+        where V is the variance of f(A) and f(B).
+
+        Parameters:
+            - Sample count: Number of rows of the A and B matrices.
+            - Seed: Optional seed of the random generator.
+
+        Returns:
+            - Dictionary with:
+                - "names": List of the input names.
+                - "first_order", "total_order": Arrays of the indices of each input.
+                - "mean", "variance": Mean [kg] and variance [kg2] of the corrected mass.
+                - "evaluations": Number of model evaluations.
+        """
+        rng = np.random.default_rng(seed)
+        matrix_a = self.model.sample(sample_count, rng)
+        matrix_b = self.model.sample(sample_count, rng)
+        input_count = matrix_a.shape[1]
+        # Every matrix is stacked, to be evaluated in one pass.
+        stacked = np.empty(((input_count + 2) * sample_count, input_count))
+        stacked[:sample_count] = matrix_a
+        stacked[sample_count : 2 * sample_count] = matrix_b
+        for column in range(input_count):
+            start = (column + 2) * sample_count
+            block = stacked[start : start + sample_count]
+            block[:] = matrix_a
+            block[:, column] = matrix_b[:, column]
+        outputs = self.evaluate(stacked).reshape(input_count + 2, sample_count)
+        mean = float(np.mean(outputs[:2]))
+        # Centering the outputs reduces the variance of the first order estimator.
+        outputs = outputs - mean
+        output_a = outputs[0]
+        output_b = outputs[1]
+        output_ab = outputs[2:]
+
+        variance = np.var(outputs[:2])
+        if variance == 0:
+            first_order = np.zeros(input_count)
+            total_order = np.zeros(input_count)
+        else:
+            first_order = np.mean(output_b * (output_ab - output_a), axis=1) / variance
+            total_order = np.mean(np.square(output_a - output_ab), axis=1) / (2 * variance)
+        return {
+            "names": self.model.get_names(),
+            "first_order": first_order,
+            "total_order": total_order,
+            "mean": mean,
+            "variance": float(variance),
+            "evaluations": len(stacked),
+        }
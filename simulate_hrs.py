@@ -5,7 +5,9 @@ g/s, kg/min, and kg/hr.
 Classes:
     GenerateFlowData
 """
+import time
 import numpy as np
+from instrumentation import timed
 
 class GenerateFlowData:
     """
@@ -20,6 +22,7 @@ class GenerateFlowData:
         self.temp_increments = 1
 
 
+    @timed("simulate_hrs.generate_profile")
     def generate_filling_protocol_kg_sec(self, vehicle_tank_size_kg):
         """ 
         This method generates flow rates similar to those seen in a HRS, in the
@@ -48,4 +51,82 @@ class GenerateFlowData:
             temps.append(temp)
             mass_delivered += flowrate
         pressures = np.linspace(0, 700, len(flowrates))
-        return flowrates, pressures, temps
\ No newline at end of file
+        return flowrates, pressures, temps
+
+    @timed("simulate_hrs.generate_profile")
+    def generate_filling_protocol_timestamped(self, vehicle_tank_size_kg, sample_interval=1):
+        """
+        Generates the same filling protocol as generate_filling_protocol_kg_sec(), sampled
+        at a given interval, such as the 10-100 Hz of a Coriolis meter log. The filling
+        starts without flow at time zero, and the mass delivered is integrated by the
+        trapezoidal rule. The samples are generated as arrays.
+
+        Parameters:
+            - Vehicle tank size kg: The capacity of the tank to be filled.
+            - Sample interval: Time between the samples [s]
+
+        Returns:
+            - Timestamps: Time of each sample [s]
+            - Flowrates: Flowrates [kg/s]
+            - Pressures: Pressures [bar]
+            - Temperatures: Temperatures [C]
+        """
+        ramp_time = self.max_flowrate_kg_s / self.flowrate_increments
+        fill_time = ramp_time + vehicle_tank_size_kg / self.max_flowrate_kg_s
+        sample_count = int(np.ceil(fill_time / sample_interval)) + 2
+        timestamps = np.arange(sample_count) * sample_interval
+
+        flowrates = np.minimum(timestamps * self.flowrate_increments, self.max_flowrate_kg_s)
+        temps = np.maximum(
+            self.start_temperature - timestamps * self.temp_increments,
+            self.negative_temp_limit,
+        )
+        mass_delivered = np.concatenate(
+            ([0], np.cumsum((flowrates[1:] + flowrates[:-1]) / 2 * sample_interval))
+        )
+        sample_count = int(np.searchsorted(mass_delivered, vehicle_tank_size_kg)) + 1
+        sample_count = min(sample_count, len(timestamps))
+        pressures = np.linspace(0, 700, sample_count)
+        return (
+            timestamps[:sample_count],
+            flowrates[:sample_count],
+            pressures,
+            temps[:sample_count],
+        )
+
+    def stream_filling_protocol(
+        self, vehicle_tank_size_kg, sample_interval=1, block_size=1, realtime=False
+    ):
+        """
+        Streams the timestamped filling protocol in blocks of samples, acting as a local
+        source for consumers of live meter data, such as the LiveDashboard.
+
+        Parameters:
+            - Vehicle tank size kg: The capacity of the tank to be filled.
+            - Sample interval: Time between the samples [s]
+            - Block size: Number of samples per block.
+            - Realtime: If True, each block is yielded when its last sample would have
+              been measured, instead of as fast as possible.
+
+        Yields:
+            - Timestamps, flowrates, pressures and temperatures of a block, as returned by
+              generate_filling_protocol_timestamped()
+        """
+        timestamps, flowrates, pressures, temps = (
+            self.generate_filling_protocol_timestamped(vehicle_tank_size_kg, sample_interval)
+        )
+        start_time = time.monotonic()
+        for start in range(0, len(timestamps), block_size):
+            end = start + block_size
+            if realtime:
+                delay = timestamps[min(end, len(timestamps)) - 1] - (
+                    time.monotonic() - start_time
+                )
+                if delay > 0:
+                    time.sleep(delay)
+            yield (
+                timestamps[start:end],
+                flowrates[start:end],
+                pressures[start:end],
+                temps[start:end],
+            )
@@ -0,0 +1,329 @@
+"""
+This module contains mergeable summaries of the distribution of fill results, for
+fleet-wide statistics over any number of fillings in constant memory. Each worker
+summarizes the fillings it evaluates, and only the summaries are sent back and merged,
+instead of every filling.
+
+The quantiles are estimated by a KLL sketch (Karnin, Lang and Liberty, 2016), which keeps
+a hierarchy of compactors where an item at level h represents 2^h values. A full
+compactor is sorted and every other item, from a random offset, is promoted to the next
+level. The rank error is about 1.7 / k of the number of values, for a sketch of O(k)
+items. The moments are accumulated as a count, mean and central moment sums, merged by
+the formulas of Pebay (2008).
+
+Classes:
+    MomentAccumulator
+    KLLSketch
+    FillDistribution
+Functions:
+    summarize_fills: Evaluates fillings into a FillDistribution, run by a process pool.
+"""
+import math
+import numpy as np
+
+from hrs_config import HRSConfiguration
+from batch_evaluator import BatchEvaluator
+
+
+class MomentAccumulator:
+    """
+    This class accumulates the count, minimum, maximum, mean, and the second to fourth
+    central moment sums of a series of values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    def add_array(self, values):
+        """Adds an array of values, by merging their moments."""
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values) == 0:
+            return
+        batch = MomentAccumulator()
+        batch.count = len(values)
+        batch.mean = float(np.mean(values))
+        deviations = values - batch.mean
+        squared = np.square(deviations)
+        batch.m2 = float(np.sum(squared))
+        batch.m3 = float(np.dot(squared, deviations))
+        batch.m4 = float(np.dot(squared, squared))
+        batch.minimum = float(np.min(values))
+        batch.maximum = float(np.max(values))
+        self.merge(batch)
+
+    def add(self, value):
+        """Adds a single value."""
+        self.add_array([value])
+
+    def merge(self, other):
+        """Adds the values of another accumulator."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update(other.__dict__)
+            return
+        count_a = self.count
+        count_b = other.count
+        count = count_a + count_b
+        delta = other.mean - self.mean
+        delta_n = delta / count
+        m2 = self.m2 + other.m2 + delta * delta_n * count_a * count_b
+        m3 = (
+            self.m3
+            + other.m3
+            + delta * delta_n**2 * count_a * count_b * (count_a - count_b)
+            + 3 * delta_n * (count_a * other.m2 - count_b * self.m2)
+        )
+        m4 = (
+            self.m4
+            + other.m4
+            + delta
+            * delta_n**3
+            * count_a
+            * count_b
+            * (count_a**2 - count_a * count_b + count_b**2)
+            + 6 * delta_n**2 * (count_a**2 * other.m2 + count_b**2 * self.m2)
+            + 4 * delta_n * (count_a * other.m3 - count_b * self.m3)
+        )
+        self.count = count
+        self.mean += delta_n * count_b
+        self.m2 = m2
+        self.m3 = m3
+        self.m4 = m4
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    def get_statistics(self):
+        """
+        Returns:
+            - Dictionary of the count, mean, sample variance and standard deviation,
+              skewness, excess kurtosis, minimum and maximum.
+        """
+        count = self.count
+        variance = self.m2 / (count - 1) if count > 1 else 0.0
+        population_variance = self.m2 / count if count else 0.0
+        return {
+            "count": count,
+            "mean": self.mean if count else math.nan,
+            "variance": variance,
+            "std": math.sqrt(variance),
+            "skewness": (
+                self.m3 / count / population_variance**1.5 if population_variance else 0.0
+            ),
+            "kurtosis": (
+                self.m4 / count / population_variance**2 - 3 if population_variance else 0.0
+            ),
+            "minimum": self.minimum if count else math.nan,
+            "maximum": self.maximum if count else math.nan,
+        }
+
+
+class KLLSketch:
+    """
+    This class estimates the quantiles of a series of values in O(k) memory. Sketches
+    of different workers are merged into a sketch of all their values.
+    """
+
+    def __init__(self, k=200, seed=None):
+        """
+        Parameters:
+            - k: Capacity of the top compactor, setting the accuracy and the size.
+            - seed: Optional seed of the random offsets of the compactions.
+        """
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        # Level h holds items of weight 2^h.
+        self.levels = [np.empty(0)]
+
+    def get_capacity(self, level):
+        """Returns the capacity of a level, decreasing by 2/3 below the top level."""
+        depth = len(self.levels) - 1 - level
+        return max(2, int(math.ceil(self.k * (2 / 3) ** depth)))
+
+    def add_array(self, values):
+        """Adds an array of values."""
+        values = np.asarray(values, dtype=float).ravel()
+        self.count += len(values)
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compress()
+
+    def add(self, value):
+        """Adds a single value."""
+        self.add_array([value])
+
+    def compress(self):
+        """Compacts every level holding more items than its capacity."""
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.get_capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item stays at its level.
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                paired = items[: len(items) - len(keep)]
+                promoted = paired[int(self.rng.integers(2)) :: 2]
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate((self.levels[level + 1], promoted))
+            level += 1
+
+    def merge(self, other):
+        """Adds the values of another sketch."""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], items))
+        self.count += other.count
+        self.compress()
+
+    def get_weighted_items(self):
+        """
+        Returns:
+            - Sorted array of the items of every level.
+            - Array of the cumulative weight of the items.
+        """
+        values = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(items), 2.0**level) for level, items in enumerate(self.levels)]
+        )
+        order = np.argsort(values, kind="stable")
+        return values[order], np.cumsum(weights[order])
+
+    def get_quantiles(self, fractions):
+        """
+        Returns the estimated quantiles.
+
+        Parameters:
+            - fractions: Array of fractions between 0 and 1, such as 0.95.
+
+        Returns:
+            - Array of the quantiles, NaN for an empty sketch.
+        """
+        fractions = np.asarray(fractions, dtype=float)
+        if self.count == 0:
+            return np.full(fractions.shape, np.nan)
+        values, cumulative = self.get_weighted_items()
+        targets = fractions * cumulative[-1]
+        indices = np.searchsorted(cumulative, targets, side="left")
+        return values[np.minimum(indices, len(values) - 1)]
+
+    def get_rank(self, value):
+        """Returns the estimated fraction of the values less than or equal to a value."""
+        if self.count == 0:
+            return math.nan
+        values, cumulative = self.get_weighted_items()
+        index = np.searchsorted(values, value, side="right")
+        return float(cumulative[index - 1] / cumulative[-1]) if index else 0.0
+
+    def get_size(self):
+        """Returns the number of items stored."""
+        return sum(len(items) for items in self.levels)
+
+
+class FillDistribution:
+    """
+    This class summarizes the distribution of values of fill summaries, such as
+    total_relative_fill_unc_k and mass_corrected, by a KLLSketch and a MomentAccumulator
+    per value.
+    """
+
+    def __init__(self, names=("total_relative_fill_unc_k", "mass_corrected"), k=200, seed=None):
+        """
+        Parameters:
+            - names: Keys of the fill summaries to summarize.
+            - k: Accuracy parameter of the sketches.
+            - seed: Optional seed of the sketches.
+        """
+        self.names = tuple(names)
+        self.sketches = {name: KLLSketch(k, seed) for name in self.names}
+        self.moments = {name: MomentAccumulator() for name in self.names}
+
+    def add_values(self, name, values):
+        """Adds an array of values of one key."""
+        self.sketches[name].add_array(values)
+        self.moments[name].add_array(values)
+
+    def add_summaries(self, summaries):
+        """
+        Adds fill summaries, as returned by BatchEvaluator.evaluate_fill().
+
+        Parameters:
+            - summaries: List of summary dictionaries.
+        """
+        for name in self.names:
+            self.add_values(name, [summary[name] for summary in summaries])
+
+    def merge(self, other):
+        """Adds the fillings summarized by another FillDistribution."""
+        for name in self.names:
+            self.sketches[name].merge(other.sketches[name])
+            self.moments[name].merge(other.moments[name])
+
+    def get_statistics(self, fractions=(0.05, 0.5, 0.95, 0.99)):
+        """
+        Returns the moments and the estimated quantiles of every key.
+
+        Parameters:
+            - fractions: Fractions of the quantiles.
+
+        Returns:
+            - Dictionary of key: dictionary of the moments, with "quantiles" mapping each
+              fraction to its quantile.
+        """
+        statistics = {}
+        for name in self.names:
+            values = self.moments[name].get_statistics()
+            values["quantiles"] = dict(
+                zip(fractions, self.sketches[name].get_quantiles(fractions).tolist())
+            )
+            statistics[name] = values
+        return statistics
+
+
+def summarize_fills(
+    hrs_config: HRSConfiguration,
+    fills,
+    k,
+    names=("total_relative_fill_unc_k", "mass_corrected"),
+    sketch_size=200,
+    seed=None,
+):
+    """
+    Evaluates fillings and summarizes their results, without keeping the results.
+    Defined at module level, so each worker of a process pool can summarize its share of
+    the fillings and return only the summary.
+
+    Parameters:
+        - hrs_config: The HRS configuration.
+        - fills: Iterable of (flowrates, temperatures, pressures) tuples, optionally
+          followed by the fill state and the timestamps, as in evaluate_fills().
+        - k: Coverage factor
+        - names: Keys of the fill summaries to summarize.
+        - sketch_size: Accuracy parameter of the sketches.
+        - seed: Optional seed of the sketches.
+
+    Returns:
+        - The FillDistribution of the fillings.
+    """
+    evaluator = BatchEvaluator(hrs_config, max_workers=1)
+    distribution = FillDistribution(names, sketch_size, seed)
+    summaries = []
+    for fill in fills:
+        fill_state = fill[3] if len(fill) > 3 else None
+        timestamps = fill[4] if len(fill) > 4 else None
+        _, summary = evaluator.evaluate_fill(*fill[:3], k, fill_state, timestamps)
+        summaries.append(summary)
+        if len(summaries) == 1024:
+            distribution.add_summaries(summaries)
+            summaries = []
+    if summaries:
+        distribution.add_summaries(summaries)
+    return distribution
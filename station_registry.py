@@ -0,0 +1,207 @@
+"""
+This module contains the StationRegistry class, which holds the HRS configurations of many
+stations, each configured by its own Excel workbook. The workbooks are loaded concurrently,
+and the parsed configurations are cached by station ID together with the modification
+time of the workbook, so a workbook is only read again after it has been changed.
+
+Reading a workbook is mostly Python code holding the global interpreter lock, so a thread
+pool mainly overlaps the file access. For large fleets a ProcessPoolExecutor can be given
+instead, as the configurations are returned by value.
+
+Classes:
+    StationRegistry
+Functions:
+    load_configuration: Reads a single workbook into a new HRS configuration.
+"""
+import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from hrs_config import HRSConfiguration
+from collect_data import CollectData
+from batch_evaluator import BatchEvaluator
+
+
+def load_configuration(file_path):
+    """
+    Reads a workbook into a new HRS configuration. Defined at module level, so it can be
+    run by a process pool.
+
+    Parameters:
+        - file_path: The path to the Excel workbook.
+
+    Returns:
+        - The HRS configuration.
+    """
+    hrs_config = HRSConfiguration()
+    CollectData(hrs_config, file_path)
+    return hrs_config
+
+
+class StationRegistry:
+    """
+    This class registers the workbook of each station, and serves the HRS configuration and
+    the uncertainty pipeline of a station by its ID. Every method may be called from
+    multiple threads.
+    """
+
+    def __init__(self, max_workers=None, executor_class=ThreadPoolExecutor):
+        """
+        Parameters:
+            - max_workers: The number of workbooks loaded at once. Defaults to the
+              default of the executor.
+            - executor_class: ThreadPoolExecutor, or ProcessPoolExecutor to parse the
+              workbooks in separate processes.
+        """
+        self.max_workers = max_workers
+        self.executor_class = executor_class
+        self.file_paths = {}
+        # Station ID: (modification time [ns], HRS configuration)
+        self.configurations = {}
+        # Station ID: BatchEvaluator
+        self.evaluators = {}
+        self.lock = threading.Lock()
+        self.station_locks = {}
+
+    def register(self, station_id, file_path):
+        """
+        Registers the workbook of a station. The workbook is loaded when first requested.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - file_path: The path to the Excel workbook of the station.
+        """
+        with self.lock:
+            if self.file_paths.get(station_id) != file_path:
+                self.configurations.pop(station_id, None)
+            self.file_paths[station_id] = file_path
+            self.station_locks.setdefault(station_id, threading.Lock())
+
+    def register_directory(self, directory, pattern="*.xlsx"):
+        """
+        Registers every workbook in a directory, using the file name without its
+        extension as the station ID.
+
+        Parameters:
+            - directory: The directory of the workbooks.
+            - pattern: Pattern of the file names of the workbooks.
+
+        Returns:
+            - List of the station IDs registered.
+        """
+        station_ids = []
+        for file_path in sorted(glob.glob(os.path.join(directory, pattern))):
+            station_id = os.path.splitext(os.path.basename(file_path))[0]
+            self.register(station_id, file_path)
+            station_ids.append(station_id)
+        return station_ids
+
+    def unregister(self, station_id):
+        """Removes a station and its cached configuration."""
+        with self.lock:
+            self.file_paths.pop(station_id, None)
+            self.configurations.pop(station_id, None)
+            self.evaluators.pop(station_id, None)
+            self.station_locks.pop(station_id, None)
+
+    def get_station_ids(self):
+        """Returns the IDs of the registered stations."""
+        with self.lock:
+            return list(self.file_paths)
+
+    def get_cached(self, station_id):
+        """
+        Returns the cached configuration of a station if its workbook is unchanged.
+
+        Returns:
+            - The file path, its modification time [ns], and the HRS configuration or None.
+        """
+        with self.lock:
+            file_path = self.file_paths[station_id]
+            cached = self.configurations.get(station_id)
+        mtime = os.stat(file_path).st_mtime_ns
+        if cached is not None and cached[0] == mtime:
+            return file_path, mtime, cached[1]
+        return file_path, mtime, None
+
+    def store(self, station_id, file_path, mtime, hrs_config):
+        """Caches a loaded configuration, unless the station was re-registered meanwhile."""
+        with self.lock:
+            if self.file_paths.get(station_id) == file_path:
+                self.configurations[station_id] = (mtime, hrs_config)
+
+    def get_configuration(self, station_id):
+        """
+        Returns the HRS configuration of a station, reading its workbook if it has not
+        been read, or has been modified since.
+
+        Parameters:
+            - station_id: Identifier of the station.
+
+        Returns:
+            - The HRS configuration.
+        """
+        file_path, mtime, hrs_config = self.get_cached(station_id)
+        if hrs_config is not None:
+            return hrs_config
+        with self.station_locks[station_id]:
+            # Another thread may have loaded the workbook while waiting for the lock.
+            file_path, mtime, hrs_config = self.get_cached(station_id)
+            if hrs_config is None:
+                hrs_config = load_configuration(file_path)
+                self.store(station_id, file_path, mtime, hrs_config)
+        return hrs_config
+
+    def load_all(self, station_ids=None):
+        """
+        Loads the workbooks of the given stations concurrently, skipping those which are
+        cached and unchanged.
+
+        Parameters:
+            - station_ids: The stations to load. Defaults to every registered station.
+
+        Returns:
+            - Dictionary of station ID: HRS configuration.
+        """
+        if station_ids is None:
+            station_ids = self.get_station_ids()
+        configurations = {}
+        stale = []
+        for station_id in station_ids:
+            file_path, mtime, hrs_config = self.get_cached(station_id)
+            if hrs_config is None:
+                stale.append((station_id, file_path, mtime))
+            else:
+                configurations[station_id] = hrs_config
+        if stale:
+            with self.executor_class(max_workers=self.max_workers) as executor:
+                futures = [
+                    (station_id, file_path, mtime, executor.submit(load_configuration, file_path))
+                    for station_id, file_path, mtime in stale
+                ]
+                for station_id, file_path, mtime, future in futures:
+                    hrs_config = future.result()
+                    self.store(station_id, file_path, mtime, hrs_config)
+                    configurations[station_id] = hrs_config
+        return configurations
+
+    def get_evaluator(self, station_id):
+        """
+        Returns the uncertainty pipeline of a station, as a BatchEvaluator holding its
+        Correction and UncertaintyTools. The evaluator is built once per loaded
+        configuration.
+
+        Parameters:
+            - station_id: Identifier of the station.
+
+        Returns:
+            - The BatchEvaluator of the station.
+        """
+        hrs_config = self.get_configuration(station_id)
+        with self.lock:
+            evaluator = self.evaluators.get(station_id)
+            if evaluator is None or evaluator.hrs_config is not hrs_config:
+                evaluator = BatchEvaluator(hrs_config)
+                self.evaluators[station_id] = evaluator
+        return evaluator
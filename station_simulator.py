@@ -0,0 +1,427 @@
+"""
+This module contains a discrete-event simulation of a whole HRS, for planning the
+throughput of a station and the distribution of the metering uncertainty under load.
+Vehicles arrive by a Poisson process with an hourly rate, wait in a queue for a free
+dispenser, and are filled from a cascade of storage banks, which are recharged by a
+compressor. The pre-cooler is shared by the dispensers, limiting the flowrate of each
+filling when several fillings run at once.
+
+The simulation jumps from event to event by a heap of pending events, so weeks of station
+operation are simulated in minutes. Each filling is generated sample by sample from the
+bank pressures when it starts, and the banks are drawn down for the whole filling at once.
+The compressor is integrated between the events. Every filling is evaluated by the
+uncertainty pipeline of a BatchEvaluator, using the conditions left in the dispenser by
+its previous filling as the pre-fill conditions.
+
+Classes:
+    StorageBank
+    StationSimulator
+"""
+import heapq
+from collections import deque
+import itertools
+import numpy as np
+
+from hrs_config import HRSConfiguration
+from fill_state import FillState
+from flow_calculations import FlowProperties
+from simulate_hrs import GenerateFlowData
+from batch_evaluator import BatchEvaluator
+from instrumentation import timed
+
+BAR = 100000  # Pa
+
+
+class StorageBank:
+    """
+    This class stores the hydrogen of one storage bank of the cascade, as an ideal gas at
+    a constant temperature.
+    """
+
+    def __init__(self, name, volume, max_pressure, temperature=288.15, pressure=None):
+        """
+        Parameters:
+            - Name: Name of the bank, such as "low", "medium" or "high".
+            - Volume: Volume of the bank [m3]
+            - Max pressure: Pressure the compressor charges the bank to [bar]
+            - Temperature: Temperature of the gas in the bank [K]
+            - Pressure: Initial pressure [bar], defaults to the max pressure.
+        """
+        self.name = name
+        self.volume = volume
+        self.max_pressure = max_pressure
+        self.temperature = temperature
+        self.flow_properties = FlowProperties()
+        self.max_mass = self.get_mass(max_pressure)
+        self.mass = self.get_mass(max_pressure if pressure is None else pressure)
+
+    def get_mass(self, pressure):
+        """Returns the mass held by the bank at a pressure [bar], in kg."""
+        return (
+            self.flow_properties.calculate_hydrogen_density(pressure * BAR, self.temperature)
+            * self.volume
+        )
+
+    def get_pressure(self):
+        """Returns the pressure of the bank [bar]."""
+        return self.max_pressure * self.mass / self.max_mass
+
+    def add(self, mass):
+        """
+        Adds mass from the compressor, up to the max pressure.
+
+        Returns:
+            - The mass added [kg]
+        """
+        added = min(mass, self.max_mass - self.mass)
+        self.mass += added
+        return added
+
+    def withdraw(self, mass):
+        """Withdraws mass delivered to a vehicle [kg]."""
+        self.mass = max(self.mass - mass, 0.0)
+
+
+class StationSimulator:
+    """
+    This class simulates the operation of a station with a number of dispensers sharing
+    a cascade of storage banks, a compressor and a pre-cooler, and evaluates the
+    uncertainty of every simulated filling.
+    """
+
+    def __init__(
+        self,
+        hrs_config: HRSConfiguration,
+        k=2,
+        dispenser_count=2,
+        banks=(("low", 1.5, 500), ("medium", 1.5, 700), ("high", 1.5, 900)),
+        compressor_rate_kg_h=30,
+        precooler_capacity_kg_min=7.2,
+        arrival_rates=6,
+        tank_sizes_kg=(4.0, 5.0, 6.3),
+        tank_size_weights=None,
+        state_of_charge=(0.05, 0.5),
+        target_pressure=700,
+        switch_pressure_difference=20,
+        orifice_coefficient=0.0085,
+        max_queue=10,
+        evaluate=True,
+        seed=None,
+    ):
+        """
+        Parameters:
+            - hrs_config: The HRS configuration of the metering of every dispenser.
+            - k: Coverage factor
+            - dispenser_count: Number of dispensers.
+            - banks: Tuple of (name, volume [m3], max pressure [bar]) per storage bank,
+              from the lowest to the highest pressure tier.
+            - compressor_rate_kg_h: Mass the compressor delivers to the banks [kg/h]
+            - precooler_capacity_kg_min: Total flowrate the pre-cooler cools to the
+              lowest temperature [kg/min], shared by the fillings running at once.
+            - arrival_rates: Vehicles per hour, either constant or a list of 24 hourly
+              rates repeated every day.
+            - tank_sizes_kg: Tank capacities of the arriving vehicles [kg]
+            - tank_size_weights: Optional relative frequency of each tank size.
+            - state_of_charge: Range of the fraction of the tank which is full on arrival.
+            - target_pressure: Pressure of a full tank at 15 C [bar]
+            - switch_pressure_difference: Difference between the bank and the vehicle
+              pressure at which the filling switches to the next bank [bar]
+            - orifice_coefficient: Flowrate per square root of the pressure difference
+              between the bank and the vehicle [kg/s/bar^0.5]
+            - max_queue: Vehicles waiting for a dispenser, before arriving vehicles leave.
+            - evaluate: Whether to evaluate the uncertainty of each filling.
+            - seed: Optional seed of the random generator.
+        """
+        self.hrs_config = hrs_config
+        self.k = k
+        self.dispenser_count = dispenser_count
+        self.bank_parameters = banks
+        self.compressor_rate = compressor_rate_kg_h / 3600
+        self.precooler_capacity = precooler_capacity_kg_min / 60
+        if np.isscalar(arrival_rates):
+            arrival_rates = [arrival_rates] * 24
+        if len(arrival_rates) != 24:
+            raise ValueError("arrival_rates must be a constant or 24 hourly rates.")
+        self.arrival_rates = np.asarray(arrival_rates, dtype=float)
+        self.tank_sizes_kg = np.asarray(tank_sizes_kg, dtype=float)
+        weights = (
+            np.ones(len(tank_sizes_kg)) if tank_size_weights is None
+            else np.asarray(tank_size_weights, dtype=float)
+        )
+        self.tank_size_weights = weights / np.sum(weights)
+        self.state_of_charge = state_of_charge
+        self.target_pressure = target_pressure
+        self.switch_pressure_difference = switch_pressure_difference
+        self.orifice_coefficient = orifice_coefficient
+        self.max_queue = max_queue
+        self.evaluate = evaluate
+        self.seed = seed
+        self.profile = GenerateFlowData()
+        self.evaluator = BatchEvaluator(hrs_config, max_workers=1)
+        self.reset()
+
+    def reset(self):
+        """Resets the station to full banks, free dispensers and an empty queue."""
+        self.rng = np.random.default_rng(self.seed)
+        self.banks = [
+            StorageBank(name, volume, max_pressure)
+            for name, volume, max_pressure in self.bank_parameters
+        ]
+        self.events = []
+        self.sequence = itertools.count()
+        self.time = 0.0
+        self.free_dispensers = list(range(self.dispenser_count))
+        self.active_fills = 0
+        self.queue = deque()
+        # Pre-fill conditions of each dispenser, (pressure [Pa], temperature [K])
+        default_state = FillState()
+        self.dispenser_states = [
+            (default_state.pre_fill_pressure, default_state.pre_fill_temp)
+        ] * self.dispenser_count
+        self.vehicle_count = 0
+        self.balked = 0
+        self.max_queue_length = 0
+        self.compressor_mass = 0.0
+        self.fills = []
+        self.bank_history = []
+
+    def schedule(self, time, kind, data=None):
+        """Adds an event to the heap. Events at the same time keep their order."""
+        heapq.heappush(self.events, (time, next(self.sequence), kind, data))
+
+    def schedule_arrival(self):
+        """
+        Schedules the next arrival, by thinning a Poisson process with the highest hourly
+        rate down to the rate of the hour of each candidate arrival.
+        """
+        max_rate = float(np.max(self.arrival_rates))
+        if max_rate <= 0:
+            return
+        time = self.time
+        while True:
+            time += self.rng.exponential(3600 / max_rate)
+            hour = int(time // 3600) % 24
+            if self.rng.random() * max_rate < self.arrival_rates[hour]:
+                break
+        self.schedule(time, "arrival")
+
+    def run_compressor(self, time):
+        """
+        Recharges the banks from the last event until the given time, charging the
+        highest pressure tier first.
+        """
+        mass = self.compressor_rate * (time - self.time)
+        for bank in reversed(self.banks):
+            if mass <= 0:
+                break
+            added = bank.add(mass)
+            self.compressor_mass += added
+            mass -= added
+        self.time = time
+
+    def new_vehicle(self):
+        """
+        Draws the tank size and the initial state of charge of an arriving vehicle.
+
+        Returns:
+            - Dictionary describing the vehicle.
+        """
+        self.vehicle_count += 1
+        capacity = float(self.rng.choice(self.tank_sizes_kg, p=self.tank_size_weights))
+        low, high = self.state_of_charge
+        return {
+            "vehicle_id": self.vehicle_count,
+            "arrival_time": self.time,
+            "capacity": capacity,
+            "initial_mass": capacity * self.rng.uniform(low, high),
+        }
+
+    def generate_fill_profile(self, vehicle, max_flowrate):
+        """
+        Generates the samples of a filling, one per second, from the pressures of the
+        banks. The filling draws from the lowest bank which is more than the switch
+        pressure difference above the vehicle, and ends when the tank is full, or when no
+        bank can raise the vehicle pressure further.
+
+        Parameters:
+            - Vehicle: Dictionary returned by new_vehicle().
+            - Max flowrate: Flowrate limit given by the pre-cooler [kg/s]
+
+        Returns:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of vehicle pressures [bar]
+            - Complete: Whether the tank was filled.
+        """
+        profile = self.profile
+        capacity = vehicle["capacity"]
+        mass = vehicle["initial_mass"]
+        # Vehicle pressure per kg in the tank, at 15 C [bar/kg]
+        pressure_per_kg = self.target_pressure / capacity
+        # A saturated pre-cooler cools the gas down more slowly.
+        temp_rate = profile.temp_increments * min(1.0, max_flowrate / profile.max_flowrate_kg_s)
+
+        flowrates = []
+        temperatures = []
+        pressures = []
+        flowrate = 0.0
+        temp = profile.start_temperature
+        bank_index = 0
+        while capacity - mass > 1e-9:
+            vehicle_pressure = mass * pressure_per_kg
+            while (
+                bank_index < len(self.banks)
+                and self.banks[bank_index].get_pressure() - vehicle_pressure
+                < self.switch_pressure_difference
+            ):
+                bank_index += 1
+            if bank_index == len(self.banks):
+                break
+            bank = self.banks[bank_index]
+            flowrate = min(
+                flowrate + profile.flowrate_increments,
+                max_flowrate,
+                self.orifice_coefficient * np.sqrt(bank.get_pressure() - vehicle_pressure),
+                capacity - mass,
+            )
+            bank.withdraw(flowrate)
+            mass += flowrate
+            temp = max(temp - temp_rate, profile.negative_temp_limit)
+            flowrates.append(flowrate * 60)
+            temperatures.append(temp)
+            pressures.append(mass * pressure_per_kg)
+        complete = capacity - mass <= 1e-9
+        return np.array(flowrates), np.array(temperatures), np.array(pressures), complete
+
+    def start_fill(self, vehicle, dispenser):
+        """Starts filling a vehicle, and schedules the end of the filling."""
+        self.active_fills += 1
+        max_flowrate = min(
+            self.profile.max_flowrate_kg_s, self.precooler_capacity / self.active_fills
+        )
+        flowrates, temperatures, pressures, complete = self.generate_fill_profile(
+            vehicle, max_flowrate
+        )
+        fill = dict(
+            vehicle,
+            dispenser=dispenser,
+            start_time=self.time,
+            end_time=self.time + len(flowrates),
+            wait_time=self.time - vehicle["arrival_time"],
+            mass_delivered=float(np.sum(flowrates)) / 60,
+            complete=complete,
+        )
+        self.schedule(fill["end_time"], "fill_end", (fill, flowrates, temperatures, pressures))
+
+    def end_fill(self, fill, flowrates, temperatures, pressures):
+        """
+        Frees the dispenser of a finished filling, evaluates the filling, and starts
+        filling the first vehicle in the queue.
+        """
+        dispenser = fill["dispenser"]
+        self.active_fills -= 1
+        if len(flowrates) > 0:
+            if self.evaluate:
+                pre_fill_pressure, pre_fill_temp = self.dispenser_states[dispenser]
+                _, fill["summary"] = self.evaluator.evaluate_fill(
+                    flowrates,
+                    temperatures,
+                    pressures,
+                    self.k,
+                    FillState(pre_fill_pressure, pre_fill_temp),
+                )
+            self.dispenser_states[dispenser] = (
+                float(pressures[-1]) * BAR,
+                float(temperatures[-1]) + 273.15,
+            )
+        self.fills.append(fill)
+        if self.queue:
+            self.start_fill(self.queue.popleft(), dispenser)
+        else:
+            self.free_dispensers.append(dispenser)
+
+    def arrive(self):
+        """Handles an arriving vehicle, and schedules the next arrival."""
+        self.schedule_arrival()
+        vehicle = self.new_vehicle()
+        if self.free_dispensers:
+            self.start_fill(vehicle, self.free_dispensers.pop(0))
+        elif len(self.queue) < self.max_queue:
+            self.queue.append(vehicle)
+            self.max_queue_length = max(self.max_queue_length, len(self.queue))
+        else:
+            self.balked += 1
+
+    @timed("station_simulator.run")
+    def run(self, duration):
+        """
+        Simulates the station from empty dispensers and full banks.
+
+        Parameters:
+            - Duration: Simulated time [s]. Arrivals stop at the duration, and the
+              fillings running at the duration are completed.
+
+        Returns:
+            - Dictionary with:
+                - "fills": List of dictionaries describing each filling, including the
+                  summary of BatchEvaluator.evaluate_fill() when evaluated.
+                - "bank_pressures": Array of the time [s] and the pressure of each bank
+                  [bar] at every event.
+                - "statistics": Dictionary returned by get_statistics().
+        """
+        self.reset()
+        self.schedule_arrival()
+        while self.events:
+            time, _, kind, data = heapq.heappop(self.events)
+            if kind == "arrival" and time > duration:
+                continue
+            self.run_compressor(time)
+            if kind == "arrival":
+                self.arrive()
+            else:
+                self.end_fill(*data)
+            self.bank_history.append([time] + [bank.get_pressure() for bank in self.banks])
+        return {
+            "fills": self.fills,
+            "bank_pressures": np.array(self.bank_history),
+            "statistics": self.get_statistics(duration),
+        }
+
+    def get_statistics(self, duration):
+        """
+        Calculates the throughput of the station and the distribution of the
+        uncertainty of the fillings.
+
+        Parameters:
+            - Duration: Simulated time [s]
+
+        Returns:
+            - Dictionary of the statistics.
+        """
+        fills = self.fills
+        waits = np.array([fill["wait_time"] for fill in fills])
+        mass_delivered = sum(fill["mass_delivered"] for fill in fills)
+        statistics = {
+            "vehicles": self.vehicle_count,
+            "fills": len(fills),
+            "incomplete_fills": sum(not fill["complete"] for fill in fills),
+            "balked": self.balked,
+            "fills_per_hour": len(fills) / duration * 3600,
+            "mass_delivered": mass_delivered,
+            "mean_wait_time": float(np.mean(waits)) if len(waits) else 0.0,
+            "p95_wait_time": float(np.percentile(waits, 95)) if len(waits) else 0.0,
+            "max_queue_length": self.max_queue_length,
+            "compressor_utilization": self.compressor_mass
+            / (self.compressor_rate * self.time) if self.time > 0 else 0.0,
+        }
+        uncertainties = np.array(
+            [fill["summary"]["total_relative_fill_unc_k"] for fill in fills if "summary" in fill]
+        )
+        if len(uncertainties):
+            statistics["uncertainty_mean"] = float(np.mean(uncertainties))
+            for percentile in (5, 50, 95):
+                statistics[f"uncertainty_p{percentile}"] = float(
+                    np.percentile(uncertainties, percentile)
+                )
+            statistics["uncertainty_max"] = float(np.max(uncertainties))
+        return statistics
@@ -0,0 +1,325 @@
+"""
+This module contains the FillSummaryStore class, a persistent SQLite store of the results
+of evaluated fillings. Each filling is stored with its corrected mass, its expanded
+uncertainty and the totaled components of return_total_system_uncs(), clustered by
+station and day. Daily and monthly rollups are updated as fillings are added, so reports
+over a year of fillings read a few hundred pre-aggregated rows instead of every filling.
+
+Classes:
+    FillSummaryStore
+"""
+import sqlite3
+import threading
+
+# Absolute uncertainty components stored per filling [kg], and their column names.
+COMPONENTS = {
+    "cfm": "tot_abs_cfm",
+    "temperature": "tot_abs_temp",
+    "pressure": "tot_abs_press",
+    "long_term_drift": "tot_abs_ltd",
+    "vent": "vent_abs_unc",
+    "dead_volume": "dv_abs_unc",
+}
+
+ROLLUP_SUMS = ["mass_corrected", "mass_uncorrected", "total_relative_fill_unc_k"] + list(
+    COMPONENTS.values()
+)
+
+
+class FillSummaryStore:
+    """
+    This class stores the summaries of fillings in an SQLite database, and maintains
+    the daily and monthly rollups per station. The summaries are the dictionaries
+    returned by BatchEvaluator.evaluate_fill() and PresentData.collect_fill_summary().
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+            - path: Path of the database file, created if missing. ":memory:" gives a
+              temporary database.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        if path != ":memory:":
+            # Readers in other processes are not blocked while fillings are added.
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.create_tables()
+
+    def create_tables(self):
+        """Creates the tables of the fillings and of the rollups."""
+        components = ", ".join(f"{column} REAL" for column in COMPONENTS.values())
+        sums = ", ".join(f"sum_{column} REAL NOT NULL" for column in ROLLUP_SUMS)
+        with self.lock, self.connection:
+            # The primary key clusters the fillings by station and day.
+            self.connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS fills (
+                    station_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    fill_id TEXT NOT NULL,
+                    fill_time TEXT NOT NULL,
+                    k REAL,
+                    mass_corrected REAL NOT NULL,
+                    mass_uncorrected REAL,
+                    total_relative_fill_unc_k REAL NOT NULL,
+                    {components},
+                    PRIMARY KEY (station_id, day, fill_id)
+                ) WITHOUT ROWID
+                """
+            )
+            self.connection.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS fills_by_id ON fills (station_id, fill_id)"
+            )
+            for table, period in (("daily_rollups", "day"), ("monthly_rollups", "month")):
+                self.connection.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        station_id TEXT NOT NULL,
+                        {period} TEXT NOT NULL,
+                        fill_count INTEGER NOT NULL,
+                        max_total_relative_fill_unc_k REAL NOT NULL,
+                        {sums},
+                        PRIMARY KEY (station_id, {period})
+                    ) WITHOUT ROWID
+                    """
+                )
+
+    def close(self):
+        """Closes the database."""
+        with self.lock:
+            self.connection.close()
+
+    def get_fill_row(self, station_id, fill_id, fill_time, summary):
+        """
+        Returns the values of a row of the fills table.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - fill_id: Identifier of the filling.
+            - fill_time: Start time of the filling, as a datetime.
+            - summary: Dictionary of the results of the filling.
+        """
+        return (
+            str(station_id),
+            fill_time.date().isoformat(),
+            str(fill_id),
+            fill_time.isoformat(),
+            summary.get("k"),
+            summary["mass_corrected"],
+            summary.get("mass_uncorrected"),
+            summary["total_relative_fill_unc_k"],
+        ) + tuple(summary.get(column, 0.0) for column in COMPONENTS.values())
+
+    def add_fills(self, station_id, fills):
+        """
+        Adds fillings of a station, and updates the rollups of their days and months
+        in the same transaction. Adding a filling with an existing ID replaces it.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - fills: List of (fill id, fill time, summary dictionary)
+        """
+        rows = [
+            self.get_fill_row(station_id, fill_id, fill_time, summary)
+            for fill_id, fill_time, summary in fills
+        ]
+        if not rows:
+            return
+        columns = (
+            "station_id, day, fill_id, fill_time, k, mass_corrected, mass_uncorrected, "
+            "total_relative_fill_unc_k, " + ", ".join(COMPONENTS.values())
+        )
+        placeholders = ", ".join("?" * len(rows[0]))
+        with self.lock, self.connection:
+            replaced_days = self.delete_existing(station_id, [row[2] for row in rows])
+            self.connection.executemany(
+                f"INSERT INTO fills ({columns}) VALUES ({placeholders})", rows
+            )
+            if replaced_days:
+                # A maximum can not be decremented, so the affected rollups are rebuilt.
+                days = replaced_days | {row[1] for row in rows}
+                self.rebuild_station_rollups(station_id, days)
+            else:
+                self.add_to_rollups(rows)
+
+    def add_fill(self, station_id, fill_id, fill_time, summary):
+        """Adds a single filling. See add_fills()."""
+        self.add_fills(station_id, [(fill_id, fill_time, summary)])
+
+    def delete_existing(self, station_id, fill_ids):
+        """
+        Deletes the fillings with the given IDs, if they are stored.
+
+        Returns:
+            - Set of the days of the deleted fillings.
+        """
+        days = set()
+        for fill_id in fill_ids:
+            row = self.connection.execute(
+                "SELECT day FROM fills WHERE station_id = ? AND fill_id = ?",
+                (str(station_id), str(fill_id)),
+            ).fetchone()
+            if row is not None:
+                days.add(row["day"])
+                self.connection.execute(
+                    "DELETE FROM fills WHERE station_id = ? AND fill_id = ?",
+                    (str(station_id), str(fill_id)),
+                )
+        return days
+
+    def add_to_rollups(self, rows):
+        """
+        Adds new fillings to the daily and monthly rollups, by aggregating them per day
+        and month, and merging the aggregates into the stored rows.
+
+        Parameters:
+            - rows: Rows of the fills table, as returned by get_fill_row().
+        """
+        for table, period, length in (
+            ("daily_rollups", "day", 10),
+            ("monthly_rollups", "month", 7),
+        ):
+            totals = {}
+            for row in rows:
+                key = (row[0], row[1][:length])
+                values = [row[5], row[6] or 0.0, row[7]] + [value or 0.0 for value in row[8:]]
+                if key not in totals:
+                    totals[key] = [0, row[7], [0.0] * len(values)]
+                total = totals[key]
+                total[0] += 1
+                total[1] = max(total[1], row[7])
+                total[2] = [a + b for a, b in zip(total[2], values)]
+            sums = ", ".join(f"sum_{column}" for column in ROLLUP_SUMS)
+            updates = ", ".join(
+                f"sum_{column} = sum_{column} + excluded.sum_{column}" for column in ROLLUP_SUMS
+            )
+            self.connection.executemany(
+                f"""
+                INSERT INTO {table} (station_id, {period}, fill_count,
+                    max_total_relative_fill_unc_k, {sums})
+                VALUES ({", ".join("?" * (4 + len(ROLLUP_SUMS)))})
+                ON CONFLICT (station_id, {period}) DO UPDATE SET
+                    fill_count = fill_count + excluded.fill_count,
+                    max_total_relative_fill_unc_k = MAX(max_total_relative_fill_unc_k,
+                        excluded.max_total_relative_fill_unc_k),
+                    {updates}
+                """,
+                [
+                    key + (count, maximum) + tuple(values)
+                    for key, (count, maximum, values) in totals.items()
+                ],
+            )
+
+    def rebuild_station_rollups(self, station_id, days):
+        """
+        Recalculates the rollups of the given days of a station, and of their months,
+        from the stored fillings.
+
+        Parameters:
+            - station_id: Identifier of the station.
+            - days: Set of days, as YYYY-MM-DD.
+        """
+        sums = ", ".join(f"sum_{column}" for column in ROLLUP_SUMS)
+        aggregates = ", ".join(f"TOTAL({column})" for column in ROLLUP_SUMS)
+        months = {day[:7] for day in days}
+        for table, period, length, keys in (
+            ("daily_rollups", "day", 10, days),
+            ("monthly_rollups", "month", 7, months),
+        ):
+            for key in keys:
+                self.connection.execute(
+                    f"DELETE FROM {table} WHERE station_id = ? AND {period} = ?",
+                    (str(station_id), key),
+                )
+                self.connection.execute(
+                    f"""
+                    INSERT INTO {table} (station_id, {period}, fill_count,
+                        max_total_relative_fill_unc_k, {sums})
+                    SELECT station_id, SUBSTR(day, 1, {length}), COUNT(*),
+                        MAX(total_relative_fill_unc_k), {aggregates}
+                    FROM fills
+                    WHERE station_id = ? AND day >= ? AND day < ?
+                    GROUP BY station_id
+                    """,
+                    (str(station_id), key, key + "~"),
+                )
+
+    def rebuild_rollups(self):
+        """Recalculates every rollup from the stored fillings."""
+        with self.lock, self.connection:
+            stations = self.connection.execute(
+                "SELECT station_id, day FROM fills GROUP BY station_id, day"
+            ).fetchall()
+            self.connection.execute("DELETE FROM daily_rollups")
+            self.connection.execute("DELETE FROM monthly_rollups")
+            days = {}
+            for row in stations:
+                days.setdefault(row["station_id"], set()).add(row["day"])
+            for station_id, station_days in days.items():
+                self.rebuild_station_rollups(station_id, station_days)
+
+    def format_rollup(self, row, period):
+        """
+        Converts a rollup row to a dictionary, adding the mean expanded uncertainty and
+        the share of each component of the totaled absolute uncertainties.
+        """
+        count = row["fill_count"]
+        component_sums = {
+            name: row[f"sum_{column}"] for name, column in COMPONENTS.items()
+        }
+        component_total = sum(abs(value) for value in component_sums.values())
+        return {
+            "station_id": row["station_id"],
+            period: row[period],
+            "fill_count": count,
+            "mass_corrected": row["sum_mass_corrected"],
+            "mass_uncorrected": row["sum_mass_uncorrected"],
+            "max_total_relative_fill_unc_k": row["max_total_relative_fill_unc_k"],
+            "mean_total_relative_fill_unc_k": row["sum_total_relative_fill_unc_k"] / count,
+            "component_shares": {
+                name: abs(value) / component_total if component_total else 0.0
+                for name, value in component_sums.items()
+            },
+        }
+
+    def get_rollups(self, period, station_id=None, start=None, end=None):
+        """
+        Returns the rollups of a period.
+
+        Parameters:
+            - period: "day" or "month".
+            - station_id: Optional identifier of the station.
+            - start, end: Optional first and last period, as YYYY-MM-DD or YYYY-MM.
+
+        Returns:
+            - List of dictionaries, ordered by station and period.
+        """
+        table = {"day": "daily_rollups", "month": "monthly_rollups"}[period]
+        conditions = []
+        parameters = []
+        if station_id is not None:
+            conditions.append("station_id = ?")
+            parameters.append(str(station_id))
+        if start is not None:
+            conditions.append(f"{period} >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append(f"{period} <= ?")
+            parameters.append(end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT * FROM {table} {where} ORDER BY station_id, {period}", parameters
+            ).fetchall()
+        return [self.format_rollup(row, period) for row in rows]
+
+    def get_daily_rollups(self, station_id=None, start=None, end=None):
+        """Returns the daily rollups. See get_rollups()."""
+        return self.get_rollups("day", station_id, start, end)
+
+    def get_monthly_rollups(self, station_id=None, start=None, end=None):
+        """Returns the monthly rollups. See get_rollups()."""
+        return self.get_rollups("month", station_id, start, end)
@@ -0,0 +1,143 @@
+"""
+This module contains the SampleIntegrator class, which integrates timestamped samples
+with a variable sampling interval. Flowrates and uncertainties are given per minute, while
+the timestamps are given in seconds, allowing meters logging at 10-100 Hz to be processed
+directly. The class also offers a decimation stage with a bounded integration error.
+
+Classes:
+    SampleIntegrator
+"""
+import numpy as np
+
+
+class SampleIntegrator:
+    """
+    This class contains methods for trapezoidal integration of sampled rates over
+    timestamps, and for decimating high rate logs.
+    """
+
+    def __init__(self):
+        self.seconds_per_minute = 60
+
+    def integrate_trapezoidal(self, rates, timestamps):
+        """
+        Integrates rates over time by the trapezoidal rule. Multiple series can be
+        integrated at once, with time along the last axis.
+
+        Parameters:
+            - Rates: Array of rates per minute, such as flowrates [kg/min]
+            - Timestamps: Array of increasing timestamps [s]
+
+        Returns:
+            - The integrated value, such as mass [kg]
+        """
+        rates = np.asarray(rates, dtype=float)
+        durations = np.diff(np.asarray(timestamps, dtype=float))
+        averages = (rates[..., 1:] + rates[..., :-1]) / 2
+        return np.sum(averages * durations, axis=-1) / self.seconds_per_minute
+
+    def is_within_tolerance(self, timestamps, series, tolerances, start, end):
+        """
+        Checks whether the samples between start and end can be replaced by a straight
+        line between the two samples, without any sample deviating more than the tolerance.
+
+        Parameters:
+            - Timestamps: Array of timestamps [s]
+            - Series: List of sample arrays.
+            - Tolerances: Largest allowed deviation of each series.
+            - Start, end: Indices of the samples kept.
+
+        Returns:
+            - True if every series is within its tolerance.
+        """
+        times = timestamps[start : end + 1]
+        fractions = (times - times[0]) / (times[-1] - times[0])
+        for values, tolerance in zip(series, tolerances):
+            window = values[start : end + 1]
+            line = window[0] + (window[-1] - window[0]) * fractions
+            if np.max(np.abs(line - window)) > tolerance:
+                return False
+        return True
+
+    def get_short_window_failures(self, timestamps, series, tolerances):
+        """
+        Checks every window of three samples at once, giving the same result as
+        is_within_tolerance() for each of them.
+
+        Parameters:
+            - Timestamps: Array of timestamps [s]
+            - Series: List of sample arrays.
+            - Tolerances: Largest allowed deviation of each series.
+
+        Returns:
+            - Boolean array, True where the window starting at the sample fails.
+        """
+        first, middle, last = timestamps[:-2], timestamps[1:-1], timestamps[2:]
+        span = last - first
+        failures = np.zeros(len(first), dtype=bool)
+        for values, tolerance in zip(series, tolerances):
+            rise = values[2:] - values[:-2]
+            deviations = np.maximum.reduce(
+                [
+                    np.abs(values[:-2] + rise * ((times - first) / span) - window)
+                    for times, window in (
+                        (first, values[:-2]),
+                        (middle, values[1:-1]),
+                        (last, values[2:]),
+                    )
+                ]
+            )
+            failures |= deviations > tolerance
+        return failures
+
+    def decimate(self, timestamps, series, tolerances):
+        """
+        Removes samples which can be linearly interpolated from the samples kept, within
+        the given tolerances. Since no removed sample deviates more than the tolerance
+        from the line between the kept samples, the trapezoidal integral of the decimated
+        series deviates at most tolerance * duration from the integral of the full series.
+
+        Parameters:
+            - Timestamps: Array of increasing timestamps [s]
+            - Series: List of sample arrays, such as flowrates [kg/min]
+            - Tolerances: Largest allowed deviation of each series, in its unit.
+
+        Returns:
+            - Indices: Array of the indices of the kept samples.
+            - Error bounds: Largest integration error of each series, such as [kg]
+        """
+        timestamps = np.asarray(timestamps, dtype=float)
+        series = [np.asarray(values, dtype=float) for values in series]
+        last = len(timestamps) - 1
+        # Samples which cannot be removed are found for the whole log at once, so noisy
+        # logs are not searched sample by sample.
+        short_failures = self.get_short_window_failures(timestamps, series, tolerances)
+        kept = [0]
+        start = 0
+        while start < last:
+            if start + 2 <= last and short_failures[start]:
+                kept.append(start + 1)
+                start += 1
+                continue
+            # Exponential search for a window which is too long, then bisection.
+            good = start + 1
+            probe = start + 2
+            while probe <= last and self.is_within_tolerance(
+                timestamps, series, tolerances, start, probe
+            ):
+                good = probe
+                probe = start + 2 * (probe - start)
+            high = min(probe, last + 1)
+            while high - good > 1:
+                middle = (good + high) // 2
+                if self.is_within_tolerance(timestamps, series, tolerances, start, middle):
+                    good = middle
+                else:
+                    high = middle
+            kept.append(good)
+            start = good
+        duration = timestamps[-1] - timestamps[0] if last > 0 else 0.0
+        error_bounds = [
+            tolerance * duration / self.seconds_per_minute for tolerance in tolerances
+        ]
+        return np.array(kept), error_bounds
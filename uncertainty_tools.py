@@ -18,6 +18,10 @@ import numpy as np
 from hrs_config import HRSConfiguration
 from flow_calculations import FlowProperties
 from correction import Correction
+from dual_numbers import CorrectionSensitivity
+from fill_state import FillState
+from time_integration import SampleIntegrator
+from instrumentation import timed
 
 
 class UncertaintyTools:
@@ -25,13 +29,27 @@ class UncertaintyTools:
     A class containing methods for uncertainty calculation and manipulation.
     """
 
-    def __init__(self, hrs_config: HRSConfiguration, correction: Correction):
+    def __init__(
+        self,
+        hrs_config: HRSConfiguration,
+        correction: Correction,
+        correlated_corrections=False,
+    ):
         """
         Initialize UncertaintyTools object.
+
+        Parameters:
+            - hrs_config: The HRS configuration.
+            - correction: The Correction of the configuration.
+            - correlated_corrections: Opt-in, whether the uncertainty of the dead volume
+              and vent corrections is propagated through the Jacobian of the corrected
+              mass, by calculate_correction_abs_unc(), instead of adding the two hand
+              derived terms in quadrature. See calculate_correction_uncertainty().
         """
         self.flow_properties = FlowProperties()
         self.correcter = correction
         self.hrs_config = hrs_config
+        self.correlated_corrections = correlated_corrections
         self.std_uncertainty_zo_m_factor = 0.0261
 
     def convert_std_to_confidence(self, std_uncertainty, k):
@@ -202,16 +220,23 @@ class UncertaintyTools:
         else:
             return self.hrs_config.get_calibration_repeatability()
 
-    def calculate_total_combined_unc(self, uncertainties_abs_std, formatting):
+    def calculate_total_combined_unc(self, uncertainties_abs_std, formatting, timestamps=None):
         """
         Calculate the total combined uncertainty.
 
         Args:
             - uncertainties_abs_std: Array containing absolute uncertainties [kg/min] per second.
+            - formatting: Duration of each sample [min]
+            - timestamps: Optional array of sample times [s]. When given, the uncertainties
+              are integrated by the trapezoidal rule, and formatting is not used.
 
         Returns:
             - Uncertainty_mass: The total combined uncertainty of mass measured by the CFM [kg].
         """
+        if timestamps is not None:
+            return float(
+                SampleIntegrator().integrate_trapezoidal(uncertainties_abs_std, timestamps)
+            )
         uncertainty_mass = 0
         for uncertainty in uncertainties_abs_std:
             uncertainty_mass += uncertainty * formatting
@@ -266,7 +291,9 @@ class UncertaintyTools:
         )
         return var
 
-    def calculate_total_abs_unc_std(self, flowrate, temperature, pressure):
+    def calculate_total_abs_unc_std(
+        self, flowrate, temperature, pressure, fill_state: FillState
+    ):
         """
         Calculate the CFM absolute uncertainty of the current flowrate.
 
@@ -277,6 +304,7 @@ class UncertaintyTools:
 
         Args:
             flowrate (float): The flowrate for which to calculate the relative uncertainty.
+            fill_state (FillState): The state of the current filling.
 
         Returns:
             float: The absolute standard uncertainty of the flowrate measurement [kg/min].
@@ -293,7 +321,7 @@ class UncertaintyTools:
         # print(f"flowrate: {flowrate}, temp: {temperature}, pres: {pressure}")
 
         # Henter absolutt verdi for temp, konverterer rel trykk og årlig deviasjon.
-        abs_temp = self.calculate_abs_temp_per_sample(temperature)
+        abs_temp = self.calculate_abs_temp_per_sample(temperature, fill_state)
         abs_pres = self.calculate_absolute_pressure_unc(pressure, flowrate)
         abs_annual = self.calculate_absolute_annual_dev(flowrate)
         print(
@@ -312,7 +340,9 @@ class UncertaintyTools:
         )
         return var
 
-    def calculate_cfm_rel_unc_k(self, flowrate, temperature, pressure, k, string=None):
+    def calculate_cfm_rel_unc_k(
+        self, flowrate, temperature, pressure, k, fill_state: FillState, string=None
+    ):
         """
         Calculate the relative uncertainty of the CFM to the current flowrate.
 
@@ -324,6 +354,7 @@ class UncertaintyTools:
 
         Args:
             flowrate (float): The flowrate for which to calculate the relative uncertainty [kg/min]
+            fill_state (FillState): The state of the current filling.
 
         Returns:
             float: The relative uncertainty of the flowrate measurement.
@@ -345,7 +376,7 @@ class UncertaintyTools:
         field_condition = (self.get_field_condition_std(flowrate) / flowrate) * 100
         if string == None:
             temp_unc = self.calculate_relative_temperature_uncertainty(
-                flowrate, temperature
+                flowrate, temperature, fill_state
             )
             press_unc = self.calculate_relative_pressure_uncertainty(pressure)
             annual_dev_unc = self.calculate_relative_annual_dev()
@@ -462,80 +493,125 @@ class UncertaintyTools:
         else:
             return 0
 
+    def calculate_correction_abs_unc(self, measured_mass, fill_state: FillState):
+        """
+        Calculates the uncertainty of the dead volume and vent corrections together, with
+        sensitivity coefficients found by automatic differentiation of the correction
+        formulas, instead of the hand derived coefficients of calculate_depress_abs_unc()
+        and caclulate_dead_volume_abs_unc(). The contributions of the post-fill pressure
+        and temperature, shared by both corrections, are added before squaring.
+
+        Parameters:
+            - Measured mass: Mass measured by the CFM [kg]
+            - Fill state: State of the filling, containing the pre- and post-fill
+              pressures [Pa] and temperatures [K]
+
+        Returns:
+            - Absolute standard uncertainty of the corrections [kg]
+        """
+        # A correction which is not applied contributes no uncertainty, as in the hand
+        # derived methods.
+        volume_dv = (
+            self.hrs_config.get_dead_volume()
+            if self.hrs_config.correct_for_dead_volume_bool
+            else 0.0
+        )
+        volume_vv = (
+            self.hrs_config.get_depressurization_vent_volume()
+            if self.hrs_config.correct_for_depress_bool
+            else 0.0
+        )
+        sensitivity = CorrectionSensitivity(self.hrs_config, self.correcter)
+        _, uncertainty, _ = sensitivity.calculate_correction_abs_unc(
+            measured_mass,
+            fill_state.pre_fill_pressure,
+            fill_state.pre_fill_temp,
+            fill_state.post_fill_pressure,
+            fill_state.post_fill_temp,
+            volume_dv,
+            volume_vv,
+        )
+        return float(uncertainty)
+
+    def calculate_correction_uncertainty(self, fill_state: FillState):
+        """
+        Calculates the combined absolute uncertainty of the dead volume and vent
+        corrections of a filling, as used by the uncertainty budget.
+
+        By default, the two hand derived terms are added in quadrature, treating the
+        corrections as independent, as in earlier reports. The correlated treatment is
+        opt-in, selected by correlated_corrections: both corrections depend on the
+        post-fill pressure and temperature, measured by the same sensors, so their
+        contributions are combined through the Jacobian of the corrected mass before
+        squaring.
+
+        Parameters:
+            - Fill state: State of the filling, containing the measured mass [kg], and
+              the pre- and post-fill pressures [Pa] and temperatures [K]
+
+        Returns:
+            - Absolute standard uncertainty of the corrections [kg]
+        """
+        if self.correlated_corrections:
+            return self.calculate_correction_abs_unc(
+                fill_state.mass_uncorrected, fill_state
+            )
+        depress_vent_uncertainty, dead_volume_uncertainty = self.return_abs_error_data(
+            fill_state
+        )
+        return self.calculate_sum_variance(
+            depress_vent_uncertainty, dead_volume_uncertainty
+        )
+
+    @timed("uncertainty_tools.total_system_rel_unc_k")
     def calculate_total_system_rel_unc_k(
         self,
         mass_delivered,
-        uncertainties,
-        pre_fill_press,
-        pre_fill_temp,
-        post_fill_press,
-        post_fill_temp,
+        fill_state: FillState,
         k,
     ):
         """
         This method calculates the total uncertainty to the mass correction, given in relative
-        expanded uncertainty, for k = 2. It uses three methods to calculate it. CFM uncertainty
-        returns totaled uncertainty from measurements, in kg.Mass vented uncertainty in kg, and
-        the uncertainty in change in mass from dead volume in kg.
+        expanded uncertainty, for k = 2. It combines the totaled CFM uncertainty from
+        measurements in kg, with the uncertainty of the vent and dead volume corrections in
+        kg from calculate_correction_uncertainty().
 
         Parameters:
             - Mass delivered: Calculated corrected mass delivered [kg]
-            - Uncertainties: CFM absolute std uncertainties [kg/min]
-            - Pre-fill-pressure: Previous filling pressure [Pa]
-            - Pre-fill-temperature: Previous filling temperature [K]
-            - Post-fill-pressure: Current filling pressure [Pa]
-            - Post-fil-temperature: Current filling temperature [K]
+            - Fill state: State of the filling, containing the totaled CFM absolute std
+              uncertainty [kg], and the pre- and post-fill pressures [Pa] and temperatures [K]
 
         """
-        cfm_uncertainty = self.calculate_total_combined_unc(uncertainties, 1 / 60)
+        cfm_uncertainty = fill_state.tot_abs_total
         # -> Returnerer kalkulert abs suikkerhet til CFM målinger [kg].
 
-        depress_vent_uncertainty = self.calculate_depress_abs_unc(
-            post_fill_press, post_fill_temp
-        )
-        # -> Returnerer kalkulert abs usikkerhet til depress [kg]
-
-        dead_volume_uncertainty = self.caclulate_dead_volume_abs_unc(
-            pre_fill_press,
-            pre_fill_temp,
-            post_fill_press,
-            post_fill_temp,
-        )
+        correction_uncertainty = self.calculate_correction_uncertainty(fill_state)
         print()
-        # -> returnerer kalkulert abs usikkerhet til dødvolum [kg]
-
-        #print(
-        #    f"CFM uncertainty: {cfm_uncertainty}kg    Depressurized vent uncertainty: {depress_vent_uncertainty}kg  Dead volume uncertainty: {dead_volume_uncertainty}kg"
-        #)
+        # -> returnerer kalkulert abs usikkerhet til dødvolum og depress [kg]
 
         rel_unc = self.calculate_sum_variance(
             (cfm_uncertainty / mass_delivered),
-            (depress_vent_uncertainty / mass_delivered),
-            (dead_volume_uncertainty / mass_delivered),
+            (correction_uncertainty / mass_delivered),
         )
         expanded_relative_uncertainty = self.convert_std_to_confidence(rel_unc, k)
         return expanded_relative_uncertainty
 
-    def return_total_system_uncs(
-        self, mass_delivered, cfm_uncertainties, dvs, vvs, tes, pes, ltds
-    ):
+    @timed("uncertainty_tools.return_total_system_uncs")
+    def return_total_system_uncs(self, mass_delivered, fill_state: FillState, dvs, vvs):
         """
         Calculates and returns the total relative uncertainties over the filling process.
         #TODO: kanskje få inn i kap 4.
         Parameters:
             - Mass delivered: Total corrected mass delivered [kg]
-            - cfm_uncertainties: List containing absolute cfm uncertainties [kg/min]
+            - Fill state: State of the filling, containing the totaled absolute cfm,
+              temperature effect, pressure effect and long term drift uncertainties [kg]
             - dvs: Absolute uncertainty due to corrececting dead volume [kg]
             - vvs: Absolute uncertainty due to crorected vented mass [kg]
-            - tts: List containing absolute uncertainties from temperature effect [kg/min]
-            - tts: List containing absolute uncertainties from pressure effect [kg/min]
-            - tts: List containing absolute uncertainties from long term drift [kg/min]
-        """
-        # print(mass_delivered, cfm_uncertainties, dvs, vvs, tts, pps, ans)
-        tot_abs_cfm = self.calculate_total_combined_unc(cfm_uncertainties, 1 / 60)
-        tot_abs_temp = self.calculate_total_combined_unc(tes, 1 / 60)
-        tot_abs_press = self.calculate_total_combined_unc(pes, 1 / 60)
-        tot_abs_ltd = self.calculate_total_combined_unc(ltds, 1 / 60)
+        """
+        tot_abs_cfm = fill_state.tot_abs_cfm
+        tot_abs_temp = fill_state.tot_abs_temp
+        tot_abs_press = fill_state.tot_abs_press
+        tot_abs_ltd = fill_state.tot_abs_ltd
         rel_tt = (tot_abs_temp / mass_delivered) * 100
         rel_pp = (tot_abs_press / mass_delivered) * 100
         rel_ltd = (tot_abs_ltd / mass_delivered) * 100
@@ -581,37 +657,41 @@ class UncertaintyTools:
         abs_pres_cont = rel_pres_cont * flowrate / 100
         return abs_pres_cont
 
-    def calculate_abs_temp_per_sample(self, temperature):
+    def calculate_abs_temp_per_sample(self, temperature, fill_state: FillState):
         """
         Calculate and return the absolute uncertainty due to temperature
         effect.
 
         Parameters:
             - Temperature: Current measured temperature.
+            - Fill state: State of the filling, containing the previous temperature.
         Returns:
             - Absolute temperature effect uncertainty [kg/min]
         """
-        prev_temp = self.hrs_config.previous_temperature
+        prev_temp = fill_state.previous_temperature
         if temperature != prev_temp:
             abs_temp_kg_min = self.hrs_config.temperature_contribution  # 7.5E-5 kg/min
         else:
             abs_temp_kg_min = 0
         return abs_temp_kg_min
 
-    def calculate_relative_temperature_uncertainty(self, flowrate, temperature):
+    def calculate_relative_temperature_uncertainty(
+        self, flowrate, temperature, fill_state: FillState
+    ):
         """
         Returns the relative uncertainty associated to increasing temperature.
-        If this module is to be utilized in a different program, the temp_init
-        must be set as the starting temperature.
+        If this module is to be utilized in a different program, the previous
+        temperature of the fill state must be set as the starting temperature.
 
         Parameters:
             - flowrate [kg/min]
             - Temperature [C]
+            - Fill state: State of the filling, containing the previous temperature.
 
         Return:
             - Relative uncertainty associated to temperature the temperature effect.
         """
-        abs_temp_kg_min = self.calculate_abs_temp_per_sample(temperature)
+        abs_temp_kg_min = self.calculate_abs_temp_per_sample(temperature, fill_state)
         rel_unc = (abs_temp_kg_min / flowrate) * 100
         return rel_unc
 
@@ -645,19 +725,21 @@ class UncertaintyTools:
         abs_an_dev = (rel_annual_deviation * flowrate) / 100  # kg / min
         return abs_an_dev
 
-    def return_misc_press_data(self, flowrate, pressure, temperature):
+    def return_misc_press_data(
+        self, flowrate, pressure, temperature, fill_state: FillState
+    ):
         """
         This method returns the relative uncertainty of the pressure, temperature,
         and annual deviation - for plotting purposes.
 
         """
         rel_temp_unc = self.calculate_relative_temperature_uncertainty(
-            flowrate, temperature
+            flowrate, temperature, fill_state
         )
         rel_press_unc = self.calculate_relative_pressure_uncertainty(pressure)
         rel_annual_dev_unc = self.calculate_relative_annual_dev()
 
-        abs_temp_unc = self.calculate_abs_temp_per_sample(temperature)
+        abs_temp_unc = self.calculate_abs_temp_per_sample(temperature, fill_state)
         abs_press_unc = self.calculate_absolute_pressure_unc(pressure, flowrate)
         abs_annual_dev_unc = self.calculate_absolute_annual_dev(flowrate)
 
@@ -670,21 +752,383 @@ class UncertaintyTools:
             abs_annual_dev_unc,
         )
 
-    def return_abs_error_data(
-        self, pre_fill_press, pre_fill_temp, post_fill_press, post_fill_temp
-    ):
+    def return_abs_error_data(self, fill_state: FillState):
         """
-        Calculate and returns absolute uncertainty data
+        Calculate and returns absolute uncertainty data, based on the pre- and
+        post-fill conditions of the fill state.
         """
         depress_vent_uncertainty = self.calculate_depress_abs_unc(
-            post_fill_press, post_fill_temp
+            fill_state.post_fill_pressure, fill_state.post_fill_temp
         )
 
         # -> Returnerer kalkulert abs usikkerhet til depress [kg]
         dead_volume_uncertainty = self.caclulate_dead_volume_abs_unc(
-            pre_fill_press,
-            pre_fill_temp,
-            post_fill_press,
-            post_fill_temp,
+            fill_state.pre_fill_pressure,
+            fill_state.pre_fill_temp,
+            fill_state.post_fill_pressure,
+            fill_state.post_fill_temp,
         )
         return depress_vent_uncertainty, dead_volume_uncertainty
+
+    def get_relative_uncertainty_array(self, flowrates, multiple_bool, uncertainty):
+        """
+        Returns the relative uncertainty for an array of flowrates, either by linear
+        interpolation over the calibration curve, or as a single value.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Multiple bool: Whether the uncertainty varies with flowrate.
+            - Uncertainty: The curve or single value from the HRS configuration.
+
+        Returns:
+            - Array of relative uncertainties.
+        """
+        if multiple_bool:
+            return self.linear_interpolation(flowrates, uncertainty)
+        return np.full(flowrates.shape, uncertainty, dtype=float)
+
+    def calculate_component_arrays(
+        self,
+        flowrates,
+        temperatures,
+        pressures,
+        fill_state: FillState,
+        previous_temperatures=None,
+    ):
+        """
+        Array version of the get_*_std methods, and of the temperature, pressure and
+        annual deviation contributions. Every sample is evaluated in one NumPy call per
+        component, so the work is done in large chunks outside of the Python interpreter.
+        The temperature change is detected against the preceding sample, where the first
+        sample is compared to the previous temperature of the fill state. The fill state
+        is only read, allowing the method to be called from multiple threads.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - Fill state: State of the filling, containing the previous temperature.
+            - Previous temperatures: Optional array of the temperature preceding each
+              sample [C], for samples which are not consecutive.
+
+        Returns:
+            - Dictionary of absolute standard uncertainty arrays [kg/min].
+        """
+        flowrates = np.asarray(flowrates, dtype=float)
+        temperatures = np.asarray(temperatures, dtype=float)
+        pressures = np.asarray(pressures, dtype=float)
+        config = self.hrs_config
+
+        components = {}
+        for name, multiple_bool, uncertainty in (
+            (
+                "calibration_deviation",
+                config.multiple_calibration_deviation_bool,
+                config.get_calibration_deviation(),
+            ),
+            (
+                "calibration_reference",
+                config.multiple_calibration_reference_bool,
+                config.get_calibration_reference(),
+            ),
+            (
+                "field_repeatability",
+                config.multiple_field_repeatability_bool,
+                config.get_field_repeatability(),
+            ),
+            (
+                "field_condition",
+                config.multiple_field_condition_bool,
+                config.get_field_condition(),
+            ),
+        ):
+            relative = self.get_relative_uncertainty_array(
+                flowrates, multiple_bool, uncertainty
+            )
+            components[name] = np.multiply(relative, flowrates, out=relative)
+
+        # A single calibration repeatability is used as an absolute value.
+        if config.multiple_calibration_repeatability_bool:
+            relative = self.linear_interpolation(
+                flowrates, config.get_calibration_repeatability()
+            )
+            repeatability = np.multiply(relative, flowrates, out=relative)
+        else:
+            repeatability = np.full(
+                flowrates.shape, config.get_calibration_repeatability(), dtype=float
+            )
+        components["calibration_repeatability"] = repeatability
+
+        # Temperature effect, counted for samples where the temperature changed.
+        if previous_temperatures is None:
+            previous = np.empty_like(temperatures)
+            previous[..., 1:] = temperatures[..., :-1]
+            if fill_state.previous_temperature is None:
+                previous[..., :1] = np.nan
+            else:
+                previous[..., :1] = fill_state.previous_temperature
+        else:
+            previous = np.asarray(previous_temperatures, dtype=float)
+        changed = np.not_equal(temperatures, previous)
+        components["temperature"] = np.where(
+            changed, float(config.temperature_contribution), 0.0
+        )
+
+        # Pressure effect and long term drift.
+        pressure_effect = np.multiply(pressures, -config.pressure_contribution)
+        components["pressure"] = np.multiply(
+            pressure_effect, flowrates, out=pressure_effect
+        )
+        components["pressure"] /= 100
+        annual_deviation = config.annual_deviation * config.years_since_calibration
+        components["annual"] = np.multiply(flowrates, annual_deviation / 100)
+        return components
+
+    @timed("uncertainty_tools.sample_arrays")
+    def calculate_sample_arrays(
+        self,
+        flowrates,
+        temperatures,
+        pressures,
+        k,
+        fill_state: FillState,
+        previous_temperatures=None,
+    ):
+        """
+        Array version of the per sample calculations done during a filling. Returns the
+        same series as calculate_cfm_abs_unc_std, calculate_total_abs_unc_std,
+        calculate_cfm_rel_unc_k and return_misc_press_data, for every sample at once.
+        Samples without flow are given zero uncertainty, as in the scalar methods.
+
+        Parameters:
+            - Flowrates: Array of flowrates [kg/min]
+            - Temperatures: Array of temperatures [C]
+            - Pressures: Array of pressures [bar]
+            - k: Coverage factor
+            - Fill state: State of the filling, containing the previous temperature.
+            - Previous temperatures: Optional array of the temperature preceding each
+              sample [C], see calculate_component_arrays().
+
+        Returns:
+            - Dictionary of arrays: abs_cfm, abs_total [kg/min], comb_rel_k, rel_cfm_k [%],
+              rel_temp, rel_pres, rel_ltd [%], abs_temp, abs_pres and abs_ltd [kg/min].
+        """
+        flowrates = np.asarray(flowrates, dtype=float)
+        pressures = np.asarray(pressures, dtype=float)
+        components = self.calculate_component_arrays(
+            flowrates, temperatures, pressures, fill_state, previous_temperatures
+        )
+        flowing = flowrates != 0
+        divisor = np.where(flowing, flowrates, 1.0)
+
+        # Sum of variances of the meter components, and of the miscellaneous effects.
+        cfm_variance = np.zeros(flowrates.shape)
+        for name in (
+            "calibration_deviation",
+            "calibration_repeatability",
+            "calibration_reference",
+            "field_condition",
+            "field_repeatability",
+        ):
+            cfm_variance += np.square(components[name])
+        misc_variance = (
+            np.square(components["temperature"])
+            + np.square(components["pressure"])
+            + np.square(components["annual"])
+        )
+
+        rel_temp = np.where(flowing, components["temperature"] / divisor * 100, 0.0)
+        rel_pres = self.calculate_relative_pressure_uncertainty(pressures)
+        rel_ltd = np.full(flowrates.shape, self.calculate_relative_annual_dev(), dtype=float)
+        rel_misc_variance = (
+            np.square(rel_temp) + np.square(rel_pres) + np.square(rel_ltd)
+        )
+        rel_cfm_variance = cfm_variance / np.square(divisor) * 10000
+
+        return {
+            "abs_cfm": np.where(flowing, np.sqrt(cfm_variance), 0.0),
+            "abs_total": np.where(flowing, np.sqrt(cfm_variance + misc_variance), 0.0),
+            "comb_rel_k": np.where(
+                flowing, np.sqrt(rel_cfm_variance + rel_misc_variance) * k, 0.0
+            ),
+            "rel_cfm_k": np.where(flowing, np.sqrt(rel_cfm_variance) * k, 0.0),
+            "rel_temp": rel_temp,
+            "rel_pres": rel_pres,
+            "rel_ltd": rel_ltd,
+            "abs_temp": components["temperature"],
+            "abs_pres": components["pressure"],
+            "abs_ltd": components["annual"],
+        }
+
+    def calculate_root_quadratic_sums(self, constant, linear, slope, counts):
+        """
+        Returns the sums of sqrt(constant + (linear + slope * j)^2) for j = 1 to count,
+        the total uncertainty of the samples of a run where only the pressure changes.
+        Short runs are summed sample by sample, and long runs by the Euler-Maclaurin
+        formula, the integral of the sum and the corrections at its ends.
+
+        Parameters:
+            - Constant: Array of the variances which do not change within each run.
+            - Linear: Array of the pressure effect before the first sample [kg/min]
+            - Slope: Array of the change of the pressure effect per sample [kg/min]
+            - Counts: Array of the number of samples of each run.
+
+        Returns:
+            - Array of the sums [kg/min]
+        """
+        constant, linear, slope = np.broadcast_arrays(
+            np.asarray(constant, dtype=float),
+            np.asarray(linear, dtype=float),
+            np.asarray(slope, dtype=float),
+        )
+        counts = np.asarray(counts, dtype=np.int64)
+        sums = counts * np.sqrt(constant + np.square(linear + slope))
+
+        summed = (slope != 0) & ((counts <= 64) | ~(constant > 0))
+        runs = np.flatnonzero(summed)
+        if len(runs):
+            run_counts = counts[runs]
+            positions = np.arange(int(np.sum(run_counts))) - np.repeat(
+                np.cumsum(run_counts) - run_counts, run_counts
+            )
+            effect = np.repeat(linear[runs], run_counts) + (positions + 1) * np.repeat(
+                slope[runs], run_counts
+            )
+            values = np.sqrt(np.repeat(constant[runs], run_counts) + np.square(effect))
+            sums[runs] = np.bincount(
+                np.repeat(np.arange(len(runs)), run_counts), values, len(runs)
+            )
+
+        integrated = (slope != 0) & ~summed
+        if np.any(integrated):
+            variance = constant[integrated]
+            rate = slope[integrated]
+            first = linear[integrated] + rate
+            last = linear[integrated] + rate * counts[integrated]
+
+            def antiderivative(effect):
+                return 0.5 * (
+                    effect * np.sqrt(variance + np.square(effect))
+                    + variance * np.arcsinh(effect / np.sqrt(variance))
+                )
+
+            def derivatives(effect):
+                value = np.sqrt(variance + np.square(effect))
+                return (
+                    value,
+                    rate * effect / value,
+                    -3 * rate**3 * variance * effect / value**5,
+                )
+
+            first_value, first_slope, first_third = derivatives(first)
+            last_value, last_slope, last_third = derivatives(last)
+            sums[integrated] = (
+                (antiderivative(last) - antiderivative(first)) / rate
+                + (first_value + last_value) / 2
+                + (last_slope - first_slope) / 12
+                - (last_third - first_third) / 720
+            )
+        return sums
+
+    def calculate_run_totals(
+        self, compressed_fill, fill_state: FillState, formatting=1 / 60
+    ):
+        """
+        Run-length version of calculate_sample_arrays() followed by
+        FillState.record_samples(), for a CompressedFill. Within a run at a constant
+        flowrate, every sample after the first has the same meter, temperature and drift
+        uncertainty, so the run is evaluated once and scaled by its length, with only the
+        pressure effect changing linearly. The first sample of every run, and every
+        sample of runs where the flowrate changes, are evaluated one by one.
+
+        The temperature effect follows calculate_abs_temp_per_sample(): the first sample
+        of a run is compared to the last sample of the preceding run, or to the previous
+        temperature of the fill state, and the other samples change temperature when the
+        temperature of the run has a step. Runs where the rounded temperature changes at
+        only some of the samples are evaluated one by one.
+
+        For a pressure logged with decimals, the pressure effect of the remaining
+        samples of a run is taken on the line through the run, which is within half of
+        the last decimal of the rounded samples.
+
+        Parameters:
+            - Compressed fill: CompressedFill of the samples.
+            - Fill state: State of the filling, containing the previous temperature. The
+              fill state is only read.
+            - Formatting: Duration of each sample [min]
+
+        Returns:
+            - Array of the mass, cfm, total, temperature, pressure and drift uncertainty
+              [kg], as taken by FillState.add_totals().
+        """
+        lengths = compressed_fill.lengths
+        if len(lengths) == 0:
+            return np.zeros(6)
+        steps = compressed_fill.get_steps()
+        changes = compressed_fill.get_changes()
+        constant = (steps[0] == 0) & (changes[1] >= 0)
+
+        # Samples evaluated one by one.
+        counts = np.where(constant, 1, lengths)
+        heads = np.cumsum(counts) - counts
+        runs = np.repeat(np.arange(len(lengths)), counts)
+        positions = np.arange(int(np.sum(counts))) - np.repeat(heads, counts)
+        samples = compressed_fill.get_run_values(runs, positions)
+        initial = fill_state.previous_temperature
+        preceding = np.concatenate(
+            (
+                [np.nan if initial is None else initial],
+                compressed_fill.get_last_values()[1, :-1],
+            )
+        )
+        previous_temperatures = np.where(
+            positions > 0,
+            compressed_fill.get_run_values(runs, positions - 1)[1],
+            preceding[runs],
+        )
+        sample_arrays = self.calculate_sample_arrays(
+            samples[0], samples[1], samples[2], 1, fill_state, previous_temperatures
+        )
+        totals = np.array(
+            [
+                np.sum(samples[0]),
+                np.sum(sample_arrays["abs_cfm"]),
+                np.sum(sample_arrays["abs_total"]),
+                np.sum(sample_arrays["abs_temp"]),
+                np.sum(sample_arrays["abs_pres"]),
+                np.sum(sample_arrays["abs_ltd"]),
+            ]
+        )
+
+        # The remaining samples of the runs at a constant flowrate.
+        tails = np.flatnonzero(constant & (lengths > 1))
+        if len(tails):
+            count = lengths[tails] - 1
+            head = heads[tails]
+            flowrate = samples[0, head]
+            cfm = sample_arrays["abs_cfm"][head]
+            annual = sample_arrays["abs_ltd"][head]
+            temperature = np.where(
+                changes[1, tails] == 1,
+                float(self.hrs_config.temperature_contribution),
+                0.0,
+            )
+            pressure_factor = -self.hrs_config.pressure_contribution * flowrate / 100
+            tail_pressures = compressed_fill.get_run_values(tails, 0, rounded=False)[2]
+            linear = pressure_factor * tail_pressures
+            slope = pressure_factor * steps[2, tails]
+            total = self.calculate_root_quadratic_sums(
+                np.square(cfm) + np.square(temperature) + np.square(annual),
+                linear,
+                slope,
+                count,
+            )
+            totals += [
+                np.sum(count * flowrate),
+                np.sum(count * cfm),
+                np.sum(np.where(flowrate != 0, total, 0.0)),
+                np.sum(count * temperature),
+                np.sum(count * linear + slope * count * (count + 1) / 2),
+                np.sum(count * annual),
+            ]
+        return totals * formatting